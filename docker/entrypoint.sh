@@ -37,7 +37,18 @@ CONTAINER_NAME="geomet-mapproxy-nightly"
 CONTAINER_HOST=${CONTAINER_HOST:=0.0.0.0}
 CONTAINER_PORT=${CONTAINER_PORT:=80}
 WSGI_WORKERS=${WSGI_WORKERS:=2}
+WSGI_THREADS=${WSGI_THREADS:=1}
 WSGI_WORKER_TIMEOUT=${WSGI_WORKER_TIMEOUT:=900}
+GEOMET_MAPPROXY_RELOAD=${GEOMET_MAPPROXY_RELOAD:=mtime}
+
+if [ "$GEOMET_MAPPROXY_RELOAD" = "signal" ]; then
+    # build MapProxy once in the master process (shared by workers) and
+    # gracefully replace workers when the configuration changes
+    WSGI_RELOAD_OPTS="--config python:geomet_mapproxy.gunicorn_config"
+else
+    # workers check configuration mtimes on each request
+    WSGI_RELOAD_OPTS="--reload"
+fi
 
 # create default cache directory
 echo "Creating default cache directory for geomet-mapproxy"
@@ -47,20 +58,25 @@ geomet-mapproxy cache create
 echo "Creating initial config for geomet-mapproxy"
 geomet-mapproxy config create
 
+# reset metrics of previous worker processes
+[ -n "${GEOMET_MAPPROXY_METRICS_DIR}" ] && rm -rf "${GEOMET_MAPPROXY_METRICS_DIR}"
+
 # pass in GEOMET_MAPPROXY env variables to /etc/environment so they are available to cron
 env | grep ^GEOMET_MAPPROXY >> /etc/environment
 # startup cron jobs (builds mapfile at schedule cron settings)
 service cron start
 
 # startup geomet-mapproxy on gunicorn
-echo "Starting gunicorn for name=${CONTAINER_NAME} on ${CONTAINER_HOST}:${CONTAINER_PORT} with ${WSGI_WORKERS} workers. Access logs output to ${GUNICORN_GEOMET_MAPPROXY_ACCESSLOG} and error logs to ${GUNICORN_GEOMET_MAPPROXY_ERRORLOG}"
+echo "Starting gunicorn for name=${CONTAINER_NAME} on ${CONTAINER_HOST}:${CONTAINER_PORT} with ${WSGI_WORKERS} workers x ${WSGI_THREADS} threads (reload=${GEOMET_MAPPROXY_RELOAD}). Access logs output to ${GUNICORN_GEOMET_MAPPROXY_ACCESSLOG} and error logs to ${GUNICORN_GEOMET_MAPPROXY_ERRORLOG}"
 gunicorn --workers ${WSGI_WORKERS} \
+    --threads ${WSGI_THREADS} \
     --name=${CONTAINER_NAME} \
     --bind ${CONTAINER_HOST}:${CONTAINER_PORT} \
     --chdir $BASEDIR/geomet_mapproxy wsgi:application \
-    --reload \
+    ${WSGI_RELOAD_OPTS} \
     --timeout ${WSGI_WORKER_TIMEOUT} \
     --access-logfile $GUNICORN_GEOMET_MAPPROXY_ACCESSLOG \
+    --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" "%({x-cache}o)s"' \
     --error-logfile $GUNICORN_GEOMET_MAPPROXY_ERRORLOG
 
 echo "END /entrypoint.sh"
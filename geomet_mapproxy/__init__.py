@@ -27,10 +27,12 @@
 #
 # =================================================================
 
+import importlib
+import os
+import sys
+
 import click
 
-from geomet_mapproxy.cache import cache
-from geomet_mapproxy.config import config
 from geomet_mapproxy.env import (
     GEOMET_MAPPROXY_LOGGING_LOGLEVEL, GEOMET_MAPPROXY_LOGGING_LOGFILE)
 from geomet_mapproxy.log import setup_logger
@@ -38,14 +40,84 @@ from geomet_mapproxy.log import setup_logger
 
 __version__ = '0.2.0'
 
+# benchmark harness, part of the source tree but not of the installed package
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests')
+
 setup_logger(GEOMET_MAPPROXY_LOGGING_LOGLEVEL, GEOMET_MAPPROXY_LOGGING_LOGFILE)
 
 
-@click.group()
+class LazyGroup(click.Group):
+    """
+    Click group importing its subcommands on first use, so that commands
+    only load the dependencies they need
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        """
+        Initialize group
+
+        :param lazy_subcommands: `dict` of subcommand names to import paths
+                                 (`module.attribute`) or functions
+                                 returning the subcommand
+
+        :returns: `geomet_mapproxy.LazyGroup`
+        """
+
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(super().list_commands(ctx) +
+                      list(self.lazy_subcommands.keys()))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands:
+            if callable(self.lazy_subcommands[cmd_name]):
+                return self.lazy_subcommands[cmd_name]()
+            module_name, attribute = \
+                self.lazy_subcommands[cmd_name].rsplit('.', 1)
+            module = importlib.import_module(module_name)
+            return getattr(module, attribute)
+
+        return super().get_command(ctx, cmd_name)
+
+
+def get_bench_command():
+    """
+    Get the benchmark harness command (`tests/bench.py`), or a command
+    reporting that it is not available (e.g. installed package)
+
+    :returns: `click.Command` of benchmark harness
+    """
+
+    if not os.path.isfile(os.path.join(BENCH_DIR, 'bench.py')):
+        @click.command('bench', add_help_option=False,
+                       context_settings={'ignore_unknown_options': True})
+        @click.argument('args', nargs=-1, type=click.UNPROCESSED)
+        def bench(args):
+            """Benchmark geomet-mapproxy (source checkout only)"""
+
+            msg = ('Benchmark harness not found in {}: run geomet-mapproxy '
+                   'from a source checkout'.format(BENCH_DIR))
+            raise click.ClickException(msg)
+
+        return bench
+
+    # the harness runs benchmarks in spawned processes, which import it
+    # by module name
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+
+    return importlib.import_module('bench').bench
+
+
+@click.group(cls=LazyGroup, lazy_subcommands={
+    'bench': get_bench_command,
+    'cache': 'geomet_mapproxy.cache.cache',
+    'config': 'geomet_mapproxy.config.config',
+    'stats': 'geomet_mapproxy.stats.stats'
+})
 @click.version_option(version=__version__)
 def cli():
     pass
-
-
-cli.add_command(cache)
-cli.add_command(config)
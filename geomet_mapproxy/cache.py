@@ -35,8 +35,10 @@ import click
 
 from geomet_mapproxy import cli_options
 from geomet_mapproxy.env import (GEOMET_MAPPROXY_CACHE_DATA,
-                                 GEOMET_MAPPROXY_CONFIG)
-from geomet_mapproxy.util import yaml_load
+                                 GEOMET_MAPPROXY_CONFIG,
+                                 GEOMET_MAPPROXY_TMP)
+from geomet_mapproxy.layers import expand_layers, split_selectors
+from geomet_mapproxy.util import yaml_load_snapshot
 
 LOGGER = logging.getLogger(__name__)
 
@@ -75,6 +77,7 @@ def clean(ctx, layers, force):
     to_delete = False
     dirs_to_delete = []
 
+    layers = split_selectors(layers)
     if layers is None:
         raise click.ClickException('--layers must be "all" or a list')
 
@@ -89,12 +92,15 @@ def clean(ctx, layers, force):
         return
 
     if layers is not None:
-        if layers == 'all':
+        if layers == ['all']:
             dirs_to_delete = [GEOMET_MAPPROXY_CACHE_DATA]
         else:
-            layer_dirs = [x.strip() for x in layers.split(',')]
-            with open(GEOMET_MAPPROXY_CONFIG) as fh:
-                yaml_config = yaml_load(fh)
+            layer_dirs = layers
+            yaml_config = yaml_load_snapshot(GEOMET_MAPPROXY_CONFIG,
+                                             GEOMET_MAPPROXY_TMP)
+
+            layer_dirs = expand_layers(
+                layer_dirs, [x['name'] for x in yaml_config['layers']])
 
             for ld in layer_dirs:
                 cache_layer = list(filter(lambda x: x['name'] == ld,
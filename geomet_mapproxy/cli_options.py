@@ -30,8 +30,13 @@
 import click
 
 OPTION_LAYERS = click.option(
-    '--layers', default=None,
-    help='CSV list of layer names (layer1,layer2,...) or "all" for all layers')
+    '--layers', multiple=True,
+    help='CSV list of layer names or patterns (layer1,RADAR_*,re:GDPS\\..*) '
+         'or "all" for all layers (repeatable)')
 OPTION_MODE = click.option(
     '--mode', default='wms', type=click.Choice(['mapfile', 'wms', 'xml']),
     help='mode of deriving temporal properties')
+OPTION_PROFILE = click.option(
+    '--profile', 'profile', default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help='Write cProfile statistics (pstats) to file and report peak memory')
@@ -27,14 +27,15 @@
 #
 # =================================================================
 
+from fnmatch import fnmatchcase
+import hashlib
+import json
 import logging
 import os
 import shutil
+import time
 
 import click
-import mappyfile
-from owslib.wms import WebMapService
-import yaml
 
 from geomet_mapproxy import cli_options
 from geomet_mapproxy.env import (
@@ -44,21 +45,82 @@ from geomet_mapproxy.env import (
     GEOMET_MAPPROXY_CACHE_XML,
     GEOMET_MAPPROXY_CACHE_WMS,
     GEOMET_MAPPROXY_CONFIG,
-    GEOMET_MAPPROXY_TMP
+    GEOMET_MAPPROXY_TMP,
+    GEOMET_MAPPROXY_WMS_BREAKER_COOLDOWN,
+    GEOMET_MAPPROXY_WMS_BREAKER_THRESHOLD,
+    GEOMET_MAPPROXY_WMS_BUDGET,
+    GEOMET_MAPPROXY_WMS_RETRIES,
+    GEOMET_MAPPROXY_WMS_TIMEOUT
 )
-from geomet_mapproxy.util import yaml_load
+from geomet_mapproxy.layers import expand_layers, split_selectors
+from geomet_mapproxy.profiling import PhaseTimer, log_event, phase, profiler
+from geomet_mapproxy.shard import (
+    create_routing_map,
+    get_node_config_filepath,
+    get_node_mapproxy_config,
+    get_node_names,
+    get_rebalance_report,
+    read_routing_map,
+    write_routing_map
+)
+from geomet_mapproxy.upstream import CircuitBreaker, call_with_retries
+from geomet_mapproxy.util import (FileLock, prune_config_files,
+                                  read_config_fragments,
+                                  read_config_structure,
+                                  read_dimensions_index,
+                                  write_config_fragments,
+                                  write_config_generation,
+                                  write_config_snapshot,
+                                  write_config_structure,
+                                  write_dimensions_index,
+                                  yaml_dump_fragments, yaml_load_snapshot)
 
 LOGGER = logging.getLogger(__name__)
 
 TMP_FILE = os.path.join(GEOMET_MAPPROXY_TMP, 'geomet-mapproxy-config.yml')
-
-
-def from_wms(layers=[]):
+LOCK_FILE = os.path.join(GEOMET_MAPPROXY_TMP, 'geomet-mapproxy-config.lock')
+BREAKER_FILE = os.path.join(GEOMET_MAPPROXY_TMP,
+                            'geomet-mapproxy-wms-breaker.json')
+
+# exit status of a create/update skipped while another one is running
+# (EX_TEMPFAIL)
+EXIT_LOCKED = 75
+
+GRIDS = [
+    'GLOBAL_GEODETIC',
+    'GLOBAL_WEBMERCATOR',
+    'CANADA_ATLAS_LAMBERT'
+]
+
+# tuning profile options and their validators
+PROFILE_OPTIONS = {
+    'meta_size': lambda v: (isinstance(v, list) and len(v) == 2 and
+                            all(isinstance(i, int) and i > 0 for i in v)),
+    'meta_buffer': lambda v: isinstance(v, int) and v >= 0,
+    'minimize_meta_requests': lambda v: isinstance(v, bool),
+    'concurrent_requests': lambda v: isinstance(v, int) and v > 0,
+    'http_timeout': lambda v: (isinstance(v, (int, float)) and
+                               not isinstance(v, bool) and v > 0),
+    'grids': lambda v: (isinstance(v, list) and len(v) > 0 and
+                        all(i in GRIDS for i in v)),
+    'format': lambda v: isinstance(v, str) and (v.startswith('image/') or
+                                                v == 'mixed')
+}
+
+
+def from_wms(layers=[], timer=None, budget=None):
     """
     Derives temporal information from a WMS
 
-    :param layers:
+    Each layer is requested with a timeout and capped retries, behind a
+    circuit breaker of the upstream, within a total time budget (once spent,
+    the remaining layers are skipped).  Layers which cannot be fetched keep
+    their last known dimensions (from the dimensions index).
+
     :param layers: `list` of layer names
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
+    :param budget: total time budget of all requests (seconds, defaults to
+                   `GEOMET_MAPPROXY_WMS_BUDGET`, 0 to disable)
 
     :returns: `dict` of layer temporal configuration
     """
@@ -66,29 +128,96 @@ def from_wms(layers=[]):
     if GEOMET_MAPPROXY_CACHE_WMS is None:
         raise RuntimeError('GEOMET_MAPPROXY_CACHE_WMS not set')
 
+    from owslib.wms import WebMapService
+
+    breaker = CircuitBreaker(BREAKER_FILE,
+                             GEOMET_MAPPROXY_WMS_BREAKER_THRESHOLD,
+                             GEOMET_MAPPROXY_WMS_BREAKER_COOLDOWN)
+    index = None
+    stale_layers = []
+
+    if budget is None:
+        budget = GEOMET_MAPPROXY_WMS_BUDGET
+    deadline = time.monotonic() + budget if budget > 0 else None
+    budget_spent = False
+
+    def get_timeout():
+        if deadline is None:
+            return GEOMET_MAPPROXY_WMS_TIMEOUT
+        return max(min(GEOMET_MAPPROXY_WMS_TIMEOUT,
+                       deadline - time.monotonic()), 0.001)
+
     ltu = {}
     for layer in layers:
         LOGGER.debug('Requesting WMS Capabilities for layer: {}'.format(layer))
         url = '{}?layer={}'.format(GEOMET_MAPPROXY_CACHE_WMS, layer)
-        wms = WebMapService(url, version='1.3.0')
-
-        for dimension in wms[layer].dimensions.keys():
-            if layer not in ltu.keys():
-                ltu[layer] = {}
+        dimensions = None
+        attempts = 0
+
+        start = time.perf_counter()
+        with phase(timer, 'fetch', layer):
+            if deadline is not None and time.monotonic() >= deadline:
+                if not budget_spent:
+                    LOGGER.warning('WMS time budget of {}s spent, skipping '
+                                   'remaining layers'.format(budget))
+                    budget_spent = True
+                status = 'skipped'
+            elif not breaker.allow():
+                status = 'skipped'
+            else:
+                try:
+                    wms, attempts = call_with_retries(
+                        lambda: WebMapService(
+                            url, version='1.3.0', timeout=get_timeout()),
+                        GEOMET_MAPPROXY_WMS_RETRIES, deadline=deadline)
+                    breaker.record_success()
+                    dimensions = wms[layer].dimensions
+                    status = 'ok'
+                except KeyError:
+                    # the upstream responded, without the layer
+                    LOGGER.warning('Layer {} not found in WMS'.format(layer))
+                    status = 'missing'
+                except Exception as err:
+                    # network errors, timeouts, service exceptions or
+                    # invalid Capabilities documents
+                    LOGGER.warning('Cannot fetch layer {}: {}'.format(
+                        layer, err))
+                    status = 'failed'
+                    breaker.record_failure()
+
+        log_event('layer_fetch', layer=layer, status=status,
+                  attempts=attempts,
+                  duration=round(time.perf_counter() - start, 6))
+
+        if dimensions is None:
+            if index is None:
+                index = read_dimensions_index(GEOMET_MAPPROXY_CONFIG)
+            if layer in index['layers']:
+                stale_layers.append(layer)
+                ltu[layer] = index['layers'][layer]['dimensions']
+            continue
+
+        ltu[layer] = {}
+        for dimension in dimensions.keys():
             ltu[layer][dimension] = {
-                'default': wms[layer].dimensions[dimension]['default'],
-                'values': wms[layer].dimensions[dimension]['values']
+                'default': dimensions[dimension]['default'],
+                'values': dimensions[dimension]['values']
             }
 
+    if stale_layers:
+        LOGGER.warning('Keeping last known dimensions of {} layers: {}'.format(
+            len(stale_layers), ', '.join(stale_layers)))
+
     return ltu
 
 
-def from_mapfile(layers):
+def from_mapfile(layers, timer=None):
     """
     Derives temporal information from a MapServer mapfile
 
     :param mapfile: filepath to mapfile on disk
     :param layers: `list` of layer names
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
 
     :returns: `dict` of layer temporal configuration
     """
@@ -96,6 +225,8 @@ def from_mapfile(layers):
     if GEOMET_MAPPROXY_CACHE_MAPFILE is None:
         raise RuntimeError('GEOMET_MAPPROXY_CACHE_MAPFILE not set')
 
+    import mappyfile
+
     ltu = {}
     all_layers = False
 
@@ -103,7 +234,8 @@ def from_mapfile(layers):
         LOGGER.debug('Processing all layers')
         all_layers = True
         LOGGER.debug('Reading global mapfile from disk')
-        f = mappyfile.open(GEOMET_MAPPROXY_CACHE_MAPFILE)
+        with phase(timer, 'parse'):
+            f = mappyfile.open(GEOMET_MAPPROXY_CACHE_MAPFILE)
 
     for layer in layers:
         if not all_layers:
@@ -111,7 +243,8 @@ def from_mapfile(layers):
                 os.path.dirname(GEOMET_MAPPROXY_CACHE_MAPFILE), layer
             )
             LOGGER.debug('Reading layer mapfile from disk')
-            f = mappyfile.open(filepath)
+            with phase(timer, 'parse', layer):
+                f = mappyfile.open(filepath)
 
         if layer not in ltu.keys():
             ltu[layer] = {}
@@ -133,12 +266,13 @@ def from_mapfile(layers):
     return ltu
 
 
-def from_xml(layers):
+def from_xml(layers, timer=None):
     """
     Derives temporal information from a Capabilities XML file on disk
 
     :param mapfile: filepath to Capabilities XML on disk
     :param layers: `list` of layer names
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
 
     :returns: `dict` of layer temporal configuration
     """
@@ -146,32 +280,104 @@ def from_xml(layers):
     if GEOMET_MAPPROXY_CACHE_XML is None:
         raise RuntimeError('GEOMET_MAPPROXY_CACHE_XML not set')
 
+    from owslib.wms import WebMapService
+
     ltu = {}
 
     LOGGER.debug('Reading global WMS Capabilities XML from disk')
     with open(GEOMET_MAPPROXY_CACHE_XML, 'rb') as fh:
-        xml = fh.read()
+        with phase(timer, 'read'):
+            xml = fh.read()
 
-        wms = WebMapService('url', version='1.3.0', xml=xml)
+        with phase(timer, 'parse'):
+            wms = WebMapService('url', version='1.3.0', xml=xml)
 
         for layer in layers:
-            for dimension in wms[layer].dimensions.keys():
-                if layer not in ltu.keys():
-                    ltu[layer] = {}
-                ltu[layer][dimension] = {
-                    'default': wms[layer].dimensions[dimension]['default'],
-                    'values': wms[layer].dimensions[dimension]['values']
-                }
+            with phase(timer, 'extract', layer):
+                ltu[layer] = {}
+                for dimension in wms[layer].dimensions.keys():
+                    ltu[layer][dimension] = {
+                        'default': wms[layer].dimensions[dimension][
+                            'default'],
+                        'values': wms[layer].dimensions[dimension]['values']
+                    }
 
     return ltu
 
 
-def create_initial_mapproxy_config(mapproxy_cache_config, mode='wms'):
+def validate_cache_config(mapproxy_cache_config):
+    """
+    Validates cache configuration tuning profiles and layer patterns
+
+    :param mapproxy_cache_config: `dict` of cache configuration
+
+    :returns: `bool` of validation result (raises `RuntimeError` on error)
+    """
+
+    profiles = mapproxy_cache_config.get('profiles') or {}
+    layer_profiles = mapproxy_cache_config.get('layer-profiles') or []
+
+    if not isinstance(profiles, dict):
+        raise RuntimeError('profiles must be a mapping of named profiles')
+
+    for name, profile in profiles.items():
+        if not isinstance(profile, dict):
+            raise RuntimeError('Profile {} must be a mapping'.format(name))
+        for key, value in profile.items():
+            if key not in PROFILE_OPTIONS:
+                msg = 'Profile {}: unknown option {}'.format(name, key)
+                raise RuntimeError(msg)
+            if not PROFILE_OPTIONS[key](value):
+                msg = 'Profile {}: invalid value for {}: {}'.format(
+                    name, key, value)
+                raise RuntimeError(msg)
+
+    if not isinstance(layer_profiles, list):
+        raise RuntimeError('layer-profiles must be a list')
+
+    for layer_profile in layer_profiles:
+        if not isinstance(layer_profile, dict) or \
+                {'pattern', 'profile'} - set(layer_profile.keys()):
+            msg = 'layer-profiles entries require a pattern and a profile'
+            raise RuntimeError(msg)
+        if layer_profile['profile'] not in profiles:
+            msg = 'Unknown profile {} for pattern {}'.format(
+                layer_profile['profile'], layer_profile['pattern'])
+            raise RuntimeError(msg)
+
+    return True
+
+
+def get_layer_profile(mapproxy_cache_config, layer):
+    """
+    Derives the tuning profile of a layer from the cache configuration
+    (first matching layer pattern, else the `default` profile if defined)
+
+    :param mapproxy_cache_config: `dict` of cache configuration
+    :param layer: layer name
+
+    :returns: `dict` of tuning profile
+    """
+
+    profiles = mapproxy_cache_config.get('profiles') or {}
+
+    for layer_profile in mapproxy_cache_config.get('layer-profiles') or []:
+        if fnmatchcase(layer, layer_profile['pattern']):
+            return profiles[layer_profile['profile']]
+
+    return profiles.get('default', {})
+
+
+def create_initial_mapproxy_config(mapproxy_cache_config, mode='wms',
+                                   timer=None, layer_names=None):
     """
     Creates initial MapProxy configuration with current temporal information
 
     :param mapproxy_cache_config: `dict` of cache configuration
     :param mode: mode of deriving temporal properties
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
+    :param layer_names: `list` of expanded layer names (optional, expanded
+                        from the cache configuration if not given)
 
     :returns: `dict` of new configuration
     """
@@ -182,42 +388,63 @@ def create_initial_mapproxy_config(mapproxy_cache_config, mode='wms'):
 
     c = mapproxy_cache_config
 
-    LOGGER.debug('Building up configuration')
-    for layer in mapproxy_cache_config['wms-server']['layers']:
-        LOGGER.debug('Configuring layer: {}'.format(layer))
-        LOGGER.debug('Configuring layer caches')
-        caches['{}_cache'.format(layer)] = {
-            'grids': [
-                'GLOBAL_GEODETIC',
-                'GLOBAL_WEBMERCATOR',
-                'CANADA_ATLAS_LAMBERT'
-            ],
-            'sources': ['{}_source'.format(layer)]
-        }
+    validate_cache_config(c)
 
-        LOGGER.debug('Configuring layer sources')
-        sources['{}_source'.format(layer)] = {
-            'forward_req_params': ['time', 'dim_reference_time'],
-            'req': {
-                'layers': layer,
-                'transparent': True,
-                'url': c['wms-server']['url']
-            },
-            'type': 'wms',
-            'wms_opts': {
-                'featureinfo_format': 'application/vnd.ogc.gml',
-                'legendgraphic': True,
-                'version': '1.3.0'
-            }
-        }
+    if layer_names is None:
+        LOGGER.debug('Expanding layer selectors')
+        with phase(timer, 'expand_layers'):
+            layer_names = expand_layers(
+                [str(x) for x in c['wms-server']['layers']], mode=mode)
 
-        layers.append(
-            {
-                'name': layer,
-                'title': layer,
-                'sources': ['{}_cache'.format(layer)],
+    LOGGER.debug('Building up configuration')
+    with phase(timer, 'build'):
+        for layer in layer_names:
+            LOGGER.debug('Configuring layer: {}'.format(layer))
+            profile = get_layer_profile(c, layer)
+
+            LOGGER.debug('Configuring layer caches')
+            caches['{}_cache'.format(layer)] = {
+                'grids': list(profile.get('grids', GRIDS)),
+                'sources': ['{}_source'.format(layer)]
             }
-        )
+            for key in ['meta_size', 'meta_buffer', 'minimize_meta_requests',
+                        'format']:
+                if key in profile:
+                    value = profile[key]
+                    if isinstance(value, list):  # avoid YAML aliases on dump
+                        value = list(value)
+                    caches['{}_cache'.format(layer)][key] = value
+
+            LOGGER.debug('Configuring layer sources')
+            sources['{}_source'.format(layer)] = {
+                'forward_req_params': ['time', 'dim_reference_time'],
+                'req': {
+                    'layers': layer,
+                    'transparent': True,
+                    'url': c['wms-server']['url']
+                },
+                'type': 'wms',
+                'wms_opts': {
+                    'featureinfo_format': 'application/vnd.ogc.gml',
+                    'legendgraphic': True,
+                    'version': '1.3.0'
+                }
+            }
+            if 'concurrent_requests' in profile:
+                sources['{}_source'.format(layer)]['concurrent_requests'] = \
+                    profile['concurrent_requests']
+            if 'http_timeout' in profile:
+                sources['{}_source'.format(layer)]['http'] = {
+                    'client_timeout': profile['http_timeout']
+                }
+
+            layers.append(
+                {
+                    'name': layer,
+                    'title': layer,
+                    'sources': ['{}_cache'.format(layer)],
+                }
+            )
 
     dict_ = {
         'sources': sources,
@@ -251,43 +478,293 @@ def create_initial_mapproxy_config(mapproxy_cache_config, mode='wms'):
             }
         }
     }
-    final_dict = update_mapproxy_config(dict_, c['wms-server']['layers'], mode)
+    final_dict = update_mapproxy_config(dict_, layer_names, mode, timer)
 
     return final_dict
 
 
-def update_mapproxy_config(mapproxy_config, layers=[], mode='wms'):
+def update_mapproxy_config(mapproxy_config, layers=[], mode='wms',
+                           timer=None):
     """
-    Updates MapProxy configuration with current temporal information
+    Updates MapProxy configuration with current temporal information.  The
+    dimensions of harvested layers are replaced as a whole (removed if the
+    layer has none), layers which could not be harvested are left as is
 
     :param mapproxy_config: `dict` of MapProxy configuration
     :param layers: `list` of layer names
     :param mode: mode of deriving temporal properties
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
 
     :returns: `dict` of updated configuration
     """
 
     if mode == 'wms':
-        layers_to_update = from_wms(layers)
+        layers_to_update = from_wms(layers, timer)
     elif mode == 'xml':
-        layers_to_update = from_xml(layers)
+        layers_to_update = from_xml(layers, timer)
     elif mode == 'mapfile':
-        layers_to_update = from_mapfile(layers)
-
-    for layer in mapproxy_config['layers']:
-        layer_name = layer['name']
-        if layer_name in layers_to_update:
+        layers_to_update = from_mapfile(layers, timer)
+
+    with phase(timer, 'apply_dimensions'):
+        for layer in mapproxy_config['layers']:
+            layer_name = layer['name']
+            if layer_name not in layers_to_update:
+                continue
+            dimensions = {}
             for dim in layers_to_update[layer_name].keys():
-                if 'dimensions' not in layer.keys():
-                    layer['dimensions'] = {}
-                layer['dimensions'][dim] = {
+                dimensions[dim] = {
                     'default': layers_to_update[layer_name][dim]['default'],
                     'values': layers_to_update[layer_name][dim]['values']
                 }
+            if dimensions:
+                layer['dimensions'] = dimensions
+            else:
+                layer.pop('dimensions', None)
 
     return mapproxy_config
 
 
+def get_config_structure_key(mapproxy_cache_config, layer_names):
+    """
+    Derives the structure key of a MapProxy configuration, i.e. a hash of
+    the inputs its sources, caches and layers are generated from
+
+    :param mapproxy_cache_config: `dict` of cache configuration
+    :param layer_names: `list` of expanded layer names
+
+    :returns: `str` of structure key
+    """
+
+    from geomet_mapproxy import __version__
+
+    inputs = {
+        'version': __version__,
+        'cache_data': GEOMET_MAPPROXY_CACHE_DATA,
+        'cache_config': mapproxy_cache_config,
+        'layers': layer_names
+    }
+
+    return hashlib.sha256(json.dumps(
+        inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def refresh_mapproxy_config(mapproxy_cache_config, mode='wms', timer=None):
+    """
+    Refreshes the temporal information of all layers of the current MapProxy
+    configuration, regenerating the configuration only when its structure
+    (cache configuration or expanded layer list) changed
+
+    :param mapproxy_cache_config: `dict` of cache configuration
+    :param mode: mode of deriving temporal properties
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
+
+    :returns: `tuple` of `dict` of configuration, `str` of structure key and
+              `bool` of whether the configuration was regenerated
+    """
+
+    validate_cache_config(mapproxy_cache_config)
+
+    LOGGER.debug('Expanding layer selectors')
+    with phase(timer, 'expand_layers'):
+        layer_names = expand_layers(
+            [str(x) for x in mapproxy_cache_config['wms-server']['layers']],
+            mode=mode)
+
+    key = get_config_structure_key(mapproxy_cache_config, layer_names)
+
+    if key != read_config_structure(GEOMET_MAPPROXY_CONFIG):
+        LOGGER.info('Configuration structure changed, regenerating')
+        mapproxy_config = create_initial_mapproxy_config(
+            mapproxy_cache_config, mode, timer, layer_names)
+        return mapproxy_config, key, True
+
+    with phase(timer, 'yaml_load'):
+        mapproxy_config = yaml_load_snapshot(GEOMET_MAPPROXY_CONFIG,
+                                             GEOMET_MAPPROXY_TMP)
+
+    mapproxy_config = update_mapproxy_config(mapproxy_config, layer_names,
+                                             mode, timer)
+
+    return mapproxy_config, key, False
+
+
+def get_changed_layers(mapproxy_config, filepath=GEOMET_MAPPROXY_CONFIG):
+    """
+    Derives the layers whose dimensions differ from those of the MapProxy
+    configuration on disk (dimensions index)
+
+    :param mapproxy_config: `dict` of MapProxy configuration
+    :param filepath: filepath to MapProxy configuration
+
+    :returns: `list` of layer names
+    """
+
+    index = read_dimensions_index(filepath)['layers']
+
+    changed = []
+    for layer in mapproxy_config['layers']:
+        dimensions = layer.get('dimensions', {})
+        indexed = index.get(layer['name'], {}).get('dimensions')
+        # the index is JSON (non string values serialized as strings)
+        if indexed != dimensions and indexed != json.loads(
+                json.dumps(dimensions, default=str)):
+            changed.append(layer['name'])
+
+    return changed
+
+
+def write_mapproxy_config(mapproxy_config,
+                          filepath=GEOMET_MAPPROXY_CONFIG, timer=None,
+                          layers=None):
+    """
+    Writes MapProxy configuration (via a temporary file), along with its
+    generation marker, dimensions index, compiled snapshot and YAML
+    fragments
+
+    :param mapproxy_config: `dict` of MapProxy configuration
+    :param filepath: filepath to MapProxy configuration
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
+    :param layers: `list` of names of the only layers changed since the
+                   configuration was last written, to only serialize these
+                   (optional)
+
+    :returns: `str` of MapProxy configuration filepath
+    """
+
+    tmp_file = TMP_FILE
+    if filepath != GEOMET_MAPPROXY_CONFIG:
+        tmp_file = os.path.join(GEOMET_MAPPROXY_TMP,
+                                os.path.basename(filepath))
+
+    fragments = None
+    if layers is not None:
+        fragments = read_config_fragments(filepath, GEOMET_MAPPROXY_TMP)
+
+    with phase(timer, 'yaml_dump'):
+        content, fragments = yaml_dump_fragments(mapproxy_config, fragments,
+                                                 layers)
+        content = content.encode('utf-8')
+        with open(tmp_file, 'wb') as fh:
+            fh.write(content)
+
+    LOGGER.debug('Moving {} to {}'.format(tmp_file, filepath))
+    with phase(timer, 'move'):
+        shutil.move(tmp_file, filepath)
+
+    with phase(timer, 'write_indexes'):
+        generation = write_config_generation(filepath)
+        write_dimensions_index(filepath, mapproxy_config)
+        write_config_snapshot(filepath, GEOMET_MAPPROXY_TMP, mapproxy_config,
+                              content)
+        write_config_fragments(filepath, GEOMET_MAPPROXY_TMP, fragments,
+                               generation)
+
+    return filepath
+
+
+def prune_tmp_files():
+    """
+    Prunes the snapshots and fragments of configurations no longer in use
+    (e.g. of former nodes), and leftover temporary files, from
+    `GEOMET_MAPPROXY_TMP`
+
+    :returns: `int` of number of files removed
+    """
+
+    filepaths = [GEOMET_MAPPROXY_CONFIG, GEOMET_MAPPROXY_CACHE_CONFIG]
+
+    routing_map = read_routing_map(GEOMET_MAPPROXY_CONFIG)
+    if routing_map is not None:
+        filepaths.extend(get_node_config_filepath(GEOMET_MAPPROXY_CONFIG, node)
+                         for node in routing_map['nodes'])
+
+    return prune_config_files(GEOMET_MAPPROXY_TMP, filepaths)
+
+
+def shard_mapproxy_config(mapproxy_config, nodes=None, timer=None,
+                          layers=None):
+    """
+    Partitions MapProxy configuration layers over nodes with consistent
+    hashing, writing one MapProxy configuration per node and a routing map
+    (layer to node).  Without nodes, the nodes of the existing routing map
+    are kept (if any)
+
+    :param mapproxy_config: `dict` of MapProxy configuration
+    :param nodes: `int` of number of nodes
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (optional)
+    :param layers: `list` of names of the only layers changed since the
+                   configuration was last sharded, to only rewrite the
+                   configurations of their nodes (optional)
+
+    :returns: `dict` of rebalance report, or `None` if not sharded
+    """
+
+    old_routing_map = read_routing_map(GEOMET_MAPPROXY_CONFIG)
+
+    if nodes is not None:
+        node_names = get_node_names(nodes)
+    elif old_routing_map is not None:
+        node_names = old_routing_map['nodes']
+    else:
+        return None
+
+    layer_names = [layer['name'] for layer in mapproxy_config['layers']]
+    with phase(timer, 'shard'):
+        routing_map = create_routing_map(layer_names, node_names)
+
+    if old_routing_map != routing_map:
+        layers = None
+
+    for node in node_names:
+        node_layers = None
+        if layers is not None:
+            node_layers = [x for x in layers
+                           if routing_map['layers'][x] == node]
+            if not node_layers:
+                LOGGER.debug('Configuration of node {} unchanged'.format(
+                    node))
+                continue
+        LOGGER.debug('Writing configuration of node {}'.format(node))
+        write_mapproxy_config(
+            get_node_mapproxy_config(mapproxy_config, routing_map, node),
+            get_node_config_filepath(GEOMET_MAPPROXY_CONFIG, node), timer,
+            node_layers)
+
+    with phase(timer, 'rebalance_report'):
+        report = get_rebalance_report(old_routing_map, routing_map,
+                                      GEOMET_MAPPROXY_CACHE_DATA)
+    write_routing_map(GEOMET_MAPPROXY_CONFIG, routing_map)
+
+    for node in set(report['nodes']['old']) - set(node_names):
+        LOGGER.debug('Removing configuration of node {}'.format(node))
+        try:
+            os.remove(get_node_config_filepath(GEOMET_MAPPROXY_CONFIG, node))
+        except FileNotFoundError:
+            pass
+
+    return report
+
+
+def get_fetch_summary(timer):
+    """
+    Summarizes per layer fetch timings of a command
+
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer`
+
+    :returns: `str` of fetch summary, or `None` if no layers were fetched
+    """
+
+    fetch = timer.summary(slowest=5)['phases'].get('fetch')
+
+    if fetch is None or 'slowest_layers' not in fetch:
+        return None
+
+    return 'Fetched {} layers in {:.2f}s (slowest: {})'.format(
+        fetch['count'], fetch['duration'], ', '.join(
+            '{} {:.2f}s'.format(layer, duration)
+            for layer, duration in fetch['slowest_layers']))
+
+
 @click.group()
 def config():
     """Manage MapProxy configuration"""
@@ -297,30 +774,68 @@ def config():
 @click.command()
 @click.pass_context
 @cli_options.OPTION_MODE
-def create(ctx, mode='wms'):
+@click.option('--nodes', '-n', 'nodes', type=click.IntRange(min=1),
+              default=None, help='Number of nodes to shard layers over')
+@cli_options.OPTION_PROFILE
+def create(ctx, mode='wms', nodes=None, profile=None):
     """Create initial MapProxy configuration"""
 
-    click.echo('Creating {}'.format(TMP_FILE))
+    lock = FileLock(LOCK_FILE)
+    if not lock.acquire():
+        click.echo('Another configuration update is running, skipping')
+        ctx.exit(EXIT_LOCKED)
 
-    click.echo(
-        'Reading from initial layer list ({})'.format(
-            GEOMET_MAPPROXY_CACHE_CONFIG
+    timer = PhaseTimer('create')
+
+    with lock, profiler(profile, 'create') as memory:
+        click.echo('Creating {}'.format(TMP_FILE))
+
+        click.echo(
+            'Reading from initial layer list ({})'.format(
+                GEOMET_MAPPROXY_CACHE_CONFIG
+            )
         )
-    )
 
-    with open(GEOMET_MAPPROXY_CACHE_CONFIG) as fh:
-        mapproxy_cache_config = yaml_load(fh)
+        with timer.phase('yaml_load'):
+            mapproxy_cache_config = yaml_load_snapshot(
+                GEOMET_MAPPROXY_CACHE_CONFIG, GEOMET_MAPPROXY_TMP)
+
+        try:
+            dict_ = create_initial_mapproxy_config(mapproxy_cache_config,
+                                                   mode, timer)
+        except RuntimeError as err:
+            LOGGER.error(err)
+            raise click.ClickException(
+                'Error creating config: {}'.format(err))
+
+        click.echo('Moving to {}'.format(GEOMET_MAPPROXY_CONFIG))
+        write_mapproxy_config(dict_, timer=timer)
+        key = get_config_structure_key(
+            mapproxy_cache_config, [x['name'] for x in dict_['layers']])
+        write_config_structure(GEOMET_MAPPROXY_CONFIG, key)
+
+        report = shard_mapproxy_config(dict_, nodes, timer)
+        prune_tmp_files()
+
+    timer.log()
 
-    try:
-        dict_ = create_initial_mapproxy_config(mapproxy_cache_config, mode)
-        with open(TMP_FILE, 'w') as fh:
-            yaml.dump(dict_, fh)
-    except RuntimeError as err:
-        LOGGER.error(err)
-        raise click.ClickException('Error creating config: {}'.format(err))
+    fetch_summary = get_fetch_summary(timer)
+    if fetch_summary is not None:
+        click.echo(fetch_summary)
+
+    if report is not None:
+        click.echo('Sharded {} layers over nodes {}'.format(
+            report['layers'], ', '.join(report['nodes']['new'])))
+        click.echo('Rebalance: {} layers ({} cached tiles) moved'.format(
+            report['moved_layers'], report['moved_tiles']))
+        for layer, move in sorted(report['moves'].items()):
+            click.echo('  {}: {} -> {} ({} tiles)'.format(
+                layer, move['from'], move['to'], move['tiles']))
+
+    if memory:
+        click.echo('Profile written to {} (peak RSS: {:.1f} MiB)'.format(
+            profile, memory['peak_rss'] / 1048576))
 
-    click.echo('Moving to {}'.format(GEOMET_MAPPROXY_CONFIG))
-    shutil.move(TMP_FILE, GEOMET_MAPPROXY_CONFIG)
     click.echo('Done')
 
 
@@ -328,32 +843,79 @@ def create(ctx, mode='wms'):
 @click.pass_context
 @cli_options.OPTION_LAYERS
 @cli_options.OPTION_MODE
-def update(ctx, layers, mode='wms'):
+@cli_options.OPTION_PROFILE
+def update(ctx, layers, mode='wms', profile=None):
     """Update MapProxy configuration"""
 
-    if layers is None:
-        click.echo('Updating all layers')
-        ctx.invoke(create, mode=mode)
-        return
-
-    click.echo('Reading {}'.format(GEOMET_MAPPROXY_CONFIG))
-    layers_ = [x.strip() for x in layers.split(',')]
-
-    click.echo('Updating layers {}'.format(layers_))
-    try:
-        with open(GEOMET_MAPPROXY_CONFIG, 'rb') as fh:
-            mapproxy_config = yaml_load(fh)
-
-        dict_ = update_mapproxy_config(mapproxy_config, layers_, mode)
-
-        with open(TMP_FILE, 'w') as fh:
-            yaml.dump(dict_, fh)
-
-        click.echo('Moving to {}'.format(GEOMET_MAPPROXY_CONFIG))
-        shutil.move(TMP_FILE, GEOMET_MAPPROXY_CONFIG)
-    except RuntimeError as err:
-        LOGGER.error(err)
-        raise click.ClickException('Error updating config: {}'.format(err))
+    lock = FileLock(LOCK_FILE)
+    if not lock.acquire():
+        click.echo('Another configuration update is running, skipping')
+        ctx.exit(EXIT_LOCKED)
+
+    timer = PhaseTimer('update')
+
+    with lock, profiler(profile, 'update') as memory:
+        try:
+            if not layers:
+                click.echo('Updating all layers')
+                with timer.phase('yaml_load'):
+                    mapproxy_cache_config = yaml_load_snapshot(
+                        GEOMET_MAPPROXY_CACHE_CONFIG, GEOMET_MAPPROXY_TMP)
+
+                dict_, key, regenerated = refresh_mapproxy_config(
+                    mapproxy_cache_config, mode, timer)
+                if regenerated:
+                    click.echo('Layer list changed, regenerated {}'.format(
+                        GEOMET_MAPPROXY_CONFIG))
+            else:
+                click.echo('Reading {}'.format(GEOMET_MAPPROXY_CONFIG))
+                layers_ = split_selectors(layers)
+
+                with timer.phase('yaml_load'):
+                    mapproxy_config = yaml_load_snapshot(
+                        GEOMET_MAPPROXY_CONFIG, GEOMET_MAPPROXY_TMP)
+
+                with timer.phase('expand_layers'):
+                    layers_ = expand_layers(
+                        layers_,
+                        [x['name'] for x in mapproxy_config['layers']])
+                click.echo('Updating layers {}'.format(layers_))
+
+                dict_ = update_mapproxy_config(mapproxy_config, layers_,
+                                               mode, timer)
+                key, regenerated = None, False
+
+            with timer.phase('diff'):
+                changed = regenerated or get_changed_layers(dict_)
+
+            if changed:
+                if not regenerated:
+                    click.echo('Dimensions of {} layers changed'.format(
+                        len(changed)))
+                layers_ = None if regenerated else changed
+                click.echo('Moving to {}'.format(GEOMET_MAPPROXY_CONFIG))
+                write_mapproxy_config(dict_, timer=timer, layers=layers_)
+                if key is not None:
+                    write_config_structure(GEOMET_MAPPROXY_CONFIG, key)
+                shard_mapproxy_config(dict_, timer=timer, layers=layers_)
+            else:
+                click.echo('No changes')
+
+            prune_tmp_files()
+        except RuntimeError as err:
+            LOGGER.error(err)
+            raise click.ClickException(
+                'Error updating config: {}'.format(err))
+
+    timer.log()
+
+    fetch_summary = get_fetch_summary(timer)
+    if fetch_summary is not None:
+        click.echo(fetch_summary)
+
+    if memory:
+        click.echo('Profile written to {} (peak RSS: {:.1f} MiB)'.format(
+            profile, memory['peak_rss'] / 1048576))
 
     click.echo('Done')
 
@@ -51,6 +51,18 @@ GEOMET_MAPPROXY_CONFIG = os.getenv('GEOMET_MAPPROXY_CONFIG', None)
 GEOMET_MAPPROXY_URL = os.getenv('GEOMET_MAPPROXY_URL', None)
 GEOMET_MAPPROXY_TMP = os.getenv('GEOMET_MAPPROXY_TMP', '/tmp')
 
+GEOMET_MAPPROXY_WMS_TIMEOUT = float(os.getenv('GEOMET_MAPPROXY_WMS_TIMEOUT',
+                                              10))
+GEOMET_MAPPROXY_WMS_RETRIES = int(os.getenv('GEOMET_MAPPROXY_WMS_RETRIES', 2))
+GEOMET_MAPPROXY_WMS_BREAKER_THRESHOLD = int(os.getenv(
+    'GEOMET_MAPPROXY_WMS_BREAKER_THRESHOLD', 5))
+GEOMET_MAPPROXY_WMS_BREAKER_COOLDOWN = float(os.getenv(
+    'GEOMET_MAPPROXY_WMS_BREAKER_COOLDOWN', 300))
+GEOMET_MAPPROXY_WMS_BUDGET = float(os.getenv(
+    'GEOMET_MAPPROXY_WMS_BUDGET', 3600))
+GEOMET_MAPPROXY_LAYER_INDEX_TTL = float(os.getenv(
+    'GEOMET_MAPPROXY_LAYER_INDEX_TTL', 900))
+
 if None in (GEOMET_MAPPROXY_CACHE_DATA, GEOMET_MAPPROXY_CONFIG,
             GEOMET_MAPPROXY_CACHE_CONFIG, GEOMET_MAPPROXY_URL,
             GEOMET_MAPPROXY_TMP):
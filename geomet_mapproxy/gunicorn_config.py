@@ -0,0 +1,62 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# gunicorn configuration for preload-and-fork serving:
+#
+#   gunicorn -c python:geomet_mapproxy.gunicorn_config wsgi:application
+#
+# with GEOMET_MAPPROXY_RELOAD=signal.  The MapProxy application is built
+# once in the master process and shared copy-on-write by the workers.  On
+# SIGHUP (sent by the master to itself when the configuration generation
+# marker changes), the application is rebuilt in the master and workers
+# are gracefully replaced
+
+import os
+
+from geomet_mapproxy.metrics import merge_process_metrics
+from geomet_mapproxy.server import reload_applications, watch_applications
+
+preload_app = True
+
+GEOMET_MAPPROXY_METRICS_DIR = os.environ.get('GEOMET_MAPPROXY_METRICS_DIR')
+GEOMET_MAPPROXY_RELOAD_INTERVAL = float(
+    os.environ.get('GEOMET_MAPPROXY_RELOAD_INTERVAL', 1))
+
+
+def when_ready(server):
+    watch_applications(GEOMET_MAPPROXY_RELOAD_INTERVAL)
+
+
+def on_reload(server):
+    reload_applications()
+
+
+def child_exit(server, worker):
+    if GEOMET_MAPPROXY_METRICS_DIR:
+        merge_process_metrics(GEOMET_MAPPROXY_METRICS_DIR, worker.pid)
@@ -0,0 +1,327 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from fnmatch import translate
+import json
+import logging
+import os
+import re
+import time
+
+from geomet_mapproxy.env import (
+    GEOMET_MAPPROXY_CACHE_MAPFILE,
+    GEOMET_MAPPROXY_CACHE_XML,
+    GEOMET_MAPPROXY_CACHE_WMS,
+    GEOMET_MAPPROXY_LAYER_INDEX_TTL,
+    GEOMET_MAPPROXY_TMP
+)
+
+LOGGER = logging.getLogger(__name__)
+
+GLOB_CHARS = ('*', '?', '[')
+REGEX_PREFIX = 're:'
+
+MAPFILE_LAYER = re.compile(r'^\s*LAYER\s*$', re.IGNORECASE)
+MAPFILE_NAME = re.compile(r'''^\s*NAME\s+["']?([^"'\s]+)''', re.IGNORECASE)
+
+# commas separating layer selectors (not within regex quantifiers {m,n})
+SELECTOR_SEPARATOR = re.compile(r',(?![^{}]*\})')
+
+
+def split_selectors(values):
+    """
+    Split layer selector option values
+
+    :param values: `list` of option values, each a CSV list of layer
+                   selectors (commas within braces, e.g. regex quantifiers
+                   such as `{1,3}`, do not separate selectors)
+
+    :returns: `list` of layer selectors, or `None` if none given
+    """
+
+    selectors = []
+
+    for value in values or []:
+        for selector in SELECTOR_SEPARATOR.split(value):
+            if selector.strip():
+                selectors.append(selector.strip())
+
+    return selectors or None
+
+
+def is_pattern(selector):
+    """
+    Detect whether a layer selector is a pattern (glob or regex)
+
+    :param selector: layer selector (layer name, glob, or `re:` regex)
+
+    :returns: `bool` of whether selector is a pattern
+    """
+
+    return (selector.startswith(REGEX_PREFIX) or
+            any(c in selector for c in GLOB_CHARS))
+
+
+def compile_selectors(selectors):
+    """
+    Compile layer selector patterns into a layer name matcher
+
+    Patterns are combined into a single regular expression, or matched one
+    by one when they are only valid on their own (e.g. regexes with inline
+    global flags such as `(?i)`, or repeating group names)
+
+    :param selectors: `list` of layer selector patterns
+
+    :returns: function returning whether a layer name matches a pattern
+    """
+
+    regexes = []
+    for selector in selectors:
+        if selector.startswith(REGEX_PREFIX):
+            regex = selector[len(REGEX_PREFIX):]
+            try:
+                regexes.append((re.compile(regex).fullmatch,
+                                '(?:{})\\Z'.format(regex)))
+            except re.error as err:
+                msg = 'Invalid layer regex {}: {}'.format(selector, err)
+                raise RuntimeError(msg)
+        else:
+            regex = translate(selector)
+            regexes.append((re.compile(regex).match, regex))
+
+    try:
+        return re.compile('|'.join(regex for _, regex in regexes)).match
+    except re.error:
+        matchers = [matcher for matcher, _ in regexes]
+        return lambda name: any(matcher(name) for matcher in matchers)
+
+
+def expand_layers(selectors, layer_names=None, mode='wms'):
+    """
+    Expand layer selectors into layer names
+
+    Selectors are layer names, glob patterns (e.g. `RADAR_*`) or regular
+    expressions prefixed with `re:` (e.g. `re:GDPS\\..*_TT`).  Layer names
+    are kept as is, patterns are matched against all layer names
+
+    :param selectors: `list` of layer selectors
+    :param layer_names: `list` of layer names to match patterns against
+                        (default is the layer index of `mode`)
+    :param mode: mode of deriving the layer index
+
+    :returns: `list` of layer names
+    """
+
+    names = [s for s in selectors if not is_pattern(s)]
+    patterns = [s for s in selectors if is_pattern(s)]
+
+    if not patterns:
+        return names
+
+    if layer_names is None:
+        layer_names = get_layer_index(mode)
+
+    matcher = compile_selectors(patterns)
+    seen = set(names)
+
+    for layer_name in layer_names:
+        if layer_name not in seen and matcher(layer_name):
+            names.append(layer_name)
+            seen.add(layer_name)
+
+    LOGGER.debug('Expanded {} into {} layers'.format(patterns, len(names)))
+
+    return names
+
+
+def layer_names_from_xml(xml):
+    """
+    Extract layer names from a WMS Capabilities document
+
+    :param xml: filepath or file-like object of WMS Capabilities XML
+
+    :returns: `list` of layer names
+    """
+
+    from lxml import etree
+
+    names = []
+    for event, element in etree.iterparse(xml, events=('end',)):
+        tag = etree.QName(element).localname
+        if tag == 'Name':
+            parent = element.getparent()
+            if (parent is not None and
+                    etree.QName(parent).localname == 'Layer' and
+                    element.text):
+                names.append(element.text.strip())
+        elif tag == 'Layer':
+            element.clear(keep_tail=True)
+
+    return names
+
+
+def layer_names_from_mapfile(mapfile):
+    """
+    Extract layer names from a MapServer mapfile
+
+    :param mapfile: filepath to mapfile on disk
+
+    :returns: `list` of layer names
+    """
+
+    names = []
+    in_layer = False
+
+    with open(mapfile) as fh:
+        for line in fh:
+            if MAPFILE_LAYER.match(line):
+                in_layer = True
+            elif in_layer:
+                match = MAPFILE_NAME.match(line)
+                if match is not None:
+                    names.append(match.group(1))
+                    in_layer = False
+
+    return names
+
+
+def get_layer_index(mode='wms'):
+    """
+    Get all layer names of the source of a mode, from a cached index
+    which is refreshed only when the source changes
+
+    :param mode: mode of deriving temporal properties (`wms`, `xml`
+                 or `mapfile`)
+
+    :returns: `list` of layer names
+    """
+
+    index_file = os.path.join(GEOMET_MAPPROXY_TMP,
+                              'geomet-mapproxy-layer-index-{}.json'.format(
+                                  mode))
+    index = {'signature': None, 'layers': []}
+
+    try:
+        with open(index_file) as fh:
+            index = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        LOGGER.debug('No layer index found')
+
+    if mode == 'wms':
+        signature, layer_names = refresh_layer_index_wms(index['signature'])
+    else:
+        if mode == 'xml':
+            filepath = GEOMET_MAPPROXY_CACHE_XML
+            func = layer_names_from_xml
+        elif mode == 'mapfile':
+            filepath = GEOMET_MAPPROXY_CACHE_MAPFILE
+            func = layer_names_from_mapfile
+        else:
+            raise RuntimeError('Unknown mode {}'.format(mode))
+
+        if filepath is None:
+            raise RuntimeError('Layer index source for {} not set'.format(
+                mode))
+
+        st = os.stat(filepath)
+        signature = [filepath, st.st_mtime_ns, st.st_size]
+        layer_names = None
+        if signature != index['signature']:
+            LOGGER.debug('Building layer index from {}'.format(filepath))
+            layer_names = func(filepath)
+
+    if layer_names is None:
+        LOGGER.debug('Layer index is up to date')
+        return index['layers']
+
+    index = {'signature': signature, 'layers': layer_names}
+    tmp_file = '{}.{}'.format(index_file, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump(index, fh)
+    os.replace(tmp_file, index_file)
+
+    return layer_names
+
+
+def refresh_layer_index_wms(signature=None,
+                            ttl=GEOMET_MAPPROXY_LAYER_INDEX_TTL):
+    """
+    Refresh layer names from WMS Capabilities using a conditional request,
+    or at most once per time to live if the WMS provides neither ETag nor
+    Last-Modified
+
+    :param signature: `list` of WMS URL, ETag, Last-Modified and fetch time
+                      of the cached layer index
+    :param ttl: time to live of a cached layer index without validators
+                (seconds)
+
+    :returns: `tuple` of signature and `list` of layer names (`None` if
+              the WMS Capabilities are unchanged)
+    """
+
+    import requests
+
+    if GEOMET_MAPPROXY_CACHE_WMS is None:
+        raise RuntimeError('GEOMET_MAPPROXY_CACHE_WMS not set')
+
+    headers = {}
+    if signature and signature[0] == GEOMET_MAPPROXY_CACHE_WMS:
+        fetched = signature[3] if len(signature) > 3 else 0
+        if not any(signature[1:3]) and time.time() - fetched < ttl:
+            LOGGER.debug('Layer index fetched {:.0f}s ago'.format(
+                time.time() - fetched))
+            return signature, None
+        if signature[1]:
+            headers['If-None-Match'] = signature[1]
+        if signature[2]:
+            headers['If-Modified-Since'] = signature[2]
+
+    params = {
+        'service': 'WMS',
+        'version': '1.3.0',
+        'request': 'GetCapabilities'
+    }
+
+    LOGGER.debug('Requesting WMS Capabilities for layer index')
+    try:
+        r = requests.get(GEOMET_MAPPROXY_CACHE_WMS, params=params,
+                         headers=headers, stream=True, timeout=60)
+        r.raise_for_status()
+    except requests.RequestException as err:
+        raise RuntimeError('Cannot fetch WMS Capabilities: {}'.format(err))
+
+    if r.status_code == 304:
+        return signature, None
+
+    r.raw.decode_content = True
+    layer_names = layer_names_from_xml(r.raw)
+    signature = [GEOMET_MAPPROXY_CACHE_WMS, r.headers.get('ETag'),
+                 r.headers.get('Last-Modified'), time.time()]
+
+    return signature, layer_names
@@ -0,0 +1,784 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from bisect import bisect_left
+import fcntl
+import glob
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from geomet_mapproxy.middleware import ClosingIterator, get_request_params
+from geomet_mapproxy.util import (get_dimensions_index_filepath,
+                                  read_dimensions_index)
+
+LOGGER = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+CRS_TO_GRIDS = {
+    'EPSG:4326': 'GLOBAL_GEODETIC',
+    'CRS:84': 'GLOBAL_GEODETIC',
+    'EPSG:3857': 'GLOBAL_WEBMERCATOR',
+    'EPSG:900913': 'GLOBAL_WEBMERCATOR',
+    'EPSG:3978': 'CANADA_ATLAS_LAMBERT'
+}
+
+# WMS request types recorded as label values
+REQUESTS = [
+    'getcapabilities',
+    'getmap',
+    'getfeatureinfo',
+    'getlegendgraphic',
+    'describelayer'
+]
+
+# label value of client supplied values which are not configured (unknown
+# layers, request types and grids), bounding the number of series
+OTHER = 'other'
+
+# client addresses allowed to read /metrics by default
+METRICS_ALLOW = ['127.0.0.0/8', '::1']
+
+METRICS = {
+    'geomet_mapproxy_request_duration_seconds': (
+        'histogram', 'Request latency by request type and layer'),
+    'geomet_mapproxy_cache_requests_total': (
+        'counter', 'GetMap requests by layer, grid and cache result'),
+    'geomet_mapproxy_upstream_request_duration_seconds': (
+        'histogram', 'Upstream WMS request duration by layer and grid'),
+    'geomet_mapproxy_upstream_requests_total': (
+        'counter', 'Upstream WMS requests by layer, grid and status'),
+    'geomet_mapproxy_config_reloads_total': (
+        'counter', 'MapProxy configuration reloads'),
+    'geomet_mapproxy_config_reload_duration_seconds': (
+        'histogram', 'MapProxy configuration reload duration')
+}
+
+# upstream requests made for the request served by the current thread,
+# inherited by the MapProxy worker threads it starts
+REQUEST_CONTEXT = threading.local()
+
+# serializes resets of registries inherited from a parent process
+FORK_LOCK = threading.Lock()
+
+
+def get_grid(crs):
+    """
+    Derive the grid of a CRS
+
+    :param crs: `str` of CRS identifier
+
+    :returns: `str` of grid name (`other` if not a configured grid)
+    """
+
+    return CRS_TO_GRIDS.get(crs.upper(), OTHER) if crs else ''
+
+
+def get_request_label(request):
+    """
+    Derive the label value of a request type
+
+    :param request: `str` of request type (lowercase)
+
+    :returns: `str` of request type (`other` if not a known request type)
+    """
+
+    return request if not request or request in REQUESTS else OTHER
+
+
+def is_process_running(pid):
+    """
+    Detect whether a process is running
+
+    :param pid: process id
+
+    :returns: `bool` of whether the process is running
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def lock_metrics(metrics_dir, operation=fcntl.LOCK_EX):
+    """
+    Lock the metrics directory, waiting for the lock, so that metrics of
+    exited processes are not read while being merged.  The lock is
+    released when the returned file is closed
+
+    :param metrics_dir: directory shared by worker processes
+    :param operation: `fcntl.LOCK_EX` (merge) or `fcntl.LOCK_SH` (read)
+
+    :returns: file object holding the lock
+    """
+
+    fh = open(os.path.join(metrics_dir, 'metrics.lock'), 'a')
+    try:
+        fcntl.flock(fh, operation)
+    except OSError:
+        fh.close()
+        raise
+
+    return fh
+
+
+def escape_label_value(value):
+    """
+    Escape a Prometheus label value
+
+    :param value: `str` of label value
+
+    :returns: `str` of escaped label value
+    """
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def dump_metrics(counters, histograms):
+    """
+    Dump metrics to a JSON serializable structure
+
+    :param counters: `dict` of counters
+    :param histograms: `dict` of histograms
+
+    :returns: `dict` of metrics
+    """
+
+    return {
+        'counters': [[k[0], k[1], v] for k, v in counters.items()],
+        'histograms': [[k[0], k[1], v] for k, v in histograms.items()]
+    }
+
+
+def merge_metrics(dumps):
+    """
+    Merge dumped metrics (e.g. of several processes)
+
+    :param dumps: `list` of `dict` of dumped metrics
+
+    :returns: `tuple` of `dict` of counters and `dict` of histograms
+    """
+
+    counters = {}
+    histograms = {}
+
+    for dump in dumps:
+        for name, labels, value in dump['counters']:
+            key = (name, tuple(tuple(x) for x in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in dump['histograms']:
+            key = (name, tuple(tuple(x) for x in labels))
+            if key not in histograms:
+                histograms[key] = [0] * len(values)
+            histograms[key] = [a + b for a, b in
+                               zip(histograms[key], values)]
+
+    return counters, histograms
+
+
+def get_request_upstream():
+    """
+    Get the upstream requests made for the request served by the current
+    thread
+
+    :returns: `list` of upstream request layers, or `None` outside of a
+              request
+    """
+
+    return getattr(REQUEST_CONTEXT, 'upstream', None)
+
+
+def propagate_request_context():
+    """
+    Make MapProxy worker threads (concurrent tile creation and source
+    requests) inherit the request context of the thread starting them, so
+    that their upstream requests are attributed to the request they were
+    made for
+
+    :returns: `None`
+    """
+
+    from mapproxy.util import async_
+
+    if getattr(async_.ThreadWorker, 'propagates_request_context', False):
+        return
+
+    class ThreadWorker(async_.ThreadWorker):
+        propagates_request_context = True
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.request_upstream = get_request_upstream()
+
+        def run(self):
+            REQUEST_CONTEXT.upstream = self.request_upstream
+            super().run()
+
+    async_.ThreadWorker = ThreadWorker
+
+
+def merge_process_metrics(metrics_dir, pid):
+    """
+    Merge the metrics of an exited process into the metrics archive of
+    exited processes, so that counters do not go backwards when workers
+    are replaced and process files do not accumulate.  Called by gunicorn
+    when a worker exits, and when collecting metrics for processes which
+    are no longer running (e.g. mod_wsgi daemon processes)
+
+    :param metrics_dir: directory shared by worker processes
+    :param pid: process id of exited process
+
+    :returns: `bool` of whether metrics were merged
+    """
+
+    filepath = os.path.join(metrics_dir, 'metrics-{}.json'.format(pid))
+    archive_filepath = os.path.join(metrics_dir, 'metrics-archive.json')
+
+    with lock_metrics(metrics_dir):
+        dumps = []
+        for filepath_ in [archive_filepath, filepath]:
+            try:
+                with open(filepath_) as fh:
+                    dumps.append(json.load(fh))
+            except FileNotFoundError:
+                if filepath_ == filepath:
+                    return False
+            except (OSError, ValueError) as err:
+                LOGGER.warning('Cannot read {}: {}'.format(filepath_, err))
+
+        tmp_filepath = '{}.tmp'.format(archive_filepath)
+        try:
+            with open(tmp_filepath, 'w') as fh:
+                json.dump(dump_metrics(*merge_metrics(dumps)), fh)
+            os.replace(tmp_filepath, archive_filepath)
+            os.remove(filepath)
+        except OSError as err:
+            LOGGER.warning('Cannot merge metrics: {}'.format(err))
+            return False
+
+    return True
+
+
+class MetricsRegistry:
+    """
+    Process-local metrics, periodically flushed to a file per process in a
+    shared directory so that metrics can be aggregated across workers
+    """
+
+    def __init__(self, metrics_dir=None, flush_interval=5):
+        """
+        Initialize registry
+
+        :param metrics_dir: directory shared by worker processes (optional)
+        :param flush_interval: minimum interval between flushes (seconds)
+
+        :returns: `geomet_mapproxy.metrics.MetricsRegistry`
+        """
+
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = os.getpid()
+
+        if metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+    def check_fork(self):
+        """
+        Resets metrics inherited from a parent process (e.g. a preloading
+        server master process), which remain accounted for by the parent
+
+        :returns: `None`
+        """
+
+        if self._pid != os.getpid():
+            with FORK_LOCK:
+                if self._pid != os.getpid():
+                    self._counters = {}
+                    self._histograms = {}
+                    self._lock = threading.Lock()
+                    self._flush_lock = threading.Lock()
+                    # published last: other threads wait until reset
+                    self._pid = os.getpid()
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increment a counter
+
+        :param name: metric name
+        :param labels: `tuple` of label name/value tuples
+        :param value: increment
+
+        :returns: `None`
+        """
+
+        self.check_fork()
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels=(), value=0):
+        """
+        Observe a value in a histogram
+
+        :param name: metric name
+        :param labels: `tuple` of label name/value tuples
+        :param value: observed value
+
+        :returns: `None`
+        """
+
+        key = (name, labels)
+        i = bisect_left(LATENCY_BUCKETS, value)
+        self.check_fork()
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # bucket counts (non-cumulative, last is +Inf), sum, count
+                histogram = [0] * (len(LATENCY_BUCKETS) + 1) + [0, 0]
+                self._histograms[key] = histogram
+            histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def dump(self):
+        """
+        Dump process metrics
+
+        :returns: `dict` of process metrics
+        """
+
+        self.check_fork()
+        with self._lock:
+            return dump_metrics(self._counters, self._histograms)
+
+    def flush(self, force=False):
+        """
+        Write process metrics to the shared directory (at most once per
+        flush interval unless forced)
+
+        :param force: whether to flush regardless of the flush interval
+
+        :returns: `None`
+        """
+
+        if self.metrics_dir is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+
+        # one flush at a time: other threads skip unless forced
+        if not self._flush_lock.acquire(blocking=force):
+            return
+
+        try:
+            self._last_flush = now
+            filepath = os.path.join(self.metrics_dir,
+                                    'metrics-{}.json'.format(os.getpid()))
+            tmp_filepath = '{}.tmp'.format(filepath)
+
+            with open(tmp_filepath, 'w') as fh:
+                json.dump(self.dump(), fh)
+            os.replace(tmp_filepath, filepath)
+        except OSError as err:
+            LOGGER.warning('Cannot write metrics: {}'.format(err))
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """
+        Aggregate metrics of all worker processes, merging the metrics of
+        processes which are no longer running into the archive
+
+        :returns: `tuple` of `dict` of counters and `dict` of histograms
+        """
+
+        dumps = []
+        if self.metrics_dir is None:
+            dumps.append(self.dump())
+            return merge_metrics(dumps)
+
+        self.flush(force=True)
+
+        pattern = os.path.join(self.metrics_dir, 'metrics-*.json')
+        for filepath in glob.glob(pattern):
+            pid = os.path.basename(filepath)[8:-5]
+            if (pid.isdigit() and int(pid) != os.getpid() and
+                    not is_process_running(int(pid))):
+                LOGGER.debug('Merging metrics of process {}'.format(pid))
+                merge_process_metrics(self.metrics_dir, pid)
+
+        with lock_metrics(self.metrics_dir, fcntl.LOCK_SH):
+            for filepath in glob.glob(pattern):
+                try:
+                    with open(filepath) as fh:
+                        dumps.append(json.load(fh))
+                except (OSError, ValueError) as err:
+                    LOGGER.debug('Cannot read {}: {}'.format(filepath, err))
+
+        return merge_metrics(dumps)
+
+    def render(self):
+        """
+        Render aggregated metrics in Prometheus text format
+
+        :returns: `str` of Prometheus text exposition
+        """
+
+        counters, histograms = self.collect()
+        lines = []
+
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{{{}}}'.format(','.join(
+                '{}="{}"'.format(k, escape_label_value(v))
+                for k, v in labels))
+
+        for name, (type_, help_) in METRICS.items():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+
+            if type_ == 'counter':
+                for key in sorted(k for k in counters if k[0] == name):
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(key[1]), counters[key]))
+                continue
+
+            for key in sorted(k for k in histograms if k[0] == name):
+                values = histograms[key]
+                cumulative = 0
+                for le, count in zip(LATENCY_BUCKETS + ['+Inf'], values):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(key[1] + (('le', le),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, format_labels(key[1]), values[-2]))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(key[1]), values[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+class UpstreamLogHandler(logging.Handler):
+    """
+    Logging handler recording MapProxy upstream (source) requests, as
+    logged by MapProxy on the `mapproxy.source.request` logger, and
+    attributing them to the request they were made for
+    """
+
+    def __init__(self, registry, get_layer_label):
+        """
+        Initialize handler
+
+        :param registry: `geomet_mapproxy.metrics.MetricsRegistry`
+        :param get_layer_label: callable deriving the label value of a
+                                layer name
+
+        :returns: `geomet_mapproxy.metrics.UpstreamLogHandler`
+        """
+
+        super().__init__(logging.INFO)
+        self.registry = registry
+        self.get_layer_label = get_layer_label
+
+    def emit(self, record):
+        try:
+            method, url, status, size, duration = record.args
+            params = {k.lower(): v for k, v in parse_qsl(urlsplit(url).query)}
+            layer = params.get('layers', '')
+            labels = (('layer', self.get_layer_label(layer)),
+                      ('grid', get_grid(params.get('crs') or
+                                        params.get('srs'))))
+
+            upstream = get_request_upstream()
+            if upstream is not None:
+                upstream.append(layer)
+
+            self.registry.inc('geomet_mapproxy_upstream_requests_total',
+                              labels + (('status', str(status)),))
+            if duration != '-':
+                self.registry.observe(
+                    'geomet_mapproxy_upstream_request_duration_seconds',
+                    labels, int(duration) / 1000.0)
+        except Exception:
+            self.handleError(record)
+
+
+class Metrics:
+    """
+    WSGI middleware recording request latency, cache hits/misses per layer
+    and grid, upstream request durations and configuration reloads, exposed
+    in Prometheus text format on `/metrics`
+
+    Upstream requests and cache hits/misses are only recorded with
+    `upstream` enabled, as this hooks into MapProxy for the lifetime of the
+    process (the `mapproxy.source.request` logger is enabled at INFO level
+    and MapProxy worker threads inherit the request context).  A GetMap
+    request is then counted as a cache miss when upstream requests were
+    made for it, by the thread serving it or the MapProxy worker threads
+    it started (exact with any number of threads per worker).  The result
+    is also returned in an `X-Cache` (`HIT`/`MISS`) response header, so
+    that it can be recorded in access logs
+
+    Label values are bounded: layers missing from the dimensions index of
+    the MapProxy configuration, unknown request types and grids are
+    recorded as `other`.  `/metrics` is only served to allowed client
+    addresses (all addresses of `REMOTE_ADDR` and `X-Forwarded-For`), or
+    to clients presenting the bearer token
+    """
+
+    def __init__(self, app, reloader=None, metrics_dir=None,
+                 flush_interval=5, path='/metrics', config_filepath=None,
+                 allow=METRICS_ALLOW, token=None, upstream=False):
+        """
+        Initialize middleware
+
+        :param app: WSGI application
+        :param reloader: `mapproxy.wsgiapp.ReloaderApp` (optional)
+        :param metrics_dir: directory shared by worker processes to
+                            aggregate metrics (optional)
+        :param flush_interval: minimum interval between flushes (seconds)
+        :param path: path of metrics endpoint
+        :param config_filepath: filepath to MapProxy configuration, whose
+                                layers are recorded as label values
+                                (optional, all layers are recorded as
+                                `other` otherwise)
+        :param allow: `list` of client addresses or networks allowed to
+                      read metrics
+        :param token: `str` of bearer token allowing to read metrics
+                      (optional)
+        :param upstream: whether to record upstream requests and cache
+                         hits/misses (hooking into MapProxy)
+
+        :returns: `geomet_mapproxy.metrics.Metrics`
+        """
+
+        self.app = app
+        self.path = path
+        self.config_filepath = config_filepath
+        self.allow = [ipaddress.ip_network(x.strip(), strict=False)
+                      for x in allow if x.strip()]
+        self.token = token
+        self.registry = MetricsRegistry(metrics_dir, flush_interval)
+
+        # (stat, layer names) of the dimensions index, replaced as a whole
+        self._layers = (None, frozenset())
+        if config_filepath is not None:
+            self._index_filepath = get_dimensions_index_filepath(
+                config_filepath)
+
+        self.upstream = None
+        if upstream:
+            self.upstream = UpstreamLogHandler(self.registry,
+                                               self.get_layer_label)
+            logger = logging.getLogger('mapproxy.source.request')
+            for handler in list(logger.handlers):
+                if isinstance(handler, UpstreamLogHandler):
+                    logger.removeHandler(handler)
+            if not logger.isEnabledFor(logging.INFO):
+                # MapProxy only logs upstream requests at INFO
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+            logger.addHandler(self.upstream)
+            propagate_request_context()
+
+        if reloader is not None:
+            make_app_func = reloader.make_app_func
+
+            def timed_make_app_func():
+                start = time.perf_counter()
+                try:
+                    return make_app_func()
+                finally:
+                    self.registry.inc('geomet_mapproxy_config_reloads_total')
+                    self.registry.observe(
+                        'geomet_mapproxy_config_reload_duration_seconds',
+                        value=time.perf_counter() - start)
+                    self.registry.flush(force=True)
+
+            reloader.make_app_func = timed_make_app_func
+
+    def get_layer_label(self, layer):
+        """
+        Derive the label value of a layer, re-reading the dimensions index
+        when it changes on disk
+
+        :param layer: `str` of layer name
+
+        :returns: `str` of layer name (`other` if not a configured layer)
+        """
+
+        if not layer:
+            return ''
+
+        if self.config_filepath is None:
+            return OTHER
+
+        try:
+            st = os.stat(self._index_filepath)
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return OTHER
+
+        stat_, layers = self._layers
+        if stat != stat_:
+            index = read_dimensions_index(self.config_filepath)
+            layers = frozenset(index['layers'])
+            self._layers = (stat, layers)
+
+        return layer if layer in layers else OTHER
+
+    def is_allowed(self, environ):
+        """
+        Detect whether a client is allowed to read metrics
+
+        :param environ: WSGI environment
+
+        :returns: `bool` of whether the client is allowed
+        """
+
+        if self.token is not None:
+            authorization = environ.get('HTTP_AUTHORIZATION', '')
+            if hmac.compare_digest(authorization.encode('utf-8'),
+                                   'Bearer {}'.format(self.token).encode(
+                                       'utf-8')):
+                return True
+
+        # a proxied client must be allowed as well as the proxy
+        addresses = [environ.get('REMOTE_ADDR', '')]
+        forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+        if forwarded_for:
+            addresses.extend(forwarded_for.split(','))
+
+        for address in addresses:
+            try:
+                address = ipaddress.ip_address(address.strip())
+            except ValueError:
+                return False
+            if not any(address in network for network in self.allow):
+                return False
+
+        return True
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            if not self.is_allowed(environ):
+                body = b'Forbidden\n'
+                start_response('403 Forbidden', [
+                    ('Content-Type', 'text/plain; charset=utf-8'),
+                    ('Content-Length', str(len(body)))
+                ])
+                return [body]
+
+            body = self.registry.render().encode('utf-8')
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                ('Content-Length', str(len(body)))
+            ])
+            return [body]
+
+        return self.instrument(environ, start_response)
+
+    def instrument(self, environ, start_response):
+        """
+        Call the WSGI application, recording metrics once the response
+        has been closed
+
+        :param environ: WSGI environment
+        :param start_response: WSGI start_response callable
+
+        :returns: WSGI response iterable
+        """
+
+        params = get_request_params(environ)
+        request = params.get('request', '').lower()
+        layer = self.get_layer_label((params.get('layers') or
+                                      params.get('layer') or
+                                      '').split(',')[0])
+        cache = request == 'getmap' and self.upstream is not None
+        upstream = []
+
+        def start_response_(status, headers, exc_info=None):
+            if cache:
+                if upstream:
+                    headers = list(headers) + [('X-Cache', 'MISS')]
+                else:
+                    headers = list(headers) + [('X-Cache', 'HIT')]
+            return start_response(status, headers, exc_info)
+
+        def record():
+            REQUEST_CONTEXT.upstream = None
+
+            self.registry.observe(
+                'geomet_mapproxy_request_duration_seconds',
+                (('request', get_request_label(request)), ('layer', layer)),
+                time.perf_counter() - start)
+
+            if cache:
+                if upstream:
+                    result = 'miss'
+                else:
+                    result = 'hit'
+                grid = get_grid(params.get('crs') or params.get('srs'))
+                self.registry.inc(
+                    'geomet_mapproxy_cache_requests_total',
+                    (('layer', layer), ('grid', grid), ('result', result)))
+
+            self.registry.flush()
+
+        start = time.perf_counter()
+        REQUEST_CONTEXT.upstream = upstream
+        try:
+            app_iter = self.app(environ, start_response_)
+        except BaseException:
+            record()
+            raise
+
+        return ClosingIterator(app_iter, callback=record)
@@ -0,0 +1,1407 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import format_datetime, parsedate_to_datetime
+import gzip
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl
+from urllib.request import Request, urlopen
+from wsgiref.util import FileWrapper
+from xml.sax.saxutils import escape
+
+from geomet_mapproxy.shard import get_routing_map_filepath, read_routing_map
+from geomet_mapproxy.util import (get_config_generation_filepath,
+                                  get_dimensions_index_filepath,
+                                  get_temporal_extent, get_temporal_steps,
+                                  is_temporal_step, parse_datetime,
+                                  read_config_generation,
+                                  read_dimensions_index)
+
+LOGGER = logging.getLogger(__name__)
+
+URL_ENVIRON_KEYS = [
+    'wsgi.url_scheme',
+    'HTTP_HOST',
+    'SCRIPT_NAME',
+    'PATH_INFO',
+    'HTTP_X_SCRIPT_NAME',
+    'HTTP_X_FORWARDED_HOST',
+    'HTTP_X_FORWARDED_PROTO'
+]
+
+# request header marking requests routed from another node, which are
+# always served locally
+ROUTED_HEADER = 'X-GeoMet-MapProxy-Node'
+
+# client request headers forwarded to other nodes
+PROXY_REQUEST_HEADERS = [
+    'Accept',
+    'Accept-Encoding',
+    'Accept-Language',
+    'If-Modified-Since',
+    'If-None-Match',
+    'User-Agent'
+]
+
+HOP_BY_HOP_HEADERS = [
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade'
+]
+
+# request parameters Capabilities depend on (others, e.g. cache busters,
+# are ignored by MapProxy)
+CAPABILITIES_PARAMS = [
+    'service',
+    'version',
+    'wmtver',
+    'request',
+    'format',
+    'lang'
+]
+
+# maximum size of cached Capabilities (bytes, plain and gzip)
+CAPABILITIES_CACHE_SIZE = 64 * 1024 * 1024
+
+# request parameter names of MapProxy layer dimensions
+DIMENSION_PARAMS = {
+    'time': 'time',
+    'reference_time': 'dim_reference_time'
+}
+
+
+def get_request_params(environ):
+    """
+    Derive request parameters from a WSGI environment
+
+    :param environ: WSGI environment
+
+    :returns: `dict` of request parameters (lowercase keys)
+    """
+
+    params = {}
+    for key, value in parse_qsl(environ.get('QUERY_STRING', ''),
+                                keep_blank_values=True):
+        params[key.lower()] = value
+
+    return params
+
+
+def accepts_gzip(environ):
+    """
+    Detect whether a client accepts gzip encoded responses
+
+    :param environ: WSGI environment
+
+    :returns: `bool` of whether gzip is accepted
+    """
+
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, qvalue = coding.strip().partition(';')
+        if name.strip().lower() == 'gzip':
+            return qvalue.replace(' ', '').lower() not in ('q=0', 'q=0.0')
+
+    return False
+
+
+def etag_matches(environ, etag):
+    """
+    Detect whether a conditional request matches an ETag
+
+    :param environ: WSGI environment
+    :param etag: `str` of ETag (quoted)
+
+    :returns: `bool` of whether If-None-Match matches
+    """
+
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+
+    return False
+
+
+def add_vary(headers, value):
+    """
+    Add a value to the Vary header of a response
+
+    :param headers: `list` of response headers
+    :param value: `str` of header name to vary on
+
+    :returns: `list` of response headers
+    """
+
+    headers_ = []
+    varies = []
+
+    for k, v in headers:
+        if k.lower() == 'vary':
+            varies.extend(x.strip() for x in v.split(','))
+        else:
+            headers_.append((k, v))
+
+    if value.lower() not in [x.lower() for x in varies]:
+        varies.append(value)
+
+    headers_.append(('Vary', ', '.join(varies)))
+
+    return headers_
+
+
+def call_app(app, environ):
+    """
+    Invoke a WSGI application and collect its response
+
+    :param app: WSGI application
+    :param environ: WSGI environment
+
+    :returns: `tuple` of status, `list` of headers and `bytes` of body
+    """
+
+    response = {}
+    chunks = []
+
+    if 'wsgi.file_wrapper' not in environ:
+        # closes file responses (e.g. cached tiles) once collected
+        environ = dict(environ)
+        environ['wsgi.file_wrapper'] = FileWrapper
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+        return chunks.append
+
+    app_iter = app(environ, start_response)
+    try:
+        for chunk in app_iter:
+            chunks.append(chunk)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    return response['status'], response['headers'], b''.join(chunks)
+
+
+class ClosingIterator:
+    """
+    WSGI response iterable closing the response iterable it was derived from
+    """
+
+    def __init__(self, iterable, app_iter=None, callback=None):
+        """
+        Initialize iterable
+
+        :param iterable: iterable of response chunks
+        :param app_iter: WSGI response iterable to close (default is
+                         `iterable`)
+        :param callback: callable called once closed (optional)
+
+        :returns: `geomet_mapproxy.middleware.ClosingIterator`
+        """
+
+        self.iterable = iterable
+        self.app_iter = iterable if app_iter is None else app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.callback is not None:
+                self.callback()
+
+
+def open_app(app, environ):
+    """
+    Invoke a WSGI application, without consuming its response
+
+    :param app: WSGI application
+    :param environ: WSGI environment
+
+    :returns: `tuple` of status, `list` of headers and WSGI response
+              iterable (the one of the application when possible, e.g. to
+              preserve `wsgi.file_wrapper` responses)
+    """
+
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+        return chunks.append
+
+    app_iter = app(environ, start_response)
+
+    if 'status' in response and not chunks:
+        return response['status'], response['headers'], app_iter
+
+    # start_response may be called on first iteration (e.g. generators)
+    iterator = iter(app_iter)
+    try:
+        if 'status' not in response:
+            chunks.extend(itertools.islice(iterator, 1))
+        status, headers = response['status'], response['headers']
+    except BaseException:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        raise
+
+    return status, headers, ClosingIterator(
+        itertools.chain(chunks, iterator), app_iter)
+
+
+def close_app_iter(app_iter):
+    """
+    Close a WSGI response iterable without consuming it
+
+    :param app_iter: WSGI response iterable
+
+    :returns: `None`
+    """
+
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
+
+
+def get_capabilities_cache_key(environ, params):
+    """
+    Derive cache key of a GetCapabilities request
+
+    :param environ: WSGI environment
+    :param params: `dict` of request parameters
+
+    :returns: `tuple` of cache key
+    """
+
+    # online resource URLs in Capabilities depend on these
+    url_keys = tuple(environ.get(k, '') for k in URL_ENVIRON_KEYS)
+
+    values = []
+    for name in CAPABILITIES_PARAMS:
+        value = params.get(name)
+        if value is not None and name in ('service', 'request'):
+            value = value.lower()
+        values.append(value)
+
+    return (url_keys, tuple(values))
+
+
+class ResponseCache:
+    """
+    Least recently used cache of responses, bounded by the total size of
+    their bodies (plain, gzip and the parts they were merged from).  Not
+    thread safe
+    """
+
+    def __init__(self, max_size):
+        """
+        Initialize cache
+
+        :param max_size: maximum size of cached responses (bytes)
+
+        :returns: `geomet_mapproxy.middleware.ResponseCache`
+        """
+
+        self.max_size = max_size
+        self.size = 0
+
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get a cached response
+
+        :param key: `tuple` of cache key
+
+        :returns: `dict` of response entry (`None` if not cached)
+        """
+
+        item = self._entries.get(key)
+        if item is None:
+            return None
+
+        self._entries.move_to_end(key)
+
+        return item[0]
+
+    def put(self, key, entry):
+        """
+        Cache a response, evicting the least recently used ones beyond the
+        maximum size (responses larger than it are not cached)
+
+        :param key: `tuple` of cache key
+        :param entry: `dict` of response entry (`body`, `body_gzip` and
+                      optionally `parts` of other nodes)
+
+        :returns: `None`
+        """
+
+        self.pop(key)
+
+        size = len(entry['body']) + len(entry['body_gzip']) + sum(
+            len(part[1]) for part in entry.get('parts', {}).values())
+        if size > self.max_size:
+            LOGGER.warning('Response of {} bytes not cached ({})'.format(
+                size, key))
+            return
+
+        self._entries[key] = (entry, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def pop(self, key):
+        """
+        Remove a cached response
+
+        :param key: `tuple` of cache key
+
+        :returns: `None`
+        """
+
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+
+def send_cached_response(environ, start_response, entry):
+    """
+    Send a cached response, honouring If-None-Match and Accept-Encoding
+
+    :param environ: WSGI environment
+    :param start_response: WSGI start_response callable
+    :param entry: `dict` of cached response (`headers`, `etag`, `body`
+                  and `body_gzip`)
+
+    :returns: WSGI response iterable
+    """
+
+    headers = add_vary(entry['headers'], 'Accept-Encoding')
+    headers.append(('ETag', entry['etag']))
+
+    if etag_matches(environ, entry['etag']):
+        start_response('304 Not Modified', [
+            (k, v) for k, v in headers if k.lower() != 'content-type'
+        ])
+        return [b'']
+
+    if accepts_gzip(environ):
+        body = entry['body_gzip']
+        headers.append(('Content-Encoding', 'gzip'))
+    else:
+        body = entry['body']
+
+    headers.append(('Content-Length', str(len(body))))
+    start_response('200 OK', headers)
+
+    return [body]
+
+
+class CapabilitiesCache:
+    """
+    WSGI middleware caching rendered GetCapabilities responses
+
+    Responses are cached per service, version, request, format and
+    language (other request parameters are ignored), stored with a gzip
+    precompressed variant and invalidated when the generation of the
+    MapProxy configuration changes
+    """
+
+    def __init__(self, app, config_filepath,
+                 max_size=CAPABILITIES_CACHE_SIZE):
+        """
+        Initialize middleware
+
+        :param app: WSGI application
+        :param config_filepath: filepath to MapProxy configuration
+        :param max_size: maximum size of cached responses (bytes)
+
+        :returns: `geomet_mapproxy.middleware.CapabilitiesCache`
+        """
+
+        self.app = app
+        self.config_filepath = config_filepath
+
+        self._generation_filepath = get_config_generation_filepath(
+            config_filepath)
+        # (stat, generation) of the generation marker, replaced as a whole
+        self._generation = (None, None)
+        self._entries = ResponseCache(max_size)
+        self._lock = threading.Lock()
+
+    def get_generation(self):
+        """
+        Derive the current generation of the MapProxy configuration
+
+        The generation marker written by `config update` is preferred,
+        falling back to the modification time of the configuration
+
+        :returns: `str` of configuration generation
+        """
+
+        try:
+            st = os.stat(self._generation_filepath)
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            st = os.stat(self.config_filepath)
+            return 'mtime-{}'.format(st.st_mtime_ns)
+
+        stat_, generation = self._generation
+        if stat != stat_:
+            generation = read_config_generation(self.config_filepath)
+            self._generation = (stat, generation)
+
+        return generation
+
+    def get_cache_key(self, environ, params):
+        """
+        Derive cache key of a GetCapabilities request
+
+        :param environ: WSGI environment
+        :param params: `dict` of request parameters
+
+        :returns: `tuple` of cache key
+        """
+
+        return get_capabilities_cache_key(environ, params)
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') != 'GET':
+            return self.app(environ, start_response)
+
+        params = get_request_params(environ)
+        if params.get('request', '').lower() != 'getcapabilities':
+            return self.app(environ, start_response)
+
+        generation = self.get_generation()
+        key = self.get_cache_key(environ, params)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['generation'] != generation:
+                entry = None
+
+        if entry is None:
+            LOGGER.debug('Rendering Capabilities ({})'.format(key))
+            status, headers, body = call_app(self.app, environ)
+            if not status.startswith('200'):
+                start_response(status, headers)
+                return [body]
+
+            entry = {
+                'generation': generation,
+                'headers': [(k, v) for k, v in headers
+                            if k.lower() not in ('content-length', 'etag')],
+                'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()),
+                'body': body,
+                'body_gzip': gzip.compress(body, compresslevel=6)
+            }
+
+            with self._lock:
+                self._entries.put(key, entry)
+
+        return send_cached_response(environ, start_response, entry)
+
+
+class InfoCache:
+    """
+    WSGI middleware caching GetLegendGraphic and GetFeatureInfo responses
+    for a fixed time to live
+
+    Responses are keyed on all request parameters (layer, style, dimensions,
+    etc.).  Concurrent identical cache misses are coalesced so that only one
+    request is forwarded to the upstream WMS
+    """
+
+    def __init__(self, app, legend_ttl=300, featureinfo_ttl=0,
+                 max_entries=1024):
+        """
+        Initialize middleware
+
+        :param app: WSGI application
+        :param legend_ttl: time to live of GetLegendGraphic responses
+                           (seconds, 0 to disable)
+        :param featureinfo_ttl: time to live of GetFeatureInfo responses
+                                (seconds, 0 to disable)
+        :param max_entries: maximum number of cached responses
+
+        :returns: `geomet_mapproxy.middleware.InfoCache`
+        """
+
+        self.app = app
+        self.ttls = {
+            'getlegendgraphic': legend_ttl,
+            'getfeatureinfo': featureinfo_ttl
+        }
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key, ttl, environ):
+        """
+        Fetch a response from the cache, or from the WSGI application
+        (once per key across concurrent requests)
+
+        :param key: `tuple` of cache key
+        :param ttl: time to live (seconds)
+        :param environ: WSGI environment
+
+        :returns: `dict` of response entry
+        """
+
+        leader = False
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry
+
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = {'event': threading.Event(), 'entry': None}
+                self._inflight[key] = flight
+                leader = True
+
+        if not leader:
+            LOGGER.debug('Waiting on in-flight request ({})'.format(key))
+            flight['event'].wait()
+            if flight['entry'] is not None:
+                return flight['entry']
+            # the leading request failed: go upstream on our own
+            status, headers, body = call_app(self.app, environ)
+            return {'status': status, 'headers': headers, 'body': body,
+                    'expires': 0}
+
+        try:
+            status, headers, body = call_app(self.app, environ)
+            entry = {
+                'status': status,
+                'headers': [(k, v) for k, v in headers
+                            if k.lower() != 'content-length'],
+                'body': body,
+                'expires': 0
+            }
+
+            if status.startswith('200'):
+                entry['expires'] = time.monotonic() + ttl
+                with self._lock:
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+
+            flight['entry'] = entry
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight['event'].set()
+
+        return entry
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') != 'GET':
+            return self.app(environ, start_response)
+
+        params = get_request_params(environ)
+        request = params.get('request', '').lower()
+        ttl = self.ttls.get(request, 0)
+
+        if ttl <= 0:
+            return self.app(environ, start_response)
+
+        url_keys = tuple(environ.get(k, '') for k in URL_ENVIRON_KEYS)
+        key = (request, url_keys, tuple(sorted(params.items())))
+
+        entry = self.fetch(key, ttl, environ)
+
+        headers = list(entry['headers'])
+        headers.append(('Content-Length', str(len(entry['body']))))
+
+        max_age = int(entry['expires'] - time.monotonic())
+        if max_age > 0:
+            headers = [(k, v) for k, v in headers
+                       if k.lower() != 'cache-control']
+            headers.append(('Cache-Control', 'max-age={}'.format(max_age)))
+
+        start_response(entry['status'], headers)
+
+        return [entry['body']]
+
+
+class ConditionalTiles:
+    """
+    WSGI middleware adding HTTP conditional request and freshness support
+    to GetMap responses
+
+    Tiled requests (`TILED=true`) are passed through to MapProxy with their
+    conditional headers, MapProxy answering 304 from the tile cache metadata
+    (timestamp and size) of tiles served from the cache, and responses are
+    streamed.  Untiled responses are validated against their content (an
+    ETag of the rendered image), so that reprocessed maps are revalidated,
+    If-None-Match/If-Modified-Since being answered with a 304.  Cache-Control
+    is set from the cadence of the temporal dimensions held in the
+    dimensions index written by `config update`: frames resolved from a
+    default value, or requested for values which are not (yet) steps of the
+    dimension, are given a short max-age (their cadence, at most the one of
+    historical frames), explicitly requested historical frames are immutable
+    for a bounded max-age
+    """
+
+    def __init__(self, app, config_filepath, default_max_age=300,
+                 historical_max_age=86400):
+        """
+        Initialize middleware
+
+        :param app: WSGI application
+        :param config_filepath: filepath to MapProxy configuration
+        :param default_max_age: max-age of layers without a time cadence
+        :param historical_max_age: max-age of historical frames
+
+        :returns: `geomet_mapproxy.middleware.ConditionalTiles`
+        """
+
+        self.app = app
+        self.config_filepath = config_filepath
+        self.default_max_age = default_max_age
+        self.historical_max_age = historical_max_age
+
+        self._index_filepath = get_dimensions_index_filepath(config_filepath)
+        self._index_stat = None
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def get_layers(self):
+        """
+        Get layer dimension metadata, re-reading the dimensions index
+        when it changes on disk
+
+        :returns: `dict` of layer dimension metadata
+        """
+
+        try:
+            st = os.stat(self._index_filepath)
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return {}
+
+        if stat != self._index_stat:
+            with self._lock:
+                if stat != self._index_stat:
+                    layers = {}
+                    index = read_dimensions_index(self.config_filepath)
+                    for name, layer in index['layers'].items():
+                        layers[name] = self.describe_layer(layer)
+                    self._layers = layers
+                    self._index_stat = stat
+
+        return self._layers
+
+    def describe_layer(self, layer):
+        """
+        Summarize the dimensions of a layer from the dimensions index
+
+        :param layer: `dict` of layer entry of the dimensions index
+
+        :returns: `dict` of layer dimension metadata
+        """
+
+        dimensions = {}
+        for name, dimension in layer.get('dimensions', {}).items():
+            latest, cadence = get_temporal_extent(dimension.get('values'))
+            dimensions[name] = {
+                'latest': latest,
+                'cadence': cadence,
+                'steps': get_temporal_steps(dimension.get('values'))
+            }
+
+        return {
+            'dimensions': dimensions
+        }
+
+    def get_cache_control(self, params, layers):
+        """
+        Derive the freshness of a GetMap request
+
+        :param params: `dict` of request parameters
+        :param layers: `dict` of layer dimension metadata
+
+        :returns: `str` of Cache-Control, or `None` if not applicable
+        """
+
+        max_age = None
+        immutable = True
+
+        for name in params.get('layers', '').split(','):
+            layer = layers.get(name)
+            if layer is None:
+                return None
+
+            if not layer['dimensions']:
+                immutable = False
+
+            for dim_name, dimension in layer['dimensions'].items():
+                param = DIMENSION_PARAMS.get(dim_name, dim_name)
+                latest = dimension['latest']
+
+                historical = False
+                if param in params and latest is not None:
+                    requested = parse_datetime(params[param])
+                    # future, misaligned and out of range values resolve
+                    # to a nearest or blank frame which may still change
+                    historical = (requested is not None and
+                                  requested < latest and
+                                  is_temporal_step(dimension['steps'],
+                                                   requested))
+                elif param in params:
+                    historical = True
+
+                if not historical:
+                    immutable = False
+                    cadence = dimension['cadence']
+                    if cadence is not None:
+                        seconds = min(int(cadence.total_seconds()),
+                                      self.historical_max_age)
+                        if max_age is None or seconds < max_age:
+                            max_age = seconds
+
+        if immutable:
+            return 'public, max-age={}, immutable'.format(
+                self.historical_max_age)
+
+        if max_age is None:
+            max_age = self.default_max_age
+
+        return 'public, max-age={}'.format(max_age)
+
+    def get_validators(self, headers, body):
+        """
+        Derive validators of an untiled GetMap response, from its content
+
+        :param headers: `dict` of response headers (lowercase keys)
+        :param body: `bytes` of response body
+
+        :returns: `tuple` of ETag and Last-Modified `datetime.datetime`
+                  (`None` if not known)
+        """
+
+        return '"{}"'.format(hashlib.sha1(body).hexdigest()), None
+
+    def get_tile_validators(self, headers):
+        """
+        Derive validators of a tiled GetMap response, from the tile cache
+        metadata provided by MapProxy (only for tiles read from the cache)
+
+        :param headers: `dict` of response headers (lowercase keys)
+
+        :returns: `tuple` of ETag and Last-Modified `datetime.datetime`
+                  (`None` if not known)
+        """
+
+        etag = None
+        if headers.get('etag'):
+            etag = '"{}"'.format(headers['etag'].strip('"'))
+
+        last_modified = None
+        if 'last-modified' in headers:
+            try:
+                last_modified = parsedate_to_datetime(
+                    headers['last-modified'])
+            except (TypeError, ValueError):
+                pass
+
+        return etag, last_modified
+
+    def is_not_modified(self, environ, etag, last_modified):
+        """
+        Evaluate the conditional headers of a request against validators
+
+        :param environ: WSGI environment
+        :param etag: `str` of ETag (quoted, or `None`)
+        :param last_modified: `datetime.datetime` of Last-Modified (or
+                              `None`)
+
+        :returns: `bool` of whether the client copy is still valid
+        """
+
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            return etag is not None and etag_matches(environ, etag)
+
+        if 'HTTP_IF_MODIFIED_SINCE' in environ and last_modified is not None:
+            try:
+                since = parsedate_to_datetime(
+                    environ['HTTP_IF_MODIFIED_SINCE'])
+                return since >= last_modified.replace(microsecond=0)
+            except (TypeError, ValueError):
+                pass
+
+        return False
+
+    def get_headers(self, headers, cache_control, etag, last_modified):
+        """
+        Set freshness and validators of GetMap response headers
+
+        :param headers: `list` of response headers
+        :param cache_control: `str` of Cache-Control
+        :param etag: `str` of ETag (quoted, or `None`)
+        :param last_modified: `datetime.datetime` of Last-Modified (or
+                              `None`)
+
+        :returns: `list` of response headers
+        """
+
+        headers = [(k, v) for k, v in headers if k.lower() not in
+                   ('etag', 'last-modified', 'cache-control')]
+        headers.append(('Cache-Control', cache_control))
+        if etag is not None:
+            headers.append(('ETag', etag))
+        if last_modified is not None:
+            headers.append(('Last-Modified',
+                            format_datetime(last_modified, usegmt=True)))
+
+        return headers
+
+    def tiled(self, environ, start_response, cache_control):
+        """
+        Serve a tiled GetMap request, passing conditional headers through
+        to MapProxy (which answers 304 from the tile cache metadata) and
+        streaming the response
+
+        :param environ: WSGI environment
+        :param start_response: WSGI start_response callable
+        :param cache_control: `str` of Cache-Control
+
+        :returns: WSGI response iterable
+        """
+
+        environ_ = environ
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        if if_none_match and ',' not in if_none_match:
+            # MapProxy compares its (unquoted) ETag verbatim
+            environ_ = dict(environ)
+            environ_['HTTP_IF_NONE_MATCH'] = if_none_match.strip().replace(
+                'W/', '', 1).strip('"')
+
+        status, headers, app_iter = open_app(self.app, environ_)
+
+        headers_ = dict((k.lower(), v) for k, v in headers)
+        not_modified = status.startswith('304')
+        if not not_modified and (
+                not status.startswith('200') or
+                not headers_.get('content-type', '').startswith('image/')):
+            start_response(status, headers)
+            return app_iter
+
+        etag, last_modified = self.get_tile_validators(headers_)
+        headers = self.get_headers(headers, cache_control, etag,
+                                   last_modified)
+
+        if not not_modified and self.is_not_modified(environ, etag,
+                                                     last_modified):
+            close_app_iter(app_iter)
+            not_modified = True
+            app_iter = [b'']
+
+        if not_modified:
+            status = '304 Not Modified'
+            headers = [(k, v) for k, v in headers if k.lower() not in
+                       ('content-type', 'content-length')]
+
+        start_response(status, headers)
+
+        return app_iter
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        params = get_request_params(environ)
+        if params.get('request', '').lower() != 'getmap':
+            return self.app(environ, start_response)
+
+        cache_control = self.get_cache_control(params, self.get_layers())
+        if cache_control is None:
+            return self.app(environ, start_response)
+
+        if params.get('tiled', '').lower() == 'true':
+            return self.tiled(environ, start_response, cache_control)
+
+        # untiled responses are validated against their content, evaluated
+        # here
+        environ_ = {k: v for k, v in environ.items() if k not in
+                    ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')}
+        status, headers, body = call_app(self.app, environ_)
+
+        headers_ = dict((k.lower(), v) for k, v in headers)
+        if not status.startswith('200') or \
+                not headers_.get('content-type', '').startswith('image/'):
+            start_response(status, headers)
+            return [body]
+
+        etag, last_modified = self.get_validators(headers_, body)
+        headers = self.get_headers(
+            [(k, v) for k, v in headers if k.lower() != 'content-length'],
+            cache_control, etag, last_modified)
+
+        if self.is_not_modified(environ, etag, last_modified):
+            start_response('304 Not Modified', [
+                (k, v) for k, v in headers if k.lower() != 'content-type'
+            ])
+            return [b'']
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+
+        return [body]
+
+
+def service_exception(start_response, status, message, code=None):
+    """
+    Send a WMS service exception report
+
+    :param start_response: WSGI start_response callable
+    :param status: `str` of HTTP status
+    :param message: `str` of exception message
+    :param code: `str` of exception code (optional)
+
+    :returns: WSGI response iterable
+    """
+
+    code_ = ' code="{}"'.format(code) if code else ''
+    body = ('<?xml version="1.0"?>\n'
+            '<ServiceExceptionReport version="1.3.0" '
+            'xmlns="http://www.opengis.net/ogc">\n'
+            '<ServiceException{}>{}</ServiceException>\n'
+            '</ServiceExceptionReport>\n').format(
+                code_, escape(message)).encode('utf-8')
+
+    start_response(status, [
+        ('Content-Type', 'text/xml'),
+        ('Content-Length', str(len(body)))
+    ])
+
+    return [body]
+
+
+def merge_capabilities(body, parts):
+    """
+    Merge the layers of WMS Capabilities documents into another one
+
+    :param body: `bytes` of WMS Capabilities (1.1.1 or 1.3.0)
+    :param parts: `list` of `bytes` of WMS Capabilities whose layers
+                  are appended to the root layer of `body`
+
+    :returns: `bytes` of merged WMS Capabilities
+    """
+
+    from lxml import etree
+
+    parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+    root = etree.fromstring(body, parser)
+    target = root.find('{*}Capability/{*}Layer')
+    if target is None:
+        raise ValueError('No root layer in Capabilities')
+
+    for part in parts:
+        layer = etree.fromstring(part, parser).find('{*}Capability/{*}Layer')
+        if layer is not None:
+            target.extend(layer.findall('{*}Layer'))
+
+    return etree.tostring(root.getroottree(), xml_declaration=True,
+                          encoding='UTF-8')
+
+
+class LayerRouter:
+    """
+    WSGI middleware serving layers sharded to other nodes, as per the
+    routing map written by `config create --nodes`
+
+    Requests for layers of another node are proxied to that node, requests
+    for layers of several nodes are rejected and GetCapabilities lists
+    the layers of all nodes (revalidated against the other nodes, in
+    parallel, at most every `capabilities_ttl` seconds)
+    """
+
+    def __init__(self, app, config_filepath, node, node_url, timeout=30,
+                 capabilities_ttl=30, max_size=CAPABILITIES_CACHE_SIZE):
+        """
+        Initialize middleware
+
+        :param app: WSGI application
+        :param config_filepath: filepath to MapProxy configuration
+        :param node: `str` of local node name
+        :param node_url: `str` of node base URL template (e.g.
+                         `http://{node}:8000`)
+        :param timeout: timeout of requests to other nodes (seconds)
+        :param capabilities_ttl: time merged Capabilities are served
+                                 before revalidating them against the
+                                 other nodes (seconds)
+        :param max_size: maximum size of cached Capabilities (bytes)
+
+        :returns: `geomet_mapproxy.middleware.LayerRouter`
+        """
+
+        self.app = app
+        self.config_filepath = config_filepath
+        self.node = node
+        self.node_url = node_url
+        self.timeout = timeout
+        self.capabilities_ttl = capabilities_ttl
+
+        self._routing_map_filepath = get_routing_map_filepath(
+            config_filepath)
+        # (stat, routing map), replaced as a whole
+        self._routing_map = (None, {})
+        self._capabilities = ResponseCache(max_size)
+        self._lock = threading.Lock()
+
+    def get_routing_map(self):
+        """
+        Get the routing map, re-reading it when it changes on disk
+
+        :returns: `dict` of routing map (empty if not sharded)
+        """
+
+        try:
+            st = os.stat(self._routing_map_filepath)
+            stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return {}
+
+        stat_, routing_map = self._routing_map
+        if stat != stat_:
+            routing_map = read_routing_map(self.config_filepath) or {}
+            self._routing_map = (stat, routing_map)
+
+        return routing_map
+
+    def get_layer_nodes(self, params):
+        """
+        Derive the nodes serving the layers of a request
+
+        :param params: `dict` of request parameters
+
+        :returns: `set` of node names (unknown layers are served locally)
+        """
+
+        routes = self.get_routing_map().get('layers', {})
+        nodes = set()
+
+        for key in ['layers', 'layer', 'query_layers']:
+            for layer in params.get(key, '').split(','):
+                if layer.strip():
+                    nodes.add(routes.get(layer.strip(), self.node))
+
+        return nodes
+
+    def get_proxy_headers(self, environ):
+        """
+        Derive the request headers of a request proxied to another node
+
+        Forwarded headers let MapProxy on the other node build online
+        resource URLs of the public (local) URL
+
+        :param environ: WSGI environment
+
+        :returns: `dict` of request headers
+        """
+
+        headers = {ROUTED_HEADER: self.node}
+
+        for name in PROXY_REQUEST_HEADERS:
+            value = environ.get('HTTP_{}'.format(
+                name.upper().replace('-', '_')))
+            if value:
+                headers[name] = value
+
+        host = environ.get('HTTP_X_FORWARDED_HOST') or environ.get(
+            'HTTP_HOST')
+        if not host:
+            host = '{}:{}'.format(environ.get('SERVER_NAME', 'localhost'),
+                                  environ.get('SERVER_PORT', '80'))
+        headers['X-Forwarded-Host'] = host
+        headers['X-Forwarded-Proto'] = (
+            environ.get('HTTP_X_FORWARDED_PROTO') or
+            environ.get('wsgi.url_scheme', 'http'))
+
+        script_name = (environ.get('HTTP_X_SCRIPT_NAME') or
+                       environ.get('SCRIPT_NAME'))
+        if script_name:
+            headers['X-Script-Name'] = script_name
+
+        forwarded_for = [environ.get('HTTP_X_FORWARDED_FOR'),
+                         environ.get('REMOTE_ADDR')]
+        if any(forwarded_for):
+            headers['X-Forwarded-For'] = ', '.join(
+                x for x in forwarded_for if x)
+
+        return headers
+
+    def open_node(self, node, environ, headers):
+        """
+        Send a request to another node
+
+        :param node: `str` of node name
+        :param environ: WSGI environment
+        :param headers: `dict` of request headers
+
+        :returns: HTTP response (`http.client.HTTPResponse` or
+                  `urllib.error.HTTPError`)
+        """
+
+        url = '{}{}'.format(self.node_url.format(node=node).rstrip('/'),
+                            environ.get('PATH_INFO', ''))
+        if environ.get('QUERY_STRING'):
+            url = '{}?{}'.format(url, environ['QUERY_STRING'])
+
+        try:
+            return urlopen(Request(url, headers=headers),
+                           timeout=self.timeout)
+        except HTTPError as err:
+            # error responses (and 304) are forwarded as is
+            return err
+
+    def proxy(self, node, environ, start_response):
+        """
+        Proxy a request to another node
+
+        :param node: `str` of node name
+        :param environ: WSGI environment
+        :param start_response: WSGI start_response callable
+
+        :returns: WSGI response iterable
+        """
+
+        LOGGER.debug('Proxying to node {}'.format(node))
+
+        try:
+            response = self.open_node(node, environ,
+                                      self.get_proxy_headers(environ))
+        except OSError as err:
+            LOGGER.warning('Node {} unavailable: {}'.format(node, err))
+            return service_exception(start_response, '502 Bad Gateway',
+                                     'Layer service unavailable')
+
+        status = '{} {}'.format(response.getcode(), response.reason)
+        headers = [(k, v) for k, v in response.headers.items()
+                   if k.lower() not in HOP_BY_HOP_HEADERS]
+
+        start_response(status, headers)
+
+        def body():
+            try:
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                response.close()
+
+        return body()
+
+    def fetch_capabilities(self, node, environ, part=None):
+        """
+        Fetch the Capabilities of another node
+
+        :param node: `str` of node name
+        :param environ: WSGI environment
+        :param part: `tuple` of ETag and `bytes` of the last Capabilities
+                     fetched from the node, to revalidate (optional)
+
+        :returns: `tuple` of ETag and `bytes` of Capabilities
+        """
+
+        headers = self.get_proxy_headers(environ)
+        for name in ['Accept-Encoding', 'If-Modified-Since', 'If-None-Match']:
+            headers.pop(name, None)
+        if part is not None:
+            headers['If-None-Match'] = part[0]
+
+        with self.open_node(node, environ, headers) as response:
+            code = response.getcode()
+            if code == 304 and part is not None:
+                return part
+            if code != 200:
+                raise OSError('HTTP {}'.format(code))
+            body = response.read()
+
+        etag = response.headers.get('ETag') or '"{}"'.format(
+            hashlib.sha1(body).hexdigest())
+
+        return etag, body
+
+    def capabilities(self, environ, start_response, params):
+        """
+        Serve Capabilities listing the layers of all nodes
+
+        :param environ: WSGI environment
+        :param start_response: WSGI start_response callable
+        :param params: `dict` of request parameters
+
+        :returns: WSGI response iterable
+        """
+
+        environ_ = dict(environ)
+        for key in ['HTTP_ACCEPT_ENCODING', 'HTTP_IF_MODIFIED_SINCE',
+                    'HTTP_IF_NONE_MATCH']:
+            environ_.pop(key, None)
+
+        status, headers, body = call_app(self.app, environ_)
+        if not status.startswith('200'):
+            start_response(status, headers)
+            return [body]
+
+        local_etag = dict((k.lower(), v) for k, v in headers).get(
+            'etag') or '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        key = get_capabilities_cache_key(environ, params)
+        with self._lock:
+            entry = self._capabilities.get(key)
+
+        if entry is not None and entry['version'][0] == local_etag and \
+                time.monotonic() < entry['checked'] + self.capabilities_ttl:
+            return send_cached_response(environ, start_response, entry)
+
+        nodes = [node for node in self.get_routing_map().get('nodes', [])
+                 if node != self.node]
+        previous = {} if entry is None else entry['parts']
+
+        parts = {}
+        with ThreadPoolExecutor(max_workers=max(len(nodes), 1)) as executor:
+            futures = dict((node, executor.submit(
+                self.fetch_capabilities, node, environ, previous.get(node)))
+                for node in nodes)
+
+        for node, future in futures.items():
+            try:
+                parts[node] = future.result()
+            except OSError as err:
+                LOGGER.warning('Node {} unavailable: {}'.format(node, err))
+                if node not in previous:
+                    return service_exception(
+                        start_response, '502 Bad Gateway',
+                        'Capabilities of node {} unavailable'.format(node))
+                parts[node] = previous[node]
+
+        version = (local_etag,) + tuple(
+            parts[node][0] for node in sorted(parts))
+
+        if entry is None or entry['version'] != version:
+            LOGGER.debug('Merging Capabilities of nodes {}'.format(
+                sorted(parts)))
+            try:
+                body = merge_capabilities(
+                    body, [parts[node][1] for node in sorted(parts)])
+            except (SyntaxError, ValueError) as err:
+                LOGGER.warning('Cannot merge Capabilities: {}'.format(err))
+                return service_exception(start_response, '502 Bad Gateway',
+                                         'Capabilities unavailable')
+
+            entry = {
+                'version': version,
+                'checked': time.monotonic(),
+                'parts': parts,
+                'headers': [(k, v) for k, v in headers
+                            if k.lower() not in ('content-encoding',
+                                                 'content-length', 'etag',
+                                                 'vary')],
+                'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()),
+                'body': body,
+                'body_gzip': gzip.compress(body, compresslevel=6)
+            }
+
+            with self._lock:
+                self._capabilities.put(key, entry)
+        else:
+            entry['checked'] = time.monotonic()
+
+        return send_cached_response(environ, start_response, entry)
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_{}'.format(
+                ROUTED_HEADER.upper().replace('-', '_'))):
+            return self.app(environ, start_response)
+
+        params = get_request_params(environ)
+
+        if params.get('request', '').lower() == 'getcapabilities':
+            if not self.get_routing_map().get('nodes'):
+                return self.app(environ, start_response)
+            return self.capabilities(environ, start_response, params)
+
+        nodes = self.get_layer_nodes(params)
+
+        if len(nodes) > 1:
+            return service_exception(
+                start_response, '400 Bad Request',
+                'Layers are served by different nodes ({}), request them '
+                'separately'.format(', '.join(sorted(nodes))),
+                'LayerNotDefined')
+
+        if nodes and self.node not in nodes:
+            return self.proxy(nodes.pop(), environ, start_response)
+
+        return self.app(environ, start_response)
@@ -0,0 +1,251 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from contextlib import contextmanager, nullcontext
+import cProfile
+import io
+import json
+import logging
+import pstats
+import resource
+import sys
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# structured (JSON) events: phase timings, layer fetches, memory and
+# profile summaries
+EVENT_LOGGER = logging.getLogger('{}.events'.format(__name__))
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the current process
+
+    :returns: `int` of peak resident set size (bytes)
+    """
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return maxrss
+
+    return maxrss * 1024
+
+
+def log_event(event, **kwargs):
+    """
+    Emits a structured (JSON) log line
+
+    :param event: event name
+    :param kwargs: event fields
+
+    :returns: `None`
+    """
+
+    EVENT_LOGGER.info(json.dumps(dict(event=event, **kwargs),
+                                 sort_keys=True))
+
+
+def enable_events(stream=None):
+    """
+    Emits structured events (at INFO level) regardless of the configured
+    log level, on a stream, unless logging already emits them
+
+    :param stream: stream to write events to (default: `sys.stderr`)
+
+    :returns: `bool` of whether a handler was added
+    """
+
+    if EVENT_LOGGER.isEnabledFor(logging.INFO):
+        return False
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    EVENT_LOGGER.addHandler(handler)
+    EVENT_LOGGER.setLevel(logging.INFO)
+    # not to handlers configured for a higher level
+    EVENT_LOGGER.propagate = False
+
+    return True
+
+
+class PhaseTimer:
+    """Records wall clock timings of the phases of a command"""
+
+    def __init__(self, command):
+        """
+        Initialize timer
+
+        :param command: command name
+
+        :returns: `geomet_mapproxy.profiling.PhaseTimer`
+        """
+
+        self.command = command
+        self.phases = {}
+        self.layers = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, layer=None):
+        """
+        Times a phase, optionally for a given layer
+
+        :param name: phase name
+        :param layer: layer name (optional)
+
+        :returns: `None`
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            total, count = self.phases.get(name, (0, 0))
+            self.phases[name] = (total + duration, count + 1)
+            if layer is not None:
+                layer_phases = self.layers.setdefault(name, {})
+                layer_phases[layer] = layer_phases.get(layer, 0) + duration
+
+    def summary(self, slowest=10):
+        """
+        Summarizes phase timings
+
+        :param slowest: number of slowest layers to report per phase
+
+        :returns: `dict` of total duration and per phase timings
+        """
+
+        phases = {}
+        for name, (total, count) in self.phases.items():
+            phases[name] = {
+                'duration': round(total, 6),
+                'count': count
+            }
+            if name in self.layers:
+                layers = sorted(self.layers[name].items(),
+                                key=lambda x: x[1], reverse=True)
+                phases[name]['slowest_layers'] = [
+                    [layer, round(duration, 6)]
+                    for layer, duration in layers[:slowest]
+                ]
+
+        return {
+            'command': self.command,
+            'duration': round(time.perf_counter() - self.start, 6),
+            'phases': phases
+        }
+
+    def log(self):
+        """
+        Emits phase timings as JSON log lines (one per phase, per layer
+        breakdowns at debug level)
+
+        :returns: `None`
+        """
+
+        summary = self.summary()
+        for name, values in summary['phases'].items():
+            log_event('phase', command=self.command, phase=name, **values)
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            for name, layers in self.layers.items():
+                for layer, duration in layers.items():
+                    LOGGER.debug(json.dumps({
+                        'event': 'layer_phase',
+                        'command': self.command,
+                        'phase': name,
+                        'layer': layer,
+                        'duration': round(duration, 6)
+                    }, sort_keys=True))
+
+        log_event('command', command=self.command,
+                  duration=summary['duration'])
+
+
+def phase(timer, name, layer=None):
+    """
+    Times a phase if a timer is given
+
+    :param timer: `geomet_mapproxy.profiling.PhaseTimer` (or `None`)
+    :param name: phase name
+    :param layer: layer name (optional)
+
+    :returns: context manager
+    """
+
+    if timer is None:
+        return nullcontext()
+
+    return timer.phase(name, layer)
+
+
+@contextmanager
+def profiler(filepath, command, limit=20):
+    """
+    Profiles a block of code with cProfile, writing statistics to a pstats
+    file and logging the slowest functions and a peak memory summary.
+    Structured events (e.g. phase timings) are emitted whatever the log
+    level when profiling
+
+    :param filepath: filepath of pstats dump (no profiling if `None`)
+    :param command: command name
+    :param limit: number of functions to report
+
+    :returns: `dict` of peak memory summary (populated on exit)
+    """
+
+    memory = {}
+
+    if filepath is None:
+        yield memory
+        return
+
+    enable_events()
+
+    baseline_rss = get_peak_rss()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield memory
+    finally:
+        profile.disable()
+        profile.dump_stats(filepath)
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        EVENT_LOGGER.info('Profile of {} ({}):\n{}'.format(
+            command, filepath, stream.getvalue()))
+
+        memory['peak_rss'] = get_peak_rss()
+        memory['peak_rss_growth'] = memory['peak_rss'] - baseline_rss
+        log_event('memory', command=command, profile=filepath, **memory)
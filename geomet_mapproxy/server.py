@@ -0,0 +1,242 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import logging
+import os
+import signal
+import threading
+import time
+import weakref
+
+from mapproxy.config.loader import (ConfigurationError, ProxyConfiguration,
+                                    load_configuration_file, load_plugins)
+from mapproxy.config.spec import validate_options
+from mapproxy.config.validator import validate
+from mapproxy.util.yaml import YAMLError
+from mapproxy.wsgiapp import MapProxyApp
+import yaml
+
+from geomet_mapproxy.util import read_config_generation, yaml_load_snapshot
+
+LOGGER = logging.getLogger(__name__)
+
+# applications of the current process, reloaded by reload_applications
+RELOADERS = weakref.WeakSet()
+
+
+def load_mapproxy_config(config_filepath, snapshot_dir=None):
+    """
+    Loads a MapProxy configuration, from its compiled snapshot (written by
+    `geomet-mapproxy config`) when given a snapshot directory, skipping
+    YAML parsing of unchanged configurations on worker startup and reloads
+
+    Configurations referencing environment variables or base
+    configurations are loaded by MapProxy, which expands and merges them
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param snapshot_dir: directory of snapshots (optional)
+
+    :returns: `dict` of MapProxy configuration, with the modification
+              times of its files (`__config_files__`) as loaded by MapProxy
+    """
+
+    config_filepath = os.path.abspath(config_filepath)
+    # before reading, so that concurrent changes trigger a reload
+    mtime = os.path.getmtime(config_filepath)
+
+    with open(config_filepath, 'rb') as fh:
+        content = fh.read()
+
+    if snapshot_dir is None or b'$' in content:
+        return load_configuration_file([os.path.basename(config_filepath)],
+                                       os.path.dirname(config_filepath))
+
+    try:
+        data = yaml_load_snapshot(config_filepath, snapshot_dir, content)
+    except yaml.YAMLError as err:
+        raise YAMLError(str(err))
+
+    if type(data) is not dict:
+        raise YAMLError('configuration not a YAML dictionary')
+
+    if 'base' in data:
+        return load_configuration_file([os.path.basename(config_filepath)],
+                                       os.path.dirname(config_filepath))
+
+    data['__config_files__'] = {config_filepath: mtime}
+
+    return data
+
+
+def make_mapproxy_app(config_filepath, snapshot_dir=None,
+                      ignore_warnings=True):
+    """
+    Builds a MapProxy application, validating its configuration as
+    `mapproxy.wsgiapp.make_wsgi_app` does
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param snapshot_dir: directory of configuration snapshots (optional)
+    :param ignore_warnings: whether to ignore configuration warnings
+
+    :returns: `mapproxy.wsgiapp.MapProxyApp`
+    """
+
+    load_plugins()
+
+    try:
+        conf_dict = load_mapproxy_config(config_filepath, snapshot_dir)
+    except YAMLError as err:
+        LOGGER.critical(err)
+        raise ConfigurationError(err)
+
+    errors, informal_only = validate_options(conf_dict)
+    for error in errors:
+        LOGGER.warning(error)
+    if not informal_only or (errors and not ignore_warnings):
+        LOGGER.critical('invalid configuration')
+        raise ConfigurationError('invalid configuration')
+
+    for error in validate(conf_dict):
+        LOGGER.warning(error)
+
+    conf = ProxyConfiguration(conf_dict, conf_base_dir=os.path.abspath(
+        os.path.dirname(config_filepath)))
+
+    app = MapProxyApp(conf.configured_services(), conf.base_config)
+    app.config_files = conf.config_files()
+
+    return app
+
+
+class GracefulReloader:
+    """
+    MapProxy application built once (e.g. in a preloading server master
+    process, shared copy-on-write by forked workers) and rebuilt on demand
+    rather than checking configuration mtimes on each request
+
+    Reloads are serialized and replace the application in a single
+    assignment, so that requests served by other threads keep using the
+    application they started with
+    """
+
+    def __init__(self, config_filepath, make_app_func=None):
+        """
+        Initialize application
+
+        :param config_filepath: filepath to MapProxy configuration
+        :param make_app_func: callable building the MapProxy application
+                              (optional, `make_mapproxy_app` otherwise)
+
+        :returns: `geomet_mapproxy.server.GracefulReloader`
+        """
+
+        if make_app_func is None:
+            def make_app_func():
+                return make_mapproxy_app(config_filepath)
+
+        self.config_filepath = config_filepath
+        self.make_app_func = make_app_func
+        self.app = self.make_app_func()
+        self.generation = read_config_generation(config_filepath)
+        self.last_reload = time.time()
+        self._lock = threading.Lock()
+
+        RELOADERS.add(self)
+
+    def reload(self):
+        """
+        Rebuilds the MapProxy application, keeping the current application
+        if the configuration is invalid
+
+        :returns: `bool` of whether the application was rebuilt
+        """
+
+        with self._lock:
+            generation = read_config_generation(self.config_filepath)
+            start = time.perf_counter()
+
+            try:
+                app = self.make_app_func()
+            except ConfigurationError as err:
+                LOGGER.error('Cannot reload {}: {}'.format(
+                    self.config_filepath, err))
+                return False
+
+            self.app = app
+            self.generation = generation
+            self.last_reload = time.time()
+
+        LOGGER.info('Reloaded {} (generation {}) in {:.3f}s'.format(
+            self.config_filepath, generation, time.perf_counter() - start))
+
+        return True
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
+
+
+def reload_applications():
+    """
+    Rebuilds all applications of the current process
+
+    :returns: `int` of number of applications rebuilt
+    """
+
+    return sum(reloader.reload() for reloader in list(RELOADERS))
+
+
+def watch_applications(interval=1, signum=signal.SIGHUP):
+    """
+    Watches the generation markers (control files) of the configurations
+    of all applications of the current process, signalling the current
+    process when one changes (e.g. after `geomet-mapproxy config update`)
+
+    :param interval: polling interval (seconds)
+    :param signum: signal to send
+
+    :returns: `threading.Thread` of watcher
+    """
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            for reloader in list(RELOADERS):
+                generation = read_config_generation(reloader.config_filepath)
+                if generation is not None and \
+                        generation != reloader.generation:
+                    # avoid signalling again before the reload
+                    reloader.generation = generation
+                    os.kill(os.getpid(), signum)
+                    break
+
+    thread = threading.Thread(target=watch, name='geomet-mapproxy-watcher',
+                              daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,279 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from bisect import bisect
+import hashlib
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HashRing:
+    """Consistent hash ring of nodes"""
+
+    def __init__(self, nodes, replicas=128):
+        """
+        Initialize hash ring
+
+        :param nodes: `list` of node names
+        :param replicas: number of virtual nodes per node
+
+        :returns: `geomet_mapproxy.shard.HashRing`
+        """
+
+        if not nodes:
+            raise RuntimeError('At least one node is required')
+
+        self.nodes = list(nodes)
+        self.replicas = replicas
+
+        ring = []
+        for node in self.nodes:
+            for i in range(replicas):
+                ring.append((self.hash('{}#{}'.format(node, i)), node))
+
+        ring.sort()
+        self._keys = [x[0] for x in ring]
+        self._nodes = [x[1] for x in ring]
+
+    @staticmethod
+    def hash(value):
+        """
+        Hash a value onto the ring
+
+        :param value: `str` of value
+
+        :returns: `int` of hash
+        """
+
+        digest = hashlib.sha256(value.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def get_node(self, key):
+        """
+        Get the node owning a key
+
+        :param key: `str` of key (layer name)
+
+        :returns: `str` of node name
+        """
+
+        i = bisect(self._keys, self.hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+def get_node_names(nodes):
+    """
+    Derive node names from a number of nodes
+
+    :param nodes: `int` of number of nodes
+
+    :returns: `list` of node names
+    """
+
+    return ['node{}'.format(i) for i in range(1, nodes + 1)]
+
+
+def create_routing_map(layers, nodes):
+    """
+    Partition layers over nodes
+
+    :param layers: `list` of layer names
+    :param nodes: `list` of node names
+
+    :returns: `dict` of routing map
+    """
+
+    ring = HashRing(nodes)
+
+    return {
+        'nodes': list(nodes),
+        'layers': {layer: ring.get_node(layer) for layer in layers}
+    }
+
+
+def get_routing_map_filepath(config_filepath):
+    """
+    Derive the filepath of the routing map of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of routing map filepath
+    """
+
+    return '{}.routing.json'.format(config_filepath)
+
+
+def read_routing_map(config_filepath):
+    """
+    Reads the routing map of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `dict` of routing map, or `None` if not sharded
+    """
+
+    try:
+        with open(get_routing_map_filepath(config_filepath)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def write_routing_map(config_filepath, routing_map):
+    """
+    Writes the routing map of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param routing_map: `dict` of routing map
+
+    :returns: `str` of routing map filepath
+    """
+
+    filepath = get_routing_map_filepath(config_filepath)
+    tmp_filepath = '{}.{}'.format(filepath, os.getpid())
+
+    with open(tmp_filepath, 'w') as fh:
+        json.dump(routing_map, fh, indent=4, sort_keys=True)
+
+    os.replace(tmp_filepath, filepath)
+
+    return filepath
+
+
+def get_node_config_filepath(config_filepath, node):
+    """
+    Derive the filepath of the MapProxy configuration of a node
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param node: `str` of node name
+
+    :returns: `str` of node configuration filepath
+    """
+
+    basename, extension = os.path.splitext(config_filepath)
+
+    return '{}.{}{}'.format(basename, node, extension)
+
+
+def get_node_mapproxy_config(mapproxy_config, routing_map, node):
+    """
+    Derive the MapProxy configuration of a node, with only the layers
+    (and their caches and sources) routed to the node
+
+    :param mapproxy_config: `dict` of MapProxy configuration
+    :param routing_map: `dict` of routing map
+    :param node: `str` of node name
+
+    :returns: `dict` of node MapProxy configuration
+    """
+
+    layers = [layer for layer in mapproxy_config['layers']
+              if routing_map['layers'].get(layer['name']) == node]
+
+    caches = {}
+    sources = {}
+    for layer in layers:
+        for cache in layer['sources']:
+            caches[cache] = mapproxy_config['caches'][cache]
+            for source in caches[cache]['sources']:
+                sources[source] = mapproxy_config['sources'][source]
+
+    node_config = dict(mapproxy_config)
+    node_config['layers'] = layers
+    node_config['caches'] = caches
+    node_config['sources'] = sources
+
+    return node_config
+
+
+def count_layer_tiles(cache_dir, layers):
+    """
+    Count cached tiles of layers on disk
+
+    :param cache_dir: MapProxy cache base directory
+    :param layers: `list` of layer names
+
+    :returns: `dict` of layer tile counts
+    """
+
+    counts = {layer: 0 for layer in layers}
+    prefixes = {'{}_cache_'.format(layer): layer for layer in layers}
+
+    try:
+        entries = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return counts
+
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        for prefix, layer in prefixes.items():
+            if entry.name.startswith(prefix):
+                for _, _, files in os.walk(entry.path):
+                    counts[layer] += len(files)
+
+    return counts
+
+
+def get_rebalance_report(old_routing_map, new_routing_map, cache_dir):
+    """
+    Report layers (and their cached tiles) moving between nodes
+
+    :param old_routing_map: `dict` of previous routing map (or `None`)
+    :param new_routing_map: `dict` of new routing map
+    :param cache_dir: MapProxy cache base directory
+
+    :returns: `dict` of rebalance report
+    """
+
+    old_layers = (old_routing_map or {}).get('layers', {})
+    moves = {}
+
+    for layer, node in new_routing_map['layers'].items():
+        if layer in old_layers and old_layers[layer] != node:
+            moves[layer] = [old_layers[layer], node]
+
+    tiles = count_layer_tiles(cache_dir, list(moves.keys()))
+
+    return {
+        'nodes': {
+            'old': (old_routing_map or {}).get('nodes', []),
+            'new': new_routing_map['nodes']
+        },
+        'layers': len(new_routing_map['layers']),
+        'moved_layers': len(moves),
+        'moved_tiles': sum(tiles.values()),
+        'moves': {
+            layer: {'from': from_, 'to': to, 'tiles': tiles[layer]}
+            for layer, (from_, to) in moves.items()
+        }
+    }
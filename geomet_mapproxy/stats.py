@@ -0,0 +1,696 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+import gzip
+import json
+import logging
+import math
+import re
+from urllib.parse import unquote, unquote_plus
+
+import click
+
+from geomet_mapproxy.env import GEOMET_MAPPROXY_CONFIG
+from geomet_mapproxy.metrics import OTHER, get_grid, get_request_label
+from geomet_mapproxy.util import (get_temporal_extent, parse_datetime,
+                                  read_dimensions_index, yaml_dump)
+
+LOGGER = logging.getLogger(__name__)
+
+# tile grids of the MapProxy configuration (see geomet_mapproxy.config and
+# mapproxy.config.defaults): bbox, origin and level 0 resolution
+TILE_GRIDS = {
+    'GLOBAL_GEODETIC': {
+        'bbox': (-180, -90, 180, 90),
+        'origin': 'sw',
+        'resolution': 1.40625
+    },
+    'GLOBAL_WEBMERCATOR': {
+        'bbox': (-20037508.342789244, -20037508.342789244,
+                 20037508.342789244, 20037508.342789244),
+        'origin': 'nw',
+        'resolution': 156543.03392804097
+    },
+    'CANADA_ATLAS_LAMBERT': {
+        'bbox': (-7192737.96, -3004297.73, 5183275.29, 4484204.83),
+        'origin': 'sw',
+        'resolution': 48343.8017578125
+    }
+}
+TILE_SIZE = 256
+NUM_LEVELS = 20
+
+# Apache/gunicorn combined log format, optionally followed by more fields
+# (e.g. "%({x-cache}o)s")
+ACCESS_LOG_LINE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<url>\S+)'
+    r'[^"]*" (?P<status>\d{3}) \S+(?P<extra>.*)$'
+)
+CACHE_STATUS = re.compile(r'"(HIT|MISS)"', re.IGNORECASE)
+MONTHS = {month: i for i, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec'], 1)}
+
+# request parameters used in aggregations
+QUERY_PARAMS = ('request', 'layers', 'crs', 'srs', 'bbox', 'width', 'time')
+
+# bounds of the keys aggregated from client supplied values, beyond which
+# values are counted as `other`: distinct layers (without a dimensions
+# index) and distinct TIME offsets per layer
+MAX_LAYERS = 10000
+MAX_TIME_OFFSETS = 100
+
+
+def open_log(filepath):
+    """
+    Open a (gzip compressed) log file for streaming
+
+    :param filepath: filepath to log file (`-` for stdin)
+
+    :returns: text file object
+    """
+
+    if filepath == '-':
+        return click.open_file('-', errors='replace')
+
+    with open(filepath, 'rb') as fh:
+        magic = fh.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(filepath, 'rt', errors='replace')
+
+    return open(filepath, errors='replace')
+
+
+@lru_cache(maxsize=65536)
+def unquote_value(value):
+    """
+    Decode a query string value (cached, as tile requests repeat)
+
+    :param value: `str` of encoded value
+
+    :returns: `str` of decoded value
+    """
+
+    return unquote_plus(value)
+
+
+def parse_log_time(value):
+    """
+    Parse an access log timestamp (faster than `datetime.strptime`)
+
+    :param value: `str` of access log timestamp (10/Oct/2026:13:55:36 -0700)
+
+    :returns: `float` of POSIX timestamp or `None` if not parseable
+    """
+
+    try:
+        day, month, rest = value.split('/', 2)
+        year, hour, minute, rest = rest.split(':', 3)
+        second, tz = rest.split(' ', 1)
+        dt = datetime(int(year), MONTHS[month], int(day), int(hour),
+                      int(minute), int(second), tzinfo=timezone.utc)
+        offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+    except (KeyError, ValueError):
+        return None
+
+    if tz.startswith('-'):
+        offset = -offset
+
+    return dt.timestamp() - offset
+
+
+def parse_query(query, keys=QUERY_PARAMS):
+    """
+    Parse selected parameters of a query string (faster than
+    `urllib.parse.parse_qsl` for long logs)
+
+    :param query: `str` of query string
+    :param keys: `tuple` of (lowercase) parameter names to keep
+
+    :returns: `dict` of (lowercase) parameter names and values
+    """
+
+    params = {}
+
+    for pair in query.split('&'):
+        key, _, value = pair.partition('=')
+        key = key.lower()
+        if key in keys:
+            if '%' in value or '+' in value:
+                value = unquote_value(value)
+            params[key] = value
+
+    return params
+
+
+def parse_access_log_line(line):
+    """
+    Parse an access log line (combined log format)
+
+    :param line: `str` of log line
+
+    :returns: `dict` of time, query parameters, HTTP status and cache
+              status (`hit`, `miss` or `unknown`), or `None` if not
+              parseable
+    """
+
+    match = ACCESS_LOG_LINE.match(line)
+    if match is None:
+        return None
+
+    cache_status = CACHE_STATUS.search(match.group('extra'))
+
+    return {
+        'time': match.group('time'),
+        'params': parse_query(match.group('url').partition('?')[2]),
+        'status': int(match.group('status')),
+        'cache': cache_status.group(1).lower() if cache_status else 'unknown'
+    }
+
+
+def get_tile(params):
+    """
+    Derive the grid, zoom level and tile of a GetMap request
+
+    :param params: `dict` of (lowercase) request parameters
+
+    :returns: `tuple` of grid name, zoom level and tile column and row
+              (zoom level and tile are `None` if not in a known grid)
+    """
+
+    crs = params.get('crs') or params.get('srs') or ''
+    grid = get_grid(crs)
+
+    if grid not in TILE_GRIDS:
+        return grid, None, None, None
+
+    try:
+        bbox = [float(v) for v in params['bbox'].split(',')[:4]]
+        width = int(params['width'])
+    except (KeyError, ValueError):
+        return grid, None, None, None
+
+    if 'crs' in params and crs.upper() == 'EPSG:4326':
+        # WMS 1.3.0 axis order (lat/lon)
+        bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+    if width <= 0 or bbox[2] <= bbox[0]:
+        return grid, None, None, None
+
+    tile_grid = TILE_GRIDS[grid]
+    resolution = (bbox[2] - bbox[0]) / width
+    zoom = round(math.log2(tile_grid['resolution'] / resolution))
+    zoom = min(max(zoom, 0), NUM_LEVELS - 1)
+
+    # tile containing the center of the request
+    span = tile_grid['resolution'] / 2 ** zoom * TILE_SIZE
+    x = math.floor(((bbox[0] + bbox[2]) / 2 - tile_grid['bbox'][0]) / span)
+    if tile_grid['origin'] == 'nw':
+        y = math.floor(
+            (tile_grid['bbox'][3] - (bbox[1] + bbox[3]) / 2) / span)
+    else:
+        y = math.floor(
+            ((bbox[1] + bbox[3]) / 2 - tile_grid['bbox'][1]) / span)
+
+    return grid, zoom, x, y
+
+
+def format_offset(seconds):
+    """
+    Format a time offset as an ISO8601 duration
+
+    :param seconds: offset (seconds)
+
+    :returns: `str` of ISO8601 duration, negative offsets prefixed with `-`
+    """
+
+    sign = '-' if seconds < 0 else ''
+    minutes, seconds = divmod(abs(int(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+
+    duration = 'P{}'.format('{}D'.format(days) if days else '')
+    if hours or minutes or seconds or not days:
+        duration += 'T'
+        if hours:
+            duration += '{}H'.format(hours)
+        if minutes:
+            duration += '{}M'.format(minutes)
+        if seconds or not (hours or minutes):
+            duration += '{}S'.format(seconds)
+
+    return sign + duration
+
+
+def get_zoom_range(zooms, coverage=0.95):
+    """
+    Derive the narrowest range of zoom levels covering a share of requests
+
+    :param zooms: `dict` of zoom levels and request counts
+    :param coverage: share of requests to cover
+
+    :returns: `list` of minimum and maximum zoom levels
+    """
+
+    total = sum(zooms.values())
+    levels = sorted(zooms)
+    best = [levels[0], levels[-1]]
+
+    for i, start in enumerate(levels):
+        count = 0
+        for end in levels[i:]:
+            count += zooms[end]
+            if count >= coverage * total:
+                if end - start < best[1] - best[0]:
+                    best = [start, end]
+                break
+
+    return best
+
+
+class HeavyHitters:
+    """
+    Approximate counts of the most frequent keys of a stream in bounded
+    memory (Misra-Gries), underestimating counts by at most the number of
+    keys added divided by the capacity
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        Initialize counter
+
+        :param capacity: maximum number of counted keys
+
+        :returns: `geomet_mapproxy.stats.HeavyHitters`
+        """
+
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+
+    def add(self, key):
+        """
+        Count a key
+
+        :param key: hashable key
+
+        :returns: `None`
+        """
+
+        self.total += 1
+
+        if key in self.counts:
+            self.counts[key] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = 1
+        else:
+            for key_ in list(self.counts):
+                self.counts[key_] -= 1
+                if self.counts[key_] == 0:
+                    del self.counts[key_]
+
+    def most_common(self, n):
+        """
+        Get the most frequent keys
+
+        :param n: number of keys
+
+        :returns: `list` of key and (approximate) count tuples
+        """
+
+        return Counter(self.counts).most_common(n)
+
+
+class AccessLogStats:
+    """
+    Aggregates access log lines for cache tuning and seeding, in bounded
+    memory: request types, layers, grids and TIME offsets which are not
+    configured (or beyond the bounds of distinct values) are counted as
+    `other`
+    """
+
+    def __init__(self, dimensions_index=None, capacity=10000,
+                 max_layers=MAX_LAYERS, max_time_offsets=MAX_TIME_OFFSETS):
+        """
+        Initialize statistics
+
+        :param dimensions_index: `dict` of dimensions index, to restrict
+                                 layers to configured ones and derive TIME
+                                 offsets from layer defaults (optional)
+        :param capacity: maximum number of counted tiles
+        :param max_layers: maximum number of distinct layers, without a
+                           dimensions index
+        :param max_time_offsets: maximum number of distinct TIME offsets
+                                 per layer
+
+        :returns: `geomet_mapproxy.stats.AccessLogStats`
+        """
+
+        self.lines = 0
+        self.unparsed = 0
+        self.start = None
+        self.end = None
+        self.requests = Counter()
+        # (layer, grid, zoom, TIME offset, cache status) -> requests
+        self.counts = Counter()
+        self.tiles = HeavyHitters(capacity)
+
+        self.max_layers = max_layers
+        self.max_time_offsets = max_time_offsets
+        self.time_offsets = {}
+
+        # configured layers, or the first distinct layers requested (e.g.
+        # when the dimensions index does not exist yet)
+        self.layers = set((dimensions_index or {}).get('layers', {}))
+        self.layers_configured = bool(self.layers)
+
+        self.time_defaults = {}
+        for layer, values in (dimensions_index or {}).get(
+                'layers', {}).items():
+            time_ = values.get('dimensions', {}).get('time')
+            if not time_:
+                continue
+            default = parse_datetime(str(time_.get('default')))
+            if default is None:
+                continue
+            cadence = get_temporal_extent(time_.get('values'))[1]
+            self.time_defaults[layer] = (
+                default, cadence, values.get('updated'))
+
+        self._log_time = (None, None)
+
+    def parse_log_time(self, value):
+        """
+        Parse an access log timestamp (repeated timestamps are cached)
+
+        :param value: `str` of access log timestamp
+
+        :returns: `float` of POSIX timestamp or `None` if not parseable
+        """
+
+        if self._log_time[0] != value:
+            self._log_time = (value, parse_log_time(value))
+
+        return self._log_time[1]
+
+    def get_layer(self, layer):
+        """
+        Derive the aggregation key of a requested layer
+
+        :param layer: layer name
+
+        :returns: `str` of layer name (`other` if not configured)
+        """
+
+        if layer in self.layers:
+            return layer
+
+        if self.layers_configured or len(self.layers) >= self.max_layers:
+            return OTHER
+
+        self.layers.add(layer)
+        return layer
+
+    def get_time_offset(self, layer, time_, request_time):
+        """
+        Derive the offset of a requested TIME from the layer default
+
+        The default in effect when the request was made is estimated from
+        the current default, its cadence and when it was last updated
+        (dimensions index), assuming the default follows the clock at a
+        constant lag
+
+        :param layer: layer name
+        :param time_: `str` of requested TIME (or `None`)
+        :param request_time: POSIX timestamp of request
+
+        :returns: `str` of ISO8601 offset, `default` when no TIME is
+                  requested or `unknown`
+        """
+
+        if not time_:
+            return 'default'
+
+        requested = parse_datetime(unquote(time_).split('/')[0])
+        if requested is None or layer not in self.time_defaults:
+            return 'unknown'
+
+        default, cadence, updated = self.time_defaults[layer]
+        if cadence and updated is not None and request_time is not None:
+            step = cadence.total_seconds()
+            lag = updated - default.timestamp()
+            # latest time step available when the request was made
+            reference = default.timestamp() + math.floor(
+                (request_time - lag - default.timestamp()) / step) * step
+            offset = round((requested.timestamp() - reference) / step) * step
+        else:
+            offset = requested.timestamp() - default.timestamp()
+
+        return format_offset(offset)
+
+    def get_time_offset_key(self, layer, offset):
+        """
+        Derive the aggregation key of a TIME offset
+
+        :param layer: layer name
+        :param offset: `str` of TIME offset
+
+        :returns: `str` of TIME offset (`other` beyond the maximum number of
+                  distinct offsets of the layer)
+        """
+
+        offsets = self.time_offsets.setdefault(layer, set())
+
+        if offset not in offsets:
+            if len(offsets) >= self.max_time_offsets:
+                return OTHER
+            offsets.add(offset)
+
+        return offset
+
+    def add(self, line):
+        """
+        Aggregate an access log line
+
+        :param line: `str` of log line
+
+        :returns: `None`
+        """
+
+        self.lines += 1
+
+        record = parse_access_log_line(line)
+        if record is None:
+            self.unparsed += 1
+            return
+
+        if self.start is None:
+            self.start = record['time']
+        self.end = record['time']
+
+        params = record['params']
+        request = get_request_label(params.get('request', '').lower())
+        self.requests[request or 'unknown'] += 1
+
+        if request != 'getmap' or record['status'] >= 400:
+            return
+
+        grid, zoom, x, y = get_tile(params)
+        request_time = None
+        if params.get('time'):
+            request_time = self.parse_log_time(record['time'])
+
+        for layer in params.get('layers', '').split(','):
+            if not layer:
+                continue
+            layer = self.get_layer(layer)
+            offset = self.get_time_offset_key(layer, self.get_time_offset(
+                layer, params.get('time'), request_time))
+            self.counts[(layer, grid, zoom, offset, record['cache'])] += 1
+            if zoom is not None and layer != OTHER:
+                self.tiles.add((layer, grid, zoom, x, y))
+
+    def summary(self, top=100, coverage=0.95):
+        """
+        Summarize aggregated requests
+
+        :param top: number of hot tiles
+        :param coverage: share of requests covered by recommended zoom
+                         ranges
+
+        :returns: `dict` of request counts, per layer breakdowns (grids,
+                  zoom levels, TIME offsets, cache status and recommended
+                  zoom ranges) and hot tiles
+        """
+
+        layers = {}
+        for (layer, grid, zoom, offset, cache), count in self.counts.items():
+            layer_ = layers.setdefault(layer, {
+                'requests': 0,
+                'cache': {},
+                'time_offsets': {},
+                'grids': {}
+            })
+            layer_['requests'] += count
+            layer_['cache'][cache] = layer_['cache'].get(cache, 0) + count
+            layer_['time_offsets'][offset] = \
+                layer_['time_offsets'].get(offset, 0) + count
+
+            grid_ = layer_['grids'].setdefault(grid, {
+                'requests': 0,
+                'cache': {},
+                'zooms': {}
+            })
+            grid_['requests'] += count
+            grid_['cache'][cache] = grid_['cache'].get(cache, 0) + count
+            if zoom is not None:
+                grid_['zooms'][zoom] = grid_['zooms'].get(zoom, 0) + count
+
+        for layer_ in layers.values():
+            layer_['time_offsets'] = dict(sorted(
+                layer_['time_offsets'].items(), key=lambda x: -x[1]))
+            for grid_ in layer_['grids'].values():
+                if grid_['zooms']:
+                    grid_['zooms'] = dict(sorted(grid_['zooms'].items()))
+                    grid_['recommended_zooms'] = get_zoom_range(
+                        grid_['zooms'], coverage)
+
+        hot_tiles = []
+        for (layer, grid, zoom, x, y), count in self.tiles.most_common(top):
+            hot_tiles.append({
+                'layer': layer,
+                'grid': grid,
+                'z': zoom,
+                'x': x,
+                'y': y,
+                'requests': count
+            })
+
+        return {
+            'lines': self.lines,
+            'unparsed': self.unparsed,
+            'period': [self.start, self.end],
+            'requests': dict(self.requests.most_common()),
+            'layers': dict(sorted(layers.items(),
+                                  key=lambda x: -x[1]['requests'])),
+            'hot_tiles': hot_tiles
+        }
+
+
+def get_seed_config(summary):
+    """
+    Derive a MapProxy seeding configuration (mapproxy-seed) from recommended
+    zoom ranges
+
+    :param summary: `dict` of access log summary
+
+    :returns: `dict` of seeding configuration
+    """
+
+    seeds = {}
+
+    for layer, values in summary['layers'].items():
+        if layer == OTHER:
+            continue
+        for grid, grid_values in values['grids'].items():
+            if 'recommended_zooms' not in grid_values:
+                continue
+            seeds['{}_{}'.format(layer, grid)] = {
+                'caches': ['{}_cache'.format(layer)],
+                'grids': [grid],
+                'levels': {
+                    'from': grid_values['recommended_zooms'][0],
+                    'to': grid_values['recommended_zooms'][1]
+                }
+            }
+
+    return {'seeds': seeds}
+
+
+@click.group()
+def stats():
+    """Analyze MapProxy usage"""
+    pass
+
+
+@click.command('access-log')
+@click.pass_context
+@click.argument('logfiles', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False,
+                                allow_dash=True))
+@click.option('--top', '-t', 'top', type=click.IntRange(min=1), default=100,
+              help='Number of hot tiles to report')
+@click.option('--coverage', 'coverage', type=click.FloatRange(0, 1),
+              default=0.95,
+              help='Share of requests covered by recommended zoom ranges')
+@click.option('--capacity', 'capacity', type=click.IntRange(min=1),
+              default=10000,
+              help='Maximum number of tiles counted (memory bound)')
+@click.option('--output', '-o', 'output', type=click.Path(dir_okay=False),
+              default=None, help='Write summary (JSON) to file')
+@click.option('--seed-config', 'seed_config',
+              type=click.Path(dir_okay=False), default=None,
+              help='Write MapProxy seeding configuration to file')
+def access_log(ctx, logfiles, top, coverage, capacity, output, seed_config):
+    """Aggregate access logs (plain or gzip) for cache tuning and seeding"""
+
+    index = None
+    if GEOMET_MAPPROXY_CONFIG is not None:
+        index = read_dimensions_index(GEOMET_MAPPROXY_CONFIG)
+
+    stats_ = AccessLogStats(index, capacity)
+
+    for logfile in logfiles:
+        LOGGER.debug('Reading {}'.format(logfile))
+        with open_log(logfile) as fh:
+            for line in fh:
+                stats_.add(line)
+
+    summary = stats_.summary(top, coverage)
+
+    if output is None:
+        click.echo(json.dumps(summary, indent=4))
+    else:
+        with open(output, 'w') as fh:
+            json.dump(summary, fh, indent=4)
+        click.echo('Summary of {} lines written to {}'.format(
+            summary['lines'], output))
+
+    if seed_config is not None:
+        with open(seed_config, 'w') as fh:
+            yaml_dump(get_seed_config(summary), fh)
+        click.echo('Seeding configuration written to {}'.format(
+            seed_config))
+
+
+stats.add_command(access_log)
@@ -0,0 +1,172 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import json
+import logging
+import os
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# exponential backoff between retries (seconds)
+BACKOFF = 0.5
+BACKOFF_MAX = 5
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an upstream service, opened after consecutive
+    failures and half-opened after a cool down.  State is persisted so that
+    it is shared by successive (e.g. cron) runs
+    """
+
+    def __init__(self, state_filepath, threshold=5, cooldown=60):
+        """
+        Initialize circuit breaker
+
+        :param state_filepath: filepath of persisted state
+        :param threshold: number of consecutive failures opening the circuit
+        :param cooldown: duration the circuit stays open (seconds)
+
+        :returns: `geomet_mapproxy.upstream.CircuitBreaker`
+        """
+
+        self.state_filepath = state_filepath
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.failures = 0
+        self.opened = None
+
+        try:
+            with open(state_filepath) as fh:
+                state = json.load(fh)
+            self.failures = state['failures']
+            self.opened = state['opened']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            LOGGER.warning('Cannot read circuit breaker state: {}'.format(err))
+
+    def allow(self):
+        """
+        Checks whether the upstream may be called
+
+        :returns: `bool` of whether the circuit is closed (or half-open)
+        """
+
+        if self.opened is None:
+            return True
+
+        return time.time() >= self.opened + self.cooldown
+
+    def record_success(self):
+        """
+        Records a successful upstream call, closing the circuit
+
+        :returns: `None`
+        """
+
+        if self.failures or self.opened is not None:
+            if self.opened is not None:
+                LOGGER.info('Closing circuit breaker')
+            self.failures = 0
+            self.opened = None
+            self.save()
+
+    def record_failure(self):
+        """
+        Records a failed upstream call, opening the circuit once the
+        threshold is reached (or again when half-open)
+
+        :returns: `None`
+        """
+
+        self.failures += 1
+        if self.failures >= self.threshold:
+            LOGGER.warning('Opening circuit breaker for {}s after {} '
+                           'consecutive failures'.format(self.cooldown,
+                                                         self.failures))
+            self.opened = time.time()
+        self.save()
+
+    def save(self):
+        """
+        Persists circuit breaker state
+
+        :returns: `None`
+        """
+
+        tmp_filepath = '{}.{}'.format(self.state_filepath, os.getpid())
+
+        try:
+            with open(tmp_filepath, 'w') as fh:
+                json.dump({
+                    'failures': self.failures,
+                    'opened': self.opened
+                }, fh)
+            os.replace(tmp_filepath, self.state_filepath)
+        except OSError as err:
+            LOGGER.warning('Cannot write circuit breaker state: {}'.format(
+                err))
+
+
+def call_with_retries(func, retries=2, backoff=BACKOFF,
+                      backoff_max=BACKOFF_MAX, retry_on=(OSError,),
+                      deadline=None):
+    """
+    Calls a function, retrying on (network) errors with exponential backoff
+
+    :param func: callable
+    :param retries: maximum number of retries
+    :param backoff: initial backoff (seconds)
+    :param backoff_max: maximum backoff (seconds)
+    :param retry_on: `tuple` of exception types to retry on (`OSError`
+                     includes socket errors and `requests` exceptions)
+    :param deadline: `time.monotonic` value after which no retry is
+                     attempted (optional)
+
+    :returns: `tuple` of result and number of attempts
+    """
+
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            return func(), attempt
+        except retry_on as err:
+            if attempt > retries:
+                raise
+            delay = min(backoff * 2 ** (attempt - 1), backoff_max)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            LOGGER.debug('Attempt {} failed ({}), retrying in {}s'.format(
+                attempt, err, delay))
+            time.sleep(delay)
@@ -27,14 +27,48 @@
 #
 # =================================================================
 
+from datetime import datetime, timedelta, timezone
+import fcntl
+import hashlib
+import io
+import json
 import logging
 import os
 import re
+import stat
+import threading
+import time
 
 import yaml
 
 LOGGER = logging.getLogger(__name__)
 
+# libyaml based loader/dumper when available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# support environment variables in config
+# https://stackoverflow.com/a/55301129
+ENV_VAR_MATCHER = re.compile(r'.*\$\{([^}^{]+)\}.*')
+ENV_VAR_PATTERN = re.compile(r'\$\{([^}^{]+)\}')
+
+# version of compiled configuration snapshots (bump on format changes)
+SNAPSHOT_VERSION = 1
+
+# snapshots and fragments of configurations (and leftover temporary files)
+CONFIG_FILE_MATCHER = re.compile(
+    r'^geomet-mapproxy-(?:snapshot|fragments)-([0-9a-f]{16})\.json(\..+)?$')
+# age after which snapshots and fragments of other configurations, and
+# leftover temporary files, are pruned (seconds)
+PRUNE_MAX_AGE = 86400
+PRUNE_TMP_MAX_AGE = 3600
+
+ISO8601_DURATION = re.compile(
+    r'^P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<weeks>\d+)W)?'
+    r'(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?'
+    r'(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$'
+)
+
 
 def get_typed_value(value):
     """
@@ -58,6 +92,31 @@ def get_typed_value(value):
     return value2
 
 
+def path_constructor(loader, node):
+    """
+    Constructs a YAML scalar referencing an environment variable
+
+    :param loader: YAML loader
+    :param node: YAML scalar node
+
+    :returns: value with environment variables expanded
+    """
+
+    env_var = ENV_VAR_MATCHER.match(node.value).group(1)
+    if env_var not in os.environ:
+        raise EnvironmentError('Undefined environment variable in config')
+    return get_typed_value(os.path.expandvars(node.value))
+
+
+class EnvVarLoader(YAML_LOADER):
+    """YAML loader resolving environment variables"""
+    pass
+
+
+EnvVarLoader.add_implicit_resolver('!path', ENV_VAR_MATCHER, None)
+EnvVarLoader.add_constructor('!path', path_constructor)
+
+
 def yaml_load(fh):
     """
     Serializes a YAML files into a pyyaml object
@@ -68,20 +127,843 @@ def yaml_load(fh):
     """
 
     LOGGER.debug('Loading YAML configuration with environment variables')
-    # support environment variables in config
-    # https://stackoverflow.com/a/55301129
-    path_matcher = re.compile(r'.*\$\{([^}^{]+)\}.*')
+    return yaml.load(fh, Loader=EnvVarLoader)
+
 
-    def path_constructor(loader, node):
-        env_var = path_matcher.match(node.value).group(1)
-        if env_var not in os.environ:
-            raise EnvironmentError('Undefined environment variable in config')
-        return get_typed_value(os.path.expandvars(node.value))
+def yaml_dump(data, fh):
+    """
+    Serializes a pyyaml object into a YAML file
+
+    :param data: `dict` representation of YAML
+    :param fh: file handle
+
+    :returns: `None`
+    """
+
+    yaml.dump(data, fh, Dumper=YAML_DUMPER)
+
+
+def get_config_file_name(filepath):
+    """
+    Derive the name of the snapshot and fragments of a configuration
+
+    :param filepath: filepath to configuration
+
+    :returns: `str` of name
+    """
+
+    return hashlib.sha256(
+        os.path.abspath(filepath).encode('utf-8')).hexdigest()[:16]
+
+
+def get_private_dir(directory):
+    """
+    Derive the directory of the files private to the current user (e.g.
+    configuration snapshots) in a (possibly shared) directory
+
+    :param directory: directory (e.g. `GEOMET_MAPPROXY_TMP`)
+
+    :returns: `str` of private directory
+    """
+
+    return os.path.join(directory, 'geomet-mapproxy-{}'.format(os.geteuid()))
+
+
+def make_private_dir(directory):
+    """
+    Create the directory of the files private to the current user, checking
+    that it is a directory only the current user can write to
 
-    class EnvVarLoader(yaml.SafeLoader):
+    :param directory: directory (e.g. `GEOMET_MAPPROXY_TMP`)
+
+    :returns: `bool` of whether the private directory can be used
+    """
+
+    private_dir = get_private_dir(directory)
+
+    try:
+        os.mkdir(private_dir, 0o700)
+    except FileExistsError:
         pass
+    except OSError as err:
+        LOGGER.warning('Cannot create {}: {}'.format(private_dir, err))
+        return False
 
-    EnvVarLoader.add_implicit_resolver('!path', path_matcher, None)
-    EnvVarLoader.add_constructor('!path', path_constructor)
+    try:
+        st = os.lstat(private_dir)
+    except OSError as err:
+        LOGGER.warning('Cannot read {}: {}'.format(private_dir, err))
+        return False
 
-    return yaml.load(fh, Loader=EnvVarLoader)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or
+            st.st_mode & 0o077):
+        LOGGER.warning('Not using {}: not a directory private to the '
+                       'current user'.format(private_dir))
+        return False
+
+    return True
+
+
+def open_private_file(filepath, mode='r'):
+    """
+    Open a file for reading, checking that it is owned by the current user
+    and not writable by others (i.e. it can be trusted)
+
+    :param filepath: filepath
+    :param mode: file mode (`r` or `rb`)
+
+    :returns: file object (raises `PermissionError` if not trusted)
+    """
+
+    fd = os.open(filepath, os.O_RDONLY | os.O_NOFOLLOW)
+
+    try:
+        st = os.fstat(fd)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+            raise PermissionError(
+                '{} is not owned by the current user or is writable by '
+                'others'.format(filepath))
+        return os.fdopen(fd, mode)
+    except Exception:
+        os.close(fd)
+        raise
+
+
+def get_config_snapshot_filepath(filepath, snapshot_dir):
+    """
+    Derive the filepath of the compiled snapshot of a YAML configuration
+
+    :param filepath: filepath to YAML configuration
+    :param snapshot_dir: directory of snapshots (kept in its private
+                         directory, see `get_private_dir`)
+
+    :returns: `str` of snapshot filepath
+    """
+
+    return os.path.join(get_private_dir(snapshot_dir),
+                        'geomet-mapproxy-snapshot-{}.json'.format(
+                            get_config_file_name(filepath)))
+
+
+def get_config_snapshot_key(content):
+    """
+    Derive the key of the compiled snapshot of a YAML configuration, from
+    its content and the values of the environment variables it references
+
+    :param content: `bytes` of YAML configuration
+
+    :returns: `str` of snapshot key
+    """
+
+    sha256 = hashlib.sha256(content)
+
+    env_vars = ENV_VAR_PATTERN.findall(content.decode('utf-8', 'replace'))
+    for env_var in sorted(set(env_vars)):
+        sha256.update('\0{}={}'.format(
+            env_var, os.environ.get(env_var)).encode('utf-8'))
+
+    return '{}:{}'.format(SNAPSHOT_VERSION, sha256.hexdigest())
+
+
+def is_json_compatible(data):
+    """
+    Checks whether data survives a JSON round trip unchanged
+
+    :param data: data
+
+    :returns: `bool` of whether data is JSON compatible
+    """
+
+    if isinstance(data, dict):
+        return all(isinstance(k, str) and is_json_compatible(v)
+                   for k, v in data.items())
+    elif isinstance(data, list):
+        return all(is_json_compatible(v) for v in data)
+
+    return data is None or isinstance(data, (str, int, float))
+
+
+def write_config_snapshot(filepath, snapshot_dir, data, content=None):
+    """
+    Writes the compiled snapshot of a YAML configuration
+
+    :param filepath: filepath to YAML configuration
+    :param snapshot_dir: directory of snapshots
+    :param data: `dict` representation of YAML configuration
+    :param content: `bytes` of YAML configuration (read if not given)
+
+    :returns: `bool` of whether the snapshot was written
+    """
+
+    if not is_json_compatible(data):
+        LOGGER.debug('Not snapshotting {}: not JSON compatible'.format(
+            filepath))
+        return False
+
+    if not make_private_dir(snapshot_dir):
+        return False
+
+    if content is None:
+        with open(filepath, 'rb') as fh:
+            content = fh.read()
+
+    snapshot_filepath = get_config_snapshot_filepath(filepath, snapshot_dir)
+    # snapshots are written by serving processes, possibly multi-threaded
+    tmp_filepath = '{}.{}.{}'.format(snapshot_filepath, os.getpid(),
+                                     threading.get_ident())
+
+    LOGGER.debug('Writing configuration snapshot {}'.format(
+        snapshot_filepath))
+    try:
+        with open(tmp_filepath, 'w') as fh:
+            json.dump({
+                'key': get_config_snapshot_key(content),
+                'data': data
+            }, fh, separators=(',', ':'))
+        os.replace(tmp_filepath, snapshot_filepath)
+    except OSError as err:
+        LOGGER.warning('Cannot write configuration snapshot: {}'.format(err))
+        return False
+
+    return True
+
+
+def yaml_load_snapshot(filepath, snapshot_dir, content=None):
+    """
+    Loads a YAML configuration from its compiled snapshot, (re)compiling
+    the snapshot if the configuration or the environment variables it
+    references have changed.  Snapshots are only trusted in the private
+    directory of the current user, if owned by the current user and not
+    writable by others
+
+    :param filepath: filepath to YAML configuration
+    :param snapshot_dir: directory of snapshots
+    :param content: `bytes` of YAML configuration (read if not given)
+
+    :returns: `dict` representation of YAML
+    """
+
+    if content is None:
+        with open(filepath, 'rb') as fh:
+            content = fh.read()
+
+    key = get_config_snapshot_key(content)
+    snapshot_filepath = get_config_snapshot_filepath(filepath, snapshot_dir)
+
+    try:
+        if make_private_dir(snapshot_dir):
+            with open_private_file(snapshot_filepath) as fh:
+                snapshot = json.load(fh)
+            if snapshot.get('key') == key:
+                LOGGER.debug('Loading configuration snapshot {}'.format(
+                    snapshot_filepath))
+                return snapshot['data']
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as err:
+        LOGGER.warning('Cannot read configuration snapshot: {}'.format(err))
+
+    data = yaml_load(io.BytesIO(content))
+    write_config_snapshot(filepath, snapshot_dir, data, content)
+
+    return data
+
+
+def yaml_dump_fragments(data, fragments=None, layers=None):
+    """
+    Serializes a MapProxy configuration to YAML one top level section and
+    one layer at a time (their concatenation is identical to `yaml_dump`),
+    reusing the fragments of a previous serialization for unchanged
+    sections and layers
+
+    :param data: `dict` of MapProxy configuration
+    :param fragments: `dict` of fragments of a previous serialization
+                      (optional)
+    :param layers: `list` of names of the layers changed since the previous
+                   serialization, all other sections and layers being
+                   unchanged (`None` to serialize everything)
+
+    :returns: `tuple` of `str` of YAML and `dict` of fragments
+    """
+
+    reuse = fragments is not None and layers is not None
+    changed = set(layers or [])
+
+    parts = []
+    new_fragments = {'sections': {}, 'layers': {}}
+
+    for key in sorted(data):
+        if key == 'layers' and isinstance(data[key], list) and data[key]:
+            parts.append('layers:\n')
+            for layer in data[key]:
+                name = layer.get('name')
+                text = None
+                if reuse and name not in changed:
+                    text = fragments['layers'].get(name)
+                if text is None:
+                    text = yaml.dump([layer], Dumper=YAML_DUMPER)
+                new_fragments['layers'][name] = text
+                parts.append(text)
+            continue
+
+        text = fragments['sections'].get(key) if reuse else None
+        if text is None:
+            text = yaml.dump({key: data[key]}, Dumper=YAML_DUMPER)
+        new_fragments['sections'][key] = text
+        parts.append(text)
+
+    return ''.join(parts), new_fragments
+
+
+def get_config_fragments_filepath(filepath, fragments_dir):
+    """
+    Derive the filepath of the YAML fragments of a MapProxy configuration
+
+    :param filepath: filepath to MapProxy configuration
+    :param fragments_dir: directory of fragments (kept in its private
+                          directory, see `get_private_dir`)
+
+    :returns: `str` of fragments filepath
+    """
+
+    return os.path.join(get_private_dir(fragments_dir),
+                        'geomet-mapproxy-fragments-{}.json'.format(
+                            get_config_file_name(filepath)))
+
+
+def write_config_fragments(filepath, fragments_dir, fragments, generation):
+    """
+    Writes the YAML fragments of a MapProxy configuration
+
+    :param filepath: filepath to MapProxy configuration
+    :param fragments_dir: directory of fragments
+    :param fragments: `dict` of fragments
+    :param generation: `str` of configuration generation
+
+    :returns: `None`
+    """
+
+    if not make_private_dir(fragments_dir):
+        return
+
+    fragments_filepath = get_config_fragments_filepath(filepath,
+                                                       fragments_dir)
+    tmp_filepath = '{}.{}'.format(fragments_filepath, os.getpid())
+
+    try:
+        with open(tmp_filepath, 'w') as fh:
+            json.dump({
+                'generation': generation,
+                'fragments': fragments
+            }, fh, separators=(',', ':'))
+        os.replace(tmp_filepath, fragments_filepath)
+    except OSError as err:
+        LOGGER.warning('Cannot write configuration fragments: {}'.format(err))
+
+
+def read_config_fragments(filepath, fragments_dir):
+    """
+    Reads the YAML fragments of a MapProxy configuration, if they match its
+    current generation and the configuration was not modified since (e.g.
+    edited by hand).  As for snapshots, fragments are only trusted in the
+    private directory of the current user, if owned by the current user and
+    not writable by others
+
+    :param filepath: filepath to MapProxy configuration
+    :param fragments_dir: directory of fragments
+
+    :returns: `dict` of fragments, or `None` if not available
+    """
+
+    generation = read_config_generation(filepath)
+    if generation is None:
+        return None
+
+    if not make_private_dir(fragments_dir):
+        return None
+
+    try:
+        with open_private_file(get_config_fragments_filepath(
+                filepath, fragments_dir)) as fh:
+            fragments = json.load(fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        LOGGER.warning('Cannot read configuration fragments: {}'.format(err))
+        return None
+
+    if fragments.get('generation') != generation:
+        LOGGER.debug('Configuration fragments out of date')
+        return None
+
+    try:
+        modified = get_config_generation(filepath) != generation
+    except OSError as err:
+        LOGGER.warning('Cannot read configuration: {}'.format(err))
+        return None
+
+    if modified:
+        LOGGER.warning('{} modified since it was written, serializing all '
+                       'layers'.format(filepath))
+        return None
+
+    return fragments['fragments']
+
+
+def prune_config_files(directory, filepaths, max_age=PRUNE_MAX_AGE,
+                       tmp_max_age=PRUNE_TMP_MAX_AGE):
+    """
+    Prunes the snapshots and fragments of configurations other than the
+    given ones (or of earlier versions, outside the private directory), and
+    leftover temporary files, once older than a maximum age.  Only files of
+    the current user are removed
+
+    :param directory: directory of snapshots and fragments
+    :param filepaths: `list` of filepaths of configurations to keep
+    :param max_age: maximum age of snapshots and fragments of other
+                    configurations (seconds)
+    :param tmp_max_age: maximum age of temporary files (seconds)
+
+    :returns: `int` of number of files removed
+    """
+
+    keep = set(get_config_file_name(filepath) for filepath in filepaths)
+    now = time.time()
+    removed = 0
+
+    # files of earlier versions were kept in the directory itself
+    for directory_ in [get_private_dir(directory), directory]:
+        try:
+            entries = list(os.scandir(directory_))
+        except FileNotFoundError:
+            continue
+        except OSError as err:
+            LOGGER.warning('Cannot list {}: {}'.format(directory_, err))
+            continue
+
+        for entry in entries:
+            match = CONFIG_FILE_MATCHER.match(entry.name)
+            if match is None:
+                continue
+
+            if match.group(2) is not None:
+                age = tmp_max_age
+            elif directory_ == directory or match.group(1) not in keep:
+                age = max_age
+            else:
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+                if st.st_uid == os.geteuid() and now - st.st_mtime > age:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                LOGGER.warning('Cannot remove {}: {}'.format(entry.path, err))
+
+    if removed:
+        LOGGER.debug('Pruned {} files from {}'.format(removed, directory))
+
+    return removed
+
+
+def get_config_generation_filepath(config_filepath):
+    """
+    Derive the filepath of the generation marker of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of generation marker filepath
+    """
+
+    return '{}.generation'.format(config_filepath)
+
+
+def get_config_generation(config_filepath):
+    """
+    Derive the generation of a MapProxy configuration from its content
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of configuration generation
+    """
+
+    sha256 = hashlib.sha256()
+
+    with open(config_filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def write_config_generation(config_filepath):
+    """
+    Writes the generation marker of a MapProxy configuration, derived
+    from the content of the configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of configuration generation
+    """
+
+    generation = get_config_generation(config_filepath)
+    generation_filepath = get_config_generation_filepath(config_filepath)
+    tmp_filepath = '{}.{}'.format(generation_filepath, os.getpid())
+
+    LOGGER.debug('Writing configuration generation {}'.format(generation))
+    with open(tmp_filepath, 'w') as fh:
+        fh.write(generation)
+
+    os.replace(tmp_filepath, generation_filepath)
+
+    return generation
+
+
+def read_config_generation(config_filepath):
+    """
+    Reads the generation marker of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of configuration generation, or `None` if not available
+    """
+
+    generation_filepath = get_config_generation_filepath(config_filepath)
+
+    try:
+        with open(generation_filepath) as fh:
+            return fh.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def get_config_structure_filepath(config_filepath):
+    """
+    Derive the filepath of the structure key of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of structure key filepath
+    """
+
+    return '{}.structure'.format(config_filepath)
+
+
+def write_config_structure(config_filepath, key):
+    """
+    Writes the structure key of a MapProxy configuration, i.e. a hash of
+    the inputs its sources, caches and layers were generated from
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param key: `str` of structure key
+
+    :returns: `None`
+    """
+
+    structure_filepath = get_config_structure_filepath(config_filepath)
+    tmp_filepath = '{}.{}'.format(structure_filepath, os.getpid())
+
+    with open(tmp_filepath, 'w') as fh:
+        fh.write(key)
+
+    os.replace(tmp_filepath, structure_filepath)
+
+
+def read_config_structure(config_filepath):
+    """
+    Reads the structure key of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of structure key, or `None` if not available
+    """
+
+    if not os.path.exists(config_filepath):
+        return None
+
+    try:
+        with open(get_config_structure_filepath(config_filepath)) as fh:
+            return fh.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def parse_datetime(value):
+    """
+    Parse an ISO8601 datetime
+
+    :param value: `str` of ISO8601 datetime
+
+    :returns: `datetime.datetime` (UTC) or `None` if not parseable
+    """
+
+    try:
+        dt = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt
+
+
+def parse_duration(value):
+    """
+    Parse an ISO8601 duration (years and months are approximated)
+
+    :param value: `str` of ISO8601 duration (e.g. PT10M)
+
+    :returns: `datetime.timedelta` or `None` if not parseable
+    """
+
+    match = ISO8601_DURATION.match(value.strip())
+    if match is None or value.strip() in ('P', 'PT'):
+        return None
+
+    parts = {k: float(v) for k, v in match.groupdict().items() if v}
+
+    return timedelta(
+        days=(parts.get('years', 0) * 365 + parts.get('months', 0) * 30 +
+              parts.get('weeks', 0) * 7 + parts.get('days', 0)),
+        hours=parts.get('hours', 0),
+        minutes=parts.get('minutes', 0),
+        seconds=parts.get('seconds', 0)
+    )
+
+
+def get_temporal_extent(values):
+    """
+    Derive the latest value and cadence of a temporal dimension
+
+    :param values: `list` of dimension values (ISO8601 instants and/or
+                   start/end/period intervals)
+
+    :returns: `tuple` of latest `datetime.datetime` and cadence
+              `datetime.timedelta` (either can be `None`)
+    """
+
+    latest = None
+    cadence = None
+    instants = []
+
+    for value in values or []:
+        for token in str(value).split(','):
+            interval = token.strip().split('/')
+            if len(interval) == 3:
+                end = parse_datetime(interval[1])
+                period = parse_duration(interval[2])
+                if end is not None and (latest is None or end > latest):
+                    latest = end
+                if period and (cadence is None or period < cadence):
+                    cadence = period
+            else:
+                instant = parse_datetime(interval[0])
+                if instant is not None:
+                    instants.append(instant)
+
+    if instants:
+        instants.sort()
+        if latest is None or instants[-1] > latest:
+            latest = instants[-1]
+        if len(instants) > 1 and cadence is None:
+            cadence = instants[-1] - instants[-2]
+
+    return latest, cadence
+
+
+def get_temporal_steps(values):
+    """
+    Derive the steps of a temporal dimension
+
+    :param values: `list` of dimension values (ISO8601 instants and/or
+                   start/end/period intervals)
+
+    :returns: `tuple` of `list` of (start, end, period) intervals and `set`
+              of instants (intervals with calendar periods, i.e. years or
+              months, are left out as their steps cannot be derived)
+    """
+
+    intervals = []
+    instants = set()
+
+    for value in values or []:
+        for token in str(value).split(','):
+            interval = token.strip().split('/')
+            if len(interval) == 3:
+                start = parse_datetime(interval[0])
+                end = parse_datetime(interval[1])
+                period = parse_duration(interval[2])
+                calendar = any(x in interval[2].upper().split('T')[0]
+                               for x in 'YM')
+                if None not in (start, end) and period and not calendar:
+                    intervals.append((start, end, period))
+            else:
+                instant = parse_datetime(interval[0])
+                if instant is not None:
+                    instants.add(instant)
+
+    return intervals, instants
+
+
+def is_temporal_step(steps, value):
+    """
+    Detect whether a datetime is a step of a temporal dimension
+
+    :param steps: `tuple` of intervals and instants (as per
+                  `get_temporal_steps`)
+    :param value: `datetime.datetime`
+
+    :returns: `bool` of whether the datetime is a step
+    """
+
+    intervals, instants = steps
+
+    if value in instants:
+        return True
+
+    for start, end, period in intervals:
+        if start <= value <= end and (value - start) % period == timedelta(0):
+            return True
+
+    return False
+
+
+def get_dimensions_index_filepath(config_filepath):
+    """
+    Derive the filepath of the dimensions index of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `str` of dimensions index filepath
+    """
+
+    return '{}.dimensions.json'.format(config_filepath)
+
+
+def write_dimensions_index(config_filepath, mapproxy_config):
+    """
+    Writes a compact index of layer dimensions of a MapProxy configuration,
+    keeping track of when the dimensions of each layer last changed
+
+    :param config_filepath: filepath to MapProxy configuration
+    :param mapproxy_config: `dict` of MapProxy configuration
+
+    :returns: `dict` of dimensions index
+    """
+
+    previous = read_dimensions_index(config_filepath)
+    now = int(time.time())
+
+    index = {'layers': {}}
+    for layer in mapproxy_config.get('layers', []):
+        dimensions = layer.get('dimensions', {})
+        updated = now
+        if previous['layers'].get(layer['name'], {}).get(
+                'dimensions') == dimensions:
+            updated = previous['layers'][layer['name']]['updated']
+
+        index['layers'][layer['name']] = {
+            'dimensions': dimensions,
+            'updated': updated
+        }
+
+    index_filepath = get_dimensions_index_filepath(config_filepath)
+    tmp_filepath = '{}.{}'.format(index_filepath, os.getpid())
+
+    with open(tmp_filepath, 'w') as fh:
+        json.dump(index, fh, default=str)
+
+    os.replace(tmp_filepath, index_filepath)
+
+    return index
+
+
+def read_dimensions_index(config_filepath):
+    """
+    Reads the dimensions index of a MapProxy configuration
+
+    :param config_filepath: filepath to MapProxy configuration
+
+    :returns: `dict` of dimensions index
+    """
+
+    index_filepath = get_dimensions_index_filepath(config_filepath)
+
+    try:
+        with open(index_filepath) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {'layers': {}}
+
+
+class FileLock:
+    """
+    Exclusive, non-blocking lock on a file, held for the lifetime of the
+    process at most (e.g. so that only one configuration update runs at a
+    time).  Acquire with `acquire()`, release with `release()` or by
+    leaving a `with` block
+    """
+
+    def __init__(self, filepath):
+        """
+        Initialize lock
+
+        :param filepath: filepath of lock file
+
+        :returns: `geomet_mapproxy.util.FileLock`
+        """
+
+        self.filepath = filepath
+        self.fh = None
+
+    def acquire(self):
+        """
+        Acquires the lock, without waiting
+
+        :returns: `bool` of whether the lock was acquired
+        """
+
+        if self.fh is not None:
+            return True
+
+        fh = open(self.filepath, 'a+')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.seek(0)
+            LOGGER.warning('{} is locked by process {}'.format(
+                self.filepath, fh.read().strip() or 'unknown'))
+            fh.close()
+            return False
+
+        fh.seek(0)
+        fh.truncate()
+        fh.write(str(os.getpid()))
+        fh.flush()
+        self.fh = fh
+
+        return True
+
+    def release(self):
+        """
+        Releases the lock
+
+        :returns: `None`
+        """
+
+        if self.fh is not None:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+            self.fh.close()
+            self.fh = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise RuntimeError('{} is locked'.format(self.filepath))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -31,14 +31,75 @@ import os
 import sys
 import logging
 
-from mapproxy.wsgiapp import make_wsgi_app
+from mapproxy.wsgiapp import ReloaderApp
+
+from geomet_mapproxy.metrics import Metrics
+from geomet_mapproxy.middleware import (CapabilitiesCache, ConditionalTiles,
+                                        InfoCache, LayerRouter)
+from geomet_mapproxy.server import GracefulReloader, make_mapproxy_app
+from geomet_mapproxy.shard import get_node_config_filepath
 
 LOGGER = logging.getLogger(__name__)
 
 GEOMET_MAPPROXY_CONFIG = os.environ.get('GEOMET_MAPPROXY_CONFIG')
+GEOMET_MAPPROXY_LEGEND_TTL = int(
+    os.environ.get('GEOMET_MAPPROXY_LEGEND_TTL', 300))
+GEOMET_MAPPROXY_FEATUREINFO_TTL = int(
+    os.environ.get('GEOMET_MAPPROXY_FEATUREINFO_TTL', 0))
+GEOMET_MAPPROXY_TILE_MAX_AGE = int(
+    os.environ.get('GEOMET_MAPPROXY_TILE_MAX_AGE', 300))
+GEOMET_MAPPROXY_TILE_HISTORICAL_MAX_AGE = int(
+    os.environ.get('GEOMET_MAPPROXY_TILE_HISTORICAL_MAX_AGE', 86400))
+GEOMET_MAPPROXY_NODE = os.environ.get('GEOMET_MAPPROXY_NODE')
+GEOMET_MAPPROXY_NODE_URL = os.environ.get('GEOMET_MAPPROXY_NODE_URL')
+GEOMET_MAPPROXY_NODE_TIMEOUT = float(
+    os.environ.get('GEOMET_MAPPROXY_NODE_TIMEOUT', 30))
+GEOMET_MAPPROXY_NODE_CAPABILITIES_TTL = float(
+    os.environ.get('GEOMET_MAPPROXY_NODE_CAPABILITIES_TTL', 30))
+GEOMET_MAPPROXY_METRICS_DIR = os.environ.get('GEOMET_MAPPROXY_METRICS_DIR')
+GEOMET_MAPPROXY_METRICS_ALLOW = os.environ.get(
+    'GEOMET_MAPPROXY_METRICS_ALLOW', '127.0.0.0/8,::1').split(',')
+GEOMET_MAPPROXY_METRICS_TOKEN = os.environ.get(
+    'GEOMET_MAPPROXY_METRICS_TOKEN')
+GEOMET_MAPPROXY_TMP = os.environ.get('GEOMET_MAPPROXY_TMP', '/tmp')
+# mtime: workers check configuration mtimes on each request
+# signal: reload on demand (see geomet_mapproxy.gunicorn_config)
+GEOMET_MAPPROXY_RELOAD = os.environ.get('GEOMET_MAPPROXY_RELOAD', 'mtime')
+
 
 if GEOMET_MAPPROXY_CONFIG:
-    application = make_wsgi_app(GEOMET_MAPPROXY_CONFIG, reloader=True)
+    config = GEOMET_MAPPROXY_CONFIG
+    if GEOMET_MAPPROXY_NODE:
+        config = get_node_config_filepath(config, GEOMET_MAPPROXY_NODE)
+
+    def make_app():
+        # configurations are loaded from their compiled snapshots
+        return make_mapproxy_app(config, GEOMET_MAPPROXY_TMP)
+
+    if GEOMET_MAPPROXY_RELOAD == 'signal':
+        reloader = GracefulReloader(config, make_app)
+    else:
+        reloader = ReloaderApp(config, make_app)
+
+    application = ConditionalTiles(reloader, config,
+                                   GEOMET_MAPPROXY_TILE_MAX_AGE,
+                                   GEOMET_MAPPROXY_TILE_HISTORICAL_MAX_AGE)
+    application = InfoCache(application, GEOMET_MAPPROXY_LEGEND_TTL,
+                            GEOMET_MAPPROXY_FEATUREINFO_TTL)
+    application = CapabilitiesCache(application, config)
+
+    if GEOMET_MAPPROXY_NODE and GEOMET_MAPPROXY_NODE_URL:
+        application = LayerRouter(application, GEOMET_MAPPROXY_CONFIG,
+                                  GEOMET_MAPPROXY_NODE,
+                                  GEOMET_MAPPROXY_NODE_URL,
+                                  GEOMET_MAPPROXY_NODE_TIMEOUT,
+                                  GEOMET_MAPPROXY_NODE_CAPABILITIES_TTL)
+
+    application = Metrics(application, reloader, GEOMET_MAPPROXY_METRICS_DIR,
+                          config_filepath=GEOMET_MAPPROXY_CONFIG,
+                          allow=GEOMET_MAPPROXY_METRICS_ALLOW,
+                          token=GEOMET_MAPPROXY_METRICS_TOKEN,
+                          upstream=GEOMET_MAPPROXY_METRICS_DIR is not None)
 else:
     LOGGER.error('GEOMET_MAPPROXY_CONFIG environment variable not set')
     sys.exit(1)
@@ -0,0 +1,1779 @@
+# =================================================================
+#
+# Author: Tom Kralidis <tom.kralidis@ec.gc.ca>
+#
+# Copyright (c) 2026 Tom Kralidis
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib.util
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import socket
+import tempfile
+import threading
+import time
+from urllib.error import URLError
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from urllib.request import urlopen
+from wsgiref.util import setup_testing_defaults
+from xml.sax.saxutils import escape
+import zlib
+
+import click
+
+from geomet_mapproxy.profiling import get_peak_rss
+
+LOGGER = logging.getLogger(__name__)
+
+CONFIG_BENCHMARKS = [
+    'from_wms',
+    'from_xml',
+    'from_mapfile',
+    'create_initial_mapproxy_config',
+    'update_mapproxy_config',
+    'yaml_load',
+    'yaml_load_snapshot',
+    'yaml_dump'
+]
+
+TIME_EXTENT = '2024-01-01T00:00:00Z/2024-01-02T00:00:00Z/PT6M'
+TIME_DEFAULT = '2024-01-02T00:00:00Z'
+REFERENCE_TIME_EXTENT = '2024-01-01T00:00:00Z/2024-01-02T00:00:00Z/PT12H'
+REFERENCE_TIME_DEFAULT = '2024-01-02T00:00:00Z'
+
+SERVE_MIX = 'hit=60,miss=20,capabilities=10,time=10'
+
+# maximum duration of a configuration benchmark process (seconds)
+CONFIG_BENCHMARK_TIMEOUT = 3600
+
+# seconds after a config update during which requests are considered
+# affected by the reload (MapProxy reloads on the next request)
+RELOAD_GRACE = 1
+
+RELOAD_MODES = ['mtime', 'signal']
+
+# consecutive responses reflecting a configuration update for all workers
+# to be considered reloaded
+RELOAD_CONVERGENCE = 10
+
+WEBMERCATOR_EXTENT = 20037508.342789244
+
+CAPABILITIES_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms"
+  xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Service>
+    <Name>WMS</Name>
+    <Title>geomet-mapproxy benchmark</Title>
+    <OnlineResource xlink:href="{url}"/>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>text/xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="{url}"/></Get></HTTP>
+        </DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="{url}"/></Get></HTTP>
+        </DCPType>
+      </GetMap>
+    </Request>
+    <Exception><Format>XML</Format></Exception>
+    <Layer>
+      <Title>geomet-mapproxy benchmark</Title>
+      <CRS>EPSG:4326</CRS>
+{layers}
+    </Layer>
+  </Capability>
+</WMS_Capabilities>
+'''
+
+CAPABILITIES_LAYER_TEMPLATE = '''      <Layer queryable="1">
+        <Name>{name}</Name>
+        <Title>{name}</Title>
+        <EX_GeographicBoundingBox>
+          <westBoundLongitude>-180</westBoundLongitude>
+          <eastBoundLongitude>180</eastBoundLongitude>
+          <southBoundLatitude>-90</southBoundLatitude>
+          <northBoundLatitude>90</northBoundLatitude>
+        </EX_GeographicBoundingBox>
+        <Dimension name="time" units="ISO8601" default="{time_default}"
+          nearestValue="0">{time_extent}</Dimension>
+        <Dimension name="reference_time" units="ISO8601"
+          default="{reference_time_default}"
+          nearestValue="0">{reference_time_extent}</Dimension>
+      </Layer>'''
+
+FEATUREINFO_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<msGMLOutput xmlns:gml="http://www.opengis.net/gml">
+  <{name}_layer><{name}_feature><value>1</value></{name}_feature></{name}_layer>
+</msGMLOutput>
+'''
+
+MAPFILE_LAYER_TEMPLATE = '''  LAYER
+    NAME "{name}"
+    TYPE RASTER
+    STATUS ON
+    METADATA
+      "wms_title" "{name}"
+      "wms_timeextent" "{time_extent}"
+      "wms_timedefault" "{time_default}"
+      "wms_reference_time_extent" "{reference_time_extent}"
+      "wms_reference_time_default" "{reference_time_default}"
+    END
+  END
+'''
+
+
+def get_layer_names(size):
+    """
+    Generate synthetic layer names
+
+    :param size: number of layers
+
+    :returns: `list` of layer names
+    """
+
+    half = size // 2
+
+    return (['RADAR_BENCH_{:05d}'.format(i) for i in range(half)] +
+            ['MODEL.BENCH_{:05d}'.format(i) for i in range(size - half)])
+
+
+def get_layer_template_values(name):
+    """
+    Get template values of a synthetic layer
+
+    :param name: layer name
+
+    :returns: `dict` of template values
+    """
+
+    return {
+        'name': escape(name),
+        'time_extent': TIME_EXTENT,
+        'time_default': TIME_DEFAULT,
+        'reference_time_extent': REFERENCE_TIME_EXTENT,
+        'reference_time_default': REFERENCE_TIME_DEFAULT
+    }
+
+
+def generate_capabilities(layer_names, url='http://localhost/wms'):
+    """
+    Generate a synthetic WMS 1.3.0 Capabilities document
+
+    :param layer_names: `list` of layer names
+    :param url: service URL
+
+    :returns: `str` of Capabilities XML
+    """
+
+    layers = '\n'.join(
+        CAPABILITIES_LAYER_TEMPLATE.format(**get_layer_template_values(name))
+        for name in layer_names)
+
+    return CAPABILITIES_TEMPLATE.format(url=escape(url), layers=layers)
+
+
+def generate_mapfile(layer_names):
+    """
+    Generate a synthetic MapServer mapfile
+
+    :param layer_names: `list` of layer names
+
+    :returns: `str` of mapfile
+    """
+
+    layers = ''.join(
+        MAPFILE_LAYER_TEMPLATE.format(**get_layer_template_values(name))
+        for name in layer_names)
+
+    return 'MAP\n  NAME "geomet-mapproxy-benchmark"\n{}END\n'.format(layers)
+
+
+def generate_cache_config(layer_names, url):
+    """
+    Generate a synthetic cache configuration, with tuning profiles
+
+    :param layer_names: `list` of layer names
+    :param url: upstream WMS URL
+
+    :returns: `dict` of cache configuration
+    """
+
+    return {
+        'wms-server': {
+            'name': 'geomet-mapproxy-benchmark',
+            'url': url,
+            'layers': layer_names
+        },
+        'profiles': {
+            'default': {
+                'concurrent_requests': 4,
+                'http_timeout': 60
+            },
+            'radar': {
+                'meta_size': [2, 2],
+                'meta_buffer': 0,
+                'minimize_meta_requests': True,
+                'concurrent_requests': 8
+            }
+        },
+        'layer-profiles': [
+            {'pattern': 'RADAR_*', 'profile': 'radar'}
+        ]
+    }
+
+
+def generate_png(width, height, rgba=(0, 128, 255, 96)):
+    """
+    Generate a single colour PNG image
+
+    :param width: image width
+    :param height: image height
+    :param rgba: `tuple` of RGBA colour
+
+    :returns: `bytes` of PNG image
+    """
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + struct.pack(
+            '>I', crc)
+
+    raw = (b'\x00' + bytes(rgba) * width) * height
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', header),
+        chunk(b'IDAT', zlib.compress(raw, 6)),
+        chunk(b'IEND', b'')
+    ])
+
+
+class StubWMSHandler(BaseHTTPRequestHandler):
+    """Local stub of an upstream WMS"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.debug('Stub WMS: {}'.format(format % args))
+
+    def send_body(self, content_type, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        params = {k.lower(): v for k, v in parse_qsl(
+            urlsplit(self.path).query, keep_blank_values=True)}
+        request = params.get('request', '').lower()
+
+        if request == 'getcapabilities':
+            layer = params.get('layer')
+            if layer is None:
+                body = self.server.capabilities
+            elif layer in self.server.layer_names:
+                body = generate_capabilities(
+                    [layer], self.server.url).encode('utf-8')
+            else:
+                body = generate_capabilities(
+                    [], self.server.url).encode('utf-8')
+            self.send_body('text/xml', body)
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if request in ('getmap', 'getlegendgraphic'):
+            try:
+                size = (min(int(params.get('width', 256)), 4096),
+                        min(int(params.get('height', 256)), 4096))
+            except ValueError:
+                size = (256, 256)
+            with self.server.lock:
+                if size not in self.server.images:
+                    self.server.images[size] = generate_png(*size)
+                body = self.server.images[size]
+            self.send_body('image/png', body)
+        elif request == 'getfeatureinfo':
+            name = escape(params.get('query_layers', 'layer'))
+            body = FEATUREINFO_TEMPLATE.format(name=name).encode('utf-8')
+            self.send_body('application/vnd.ogc.gml', body)
+        else:
+            self.send_body('text/plain', b'Not supported', 400)
+
+
+class StubWMS:
+    """Local stub of an upstream WMS, served from a background thread"""
+
+    def __init__(self, layer_names, latency=0, handler=StubWMSHandler):
+        """
+        Initialize stub WMS
+
+        :param layer_names: `list` of layer names
+        :param latency: simulated latency of map requests (seconds)
+        :param handler: HTTP request handler class
+
+        :returns: `bench.StubWMS`
+        """
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/wms'.format(self.server.server_port)
+
+        self.server.url = self.url
+        self.server.latency = latency
+        self.server.layer_names = set(layer_names)
+        self.server.images = {}
+        self.server.lock = threading.Lock()
+        self.server.capabilities = generate_capabilities(
+            layer_names, self.url).encode('utf-8')
+
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def prepare_workdir(workdir, layer_names, url):
+    """
+    Write synthetic benchmark inputs to a working directory
+
+    :param workdir: working directory
+    :param layer_names: `list` of layer names
+    :param url: upstream WMS URL
+
+    :returns: `dict` of environment variables pointing to the inputs
+    """
+
+    import yaml
+
+    mapfile = os.path.join(workdir, 'geomet-en.map')
+    with open(mapfile, 'w') as fh:
+        fh.write(generate_mapfile(layer_names))
+
+    for name in layer_names:
+        filepath = os.path.join(workdir, 'geomet-{}-en.map'.format(name))
+        with open(filepath, 'w') as fh:
+            fh.write(generate_mapfile([name]))
+
+    xml = os.path.join(workdir, 'capabilities.xml')
+    with open(xml, 'w') as fh:
+        fh.write(generate_capabilities(layer_names, url))
+
+    cache_config = os.path.join(workdir, 'cache-config.yml')
+    with open(cache_config, 'w') as fh:
+        yaml.dump(generate_cache_config(layer_names, url), fh)
+
+    return {
+        'GEOMET_MAPPROXY_LOGGING_LOGLEVEL': 'ERROR',
+        'GEOMET_MAPPROXY_CACHE_DATA': os.path.join(workdir, 'cache_data'),
+        'GEOMET_MAPPROXY_CACHE_WMS': url,
+        'GEOMET_MAPPROXY_CACHE_MAPFILE': mapfile,
+        'GEOMET_MAPPROXY_CACHE_XML': xml,
+        'GEOMET_MAPPROXY_CACHE_CONFIG': cache_config,
+        'GEOMET_MAPPROXY_CONFIG': os.path.join(workdir, 'config.yml'),
+        'GEOMET_MAPPROXY_URL': 'http://localhost',
+        'GEOMET_MAPPROXY_TMP': workdir
+    }
+
+
+def get_benchmark_func(benchmark, layer_names):
+    """
+    Set up a configuration pipeline benchmark
+
+    :param benchmark: benchmark name
+    :param layer_names: `list` of layer names
+
+    :returns: callable of benchmark
+    """
+
+    from geomet_mapproxy.config import (
+        create_initial_mapproxy_config, from_mapfile, from_wms, from_xml,
+        update_mapproxy_config)
+    from geomet_mapproxy.env import (GEOMET_MAPPROXY_CACHE_CONFIG,
+                                     GEOMET_MAPPROXY_CONFIG,
+                                     GEOMET_MAPPROXY_TMP)
+    from geomet_mapproxy.util import (write_config_snapshot, yaml_dump,
+                                      yaml_load, yaml_load_snapshot)
+
+    if benchmark == 'from_wms':
+        return lambda: from_wms(layer_names)
+    elif benchmark == 'from_xml':
+        return lambda: from_xml(layer_names)
+    elif benchmark == 'from_mapfile':
+        return lambda: from_mapfile(layer_names)
+
+    with open(GEOMET_MAPPROXY_CACHE_CONFIG) as fh:
+        cache_config = yaml_load(fh)
+
+    if benchmark == 'create_initial_mapproxy_config':
+        return lambda: create_initial_mapproxy_config(cache_config, 'xml')
+
+    mapproxy_config = create_initial_mapproxy_config(cache_config, 'xml')
+
+    if benchmark == 'update_mapproxy_config':
+        return lambda: update_mapproxy_config(mapproxy_config, layer_names,
+                                              'xml')
+
+    with open(GEOMET_MAPPROXY_CONFIG, 'w') as fh:
+        yaml_dump(mapproxy_config, fh)
+
+    if benchmark == 'yaml_load':
+        def func():
+            with open(GEOMET_MAPPROXY_CONFIG) as fh:
+                return yaml_load(fh)
+        return func
+    elif benchmark == 'yaml_load_snapshot':
+        write_config_snapshot(GEOMET_MAPPROXY_CONFIG, GEOMET_MAPPROXY_TMP,
+                              mapproxy_config)
+        return lambda: yaml_load_snapshot(GEOMET_MAPPROXY_CONFIG,
+                                          GEOMET_MAPPROXY_TMP)
+    elif benchmark == 'yaml_dump':
+        def func():
+            with open(os.devnull, 'w') as fh:
+                yaml_dump(mapproxy_config, fh)
+        return func
+
+    raise RuntimeError('Unknown benchmark {}'.format(benchmark))
+
+
+def run_benchmark(benchmark, layer_names, repeat, queue):
+    """
+    Run a benchmark (in a dedicated process) and report timings and peak
+    memory
+
+    :param benchmark: benchmark name
+    :param layer_names: `list` of layer names
+    :param repeat: number of timed runs
+    :param queue: `multiprocessing.Queue` to put the result on
+
+    :returns: `None`
+    """
+
+    try:
+        func = get_benchmark_func(benchmark, layer_names)
+        baseline_rss = get_peak_rss()
+
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+
+        # peak memory growth over the set up process
+        peak_memory = get_peak_rss() - baseline_rss
+
+        queue.put({
+            'benchmark': benchmark,
+            'layers': len(layer_names),
+            'repeat': repeat,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'peak_memory': peak_memory
+        })
+    except Exception as err:
+        queue.put({
+            'benchmark': benchmark,
+            'layers': len(layer_names),
+            'error': str(err)
+        })
+
+
+def get_benchmark_result(process, queue, timeout):
+    """
+    Wait for the result of a benchmark process, terminating it on timeout
+
+    :param process: `multiprocessing.Process` running `run_benchmark`
+    :param queue: `multiprocessing.Queue` the result is put on
+    :param timeout: maximum duration of the process (seconds)
+
+    :returns: `dict` of result, or `str` of error
+    """
+
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+
+        if not process.is_alive():
+            # the result may have been flushed as the process exited
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                return 'Benchmark process exited with status {}'.format(
+                    process.exitcode)
+
+        if time.monotonic() >= deadline:
+            process.terminate()
+            return 'Benchmark process timed out after {}s'.format(timeout)
+
+
+def run_config_benchmarks(sizes, benchmarks=CONFIG_BENCHMARKS, repeat=3,
+                          timeout=CONFIG_BENCHMARK_TIMEOUT):
+    """
+    Run configuration pipeline benchmarks against synthetic inputs
+
+    :param sizes: `list` of numbers of layers
+    :param benchmarks: `list` of benchmark names
+    :param repeat: number of timed runs per benchmark
+    :param timeout: maximum duration of a benchmark (seconds)
+
+    :returns: `dict` of benchmark results
+    """
+
+    # fresh interpreters so that each benchmark picks up its environment
+    # and peak memory is not polluted by other benchmarks
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for size in sizes:
+        layer_names = get_layer_names(size)
+
+        with tempfile.TemporaryDirectory() as workdir, \
+                StubWMS(layer_names) as stub:
+            env = prepare_workdir(workdir, layer_names, stub.url)
+
+            for benchmark in benchmarks:
+                LOGGER.debug('Running {} ({} layers)'.format(benchmark, size))
+                environ = os.environ.copy()
+                os.environ.update(env)
+                os.environ.pop('GEOMET_MAPPROXY_LOGGING_LOGFILE', None)
+                try:
+                    queue = context.Queue()
+                    process = context.Process(
+                        target=run_benchmark,
+                        args=(benchmark, layer_names, repeat, queue))
+                    process.start()
+                    result = get_benchmark_result(process, queue, timeout)
+                    process.join()
+                finally:
+                    os.environ.clear()
+                    os.environ.update(environ)
+
+                if not isinstance(result, dict):
+                    LOGGER.error('{} ({} layers): {}'.format(
+                        benchmark, size, result))
+                    result = {
+                        'benchmark': benchmark,
+                        'layers': size,
+                        'error': result
+                    }
+
+                results.append(result)
+
+    return {
+        'timestamp': datetime.now(timezone.utc).strftime(
+            '%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def compare_results(results, baseline):
+    """
+    Compare benchmark results against a baseline
+
+    :param results: `dict` of benchmark results
+    :param baseline: `dict` of baseline benchmark results
+
+    :returns: `dict` of median timing ratio (result / baseline) and peak
+              memory difference (bytes) keyed by (benchmark, layers)
+    """
+
+    baseline_results = {(r['benchmark'], r['layers']): r
+                        for r in baseline['results'] if 'error' not in r}
+    ratios = {}
+
+    for result in results['results']:
+        key = (result['benchmark'], result['layers'])
+        if 'error' in result or key not in baseline_results:
+            continue
+
+        ratios[key] = {
+            'median': result['median'] / baseline_results[key]['median'],
+            'peak_memory': (result['peak_memory'] -
+                            baseline_results[key]['peak_memory'])
+        }
+
+    return ratios
+
+
+def get_percentile(values, percentile):
+    """
+    Derive a percentile (nearest rank) of values
+
+    :param values: `list` of values
+    :param percentile: percentile (0-100)
+
+    :returns: percentile value, or `None` if no values
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(int(math.ceil(percentile / 100.0 * len(values))), 1)
+
+    return values[rank - 1]
+
+
+def get_latency_summary(latencies):
+    """
+    Summarize request latencies
+
+    :param latencies: `list` of latencies (seconds)
+
+    :returns: `dict` of latency summary
+    """
+
+    return {
+        'count': len(latencies),
+        'p50': get_percentile(latencies, 50),
+        'p95': get_percentile(latencies, 95),
+        'p99': get_percentile(latencies, 99)
+    }
+
+
+def get_getmap_query(layer, z, x, y, time_=None):
+    """
+    Derive the query string of a GetMap request of a web mercator tile
+
+    :param layer: layer name
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row (from the top)
+    :param time_: `str` of TIME value (optional)
+
+    :returns: `str` of query string
+    """
+
+    size = 2 * WEBMERCATOR_EXTENT / 2 ** z
+    minx = -WEBMERCATOR_EXTENT + x * size
+    maxy = WEBMERCATOR_EXTENT - y * size
+
+    params = {
+        'SERVICE': 'WMS',
+        'VERSION': '1.3.0',
+        'REQUEST': 'GetMap',
+        'FORMAT': 'image/png',
+        'TRANSPARENT': 'true',
+        'LAYERS': layer,
+        'WIDTH': 256,
+        'HEIGHT': 256,
+        'CRS': 'EPSG:3857',
+        'STYLES': '',
+        'BBOX': ','.join('{:.6f}'.format(v) for v in
+                         [minx, maxy - size, minx + size, maxy])
+    }
+
+    if time_ is not None:
+        params['TIME'] = time_
+
+    return urlencode(params)
+
+
+def generate_request_mix(layer_names, mix=SERVE_MIX, count=1000, seed=0):
+    """
+    Generate a synthetic request mix
+
+    Request kinds are `hit` (GetMap of a small hot tile set), `miss`
+    (GetMap of random tiles at high zoom levels), `capabilities`
+    (GetCapabilities) and `time` (GetMap of the hot tile set with TIME
+    variants)
+
+    :param layer_names: `list` of layer names
+    :param mix: `str` of request kind weights (kind=weight,...)
+    :param count: number of requests
+    :param seed: random seed (for reproducible mixes)
+
+    :returns: `list` of `tuple` of request kind and query string
+    """
+
+    weights = {}
+    for kind_weight in mix.split(','):
+        kind, _, weight = kind_weight.partition('=')
+        if kind.strip() not in ('hit', 'miss', 'capabilities', 'time'):
+            raise RuntimeError('Unknown request kind {}'.format(kind))
+        weights[kind.strip()] = float(weight or 1)
+
+    rng = random.Random(seed)
+    kinds = list(weights.keys())
+    hot_layers = layer_names[:max(1, len(layer_names) // 10)]
+    hot_tiles = [(3, x, y) for x in range(1, 3) for y in range(1, 3)]
+    times = ['2024-01-01T{:02d}:{:02d}:00Z'.format(h, m)
+             for h in range(0, 24, 3) for m in (0, 30)]
+
+    requests = []
+    for kind in rng.choices(kinds, [weights[k] for k in kinds], k=count):
+        if kind == 'capabilities':
+            query = 'SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
+        elif kind == 'miss':
+            z = rng.randint(10, 16)
+            query = get_getmap_query(rng.choice(layer_names), z,
+                                     rng.randrange(2 ** z),
+                                     rng.randrange(2 ** z))
+        else:
+            z, x, y = rng.choice(hot_tiles)
+            time_ = rng.choice(times) if kind == 'time' else None
+            query = get_getmap_query(rng.choice(hot_layers), z, x, y, time_)
+
+        requests.append((kind, query))
+
+    return requests
+
+
+def read_request_log(filepath):
+    """
+    Read recorded requests (one URL or query string per line)
+
+    :param filepath: filepath to recorded requests
+
+    :returns: `tuple` of `list` of request kind and query string tuples,
+              and `list` of layer names
+    """
+
+    requests = []
+    layer_names = []
+
+    with open(filepath) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            query = line.split('?', 1)[1] if '?' in line else line
+            params = {k.lower(): v for k, v in parse_qsl(
+                query, keep_blank_values=True)}
+
+            kind = params.get('request', 'unknown').lower()
+            if 'time' in params:
+                kind = '{}+time'.format(kind)
+
+            for layer in (params.get('layers') or
+                          params.get('layer') or '').split(','):
+                if layer and layer not in layer_names:
+                    layer_names.append(layer)
+
+            requests.append((kind, query))
+
+    return requests, layer_names
+
+
+def load_wsgi_module(env):
+    """
+    Load a new instance of the geomet-mapproxy WSGI module in-process,
+    leaving `os.environ` and `sys.modules` untouched
+
+    :param env: `dict` of environment variables to load the module with
+
+    :returns: module of `geomet_mapproxy.wsgi` (`application`, `reloader`)
+    """
+
+    spec = importlib.util.find_spec('geomet_mapproxy.wsgi')
+    module = importlib.util.module_from_spec(spec)
+
+    environ = os.environ.copy()
+    os.environ.update(env)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+    return module
+
+
+def call_wsgi_application(application, query):
+    """
+    Call a WSGI application with a GET request
+
+    :param application: WSGI application
+    :param query: `str` of query string
+
+    :returns: `bool` of whether the request was successful
+    """
+
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/service',
+        'QUERY_STRING': query
+    }
+    setup_testing_defaults(environ)
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = {k.lower(): v for k, v in headers}
+
+    app_iter = application(environ, start_response)
+    try:
+        for chunk in app_iter:
+            pass
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    if response['status'][0] not in ('2', '3'):
+        return False
+
+    # MapProxy reports WMS errors as service exceptions
+    content_type = response['headers'].get('content-type', '')
+    return 'se_xml' not in content_type
+
+
+def run_config_updates(env, interval, stop, reloads, on_update=None):
+    """
+    Run `config update` periodically until stopped, advancing the TIME
+    default of the Capabilities XML before each update so that the
+    configuration changes
+
+    :param env: `dict` of environment variables
+    :param interval: interval between updates (seconds)
+    :param stop: `threading.Event` to stop updates
+    :param reloads: `list` to append update (start, end) times to
+    :param on_update: callable invoked after each update (optional)
+
+    :returns: `None`
+    """
+
+    environ = os.environ.copy()
+    environ.update(env)
+    cmd = [sys.executable, '-c',
+           'from geomet_mapproxy import cli; cli()',
+           'config', 'update', '--mode', 'xml']
+
+    capabilities_xml = env['GEOMET_MAPPROXY_CACHE_XML']
+    time_default = TIME_DEFAULT
+
+    while not stop.wait(interval):
+        new_time_default = (
+            datetime.strptime(time_default, '%Y-%m-%dT%H:%M:%SZ') +
+            timedelta(minutes=6)
+        ).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with open(capabilities_xml) as fh:
+            xml = fh.read()
+        with open(capabilities_xml, 'w') as fh:
+            fh.write(xml.replace(time_default, new_time_default))
+        time_default = new_time_default
+
+        start = time.perf_counter()
+        subprocess.run(cmd, env=environ, stdout=subprocess.DEVNULL,
+                       check=False)
+        if on_update is not None:
+            on_update()
+        reloads.append((start, time.perf_counter()))
+
+
+def run_serve_benchmark(requests, layer_names, concurrency=4,
+                        reload_interval=0, upstream_latency=0,
+                        reload_mode='mtime'):
+    """
+    Run a load test of the WSGI application against a stub upstream WMS
+
+    :param requests: `list` of request kind and query string tuples
+    :param layer_names: `list` of layer names
+    :param concurrency: number of concurrent clients
+    :param reload_interval: interval between `config update` runs during
+                            the load test (seconds, 0 to disable)
+    :param upstream_latency: simulated upstream latency (seconds)
+    :param reload_mode: reload mode (mtime: configuration mtimes checked
+                        on each request, signal: application rebuilt after
+                        each update, as on SIGHUP)
+
+    :returns: `dict` of load test results
+    """
+
+    with tempfile.TemporaryDirectory() as workdir, \
+            StubWMS(layer_names, upstream_latency) as stub:
+        env = prepare_workdir(workdir, layer_names, stub.url)
+        env['GEOMET_MAPPROXY_RELOAD'] = reload_mode
+        environ = os.environ.copy()
+        environ.update(env)
+
+        LOGGER.debug('Creating MapProxy configuration')
+        subprocess.run([sys.executable, '-c',
+                        'from geomet_mapproxy import cli; cli()',
+                        'config', 'create', '--mode', 'xml'],
+                       env=environ, stdout=subprocess.DEVNULL, check=True)
+
+        module = load_wsgi_module(env)
+        application = module.application
+
+        on_update = None
+        if reload_mode == 'signal':
+            on_update = module.reloader.reload
+
+        samples = []
+        lock = threading.Lock()
+        queue = iter(requests)
+
+        def client():
+            while True:
+                with lock:
+                    request = next(queue, None)
+                if request is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    ok = call_wsgi_application(application, request[1])
+                except Exception as err:
+                    LOGGER.debug('Request failed: {}'.format(err))
+                    ok = False
+                samples.append((request[0], start, time.perf_counter(), ok))
+
+        stop = threading.Event()
+        reloads = []
+        reloader = None
+        if reload_interval > 0:
+            reloader = threading.Thread(
+                target=run_config_updates,
+                args=(env, reload_interval, stop, reloads, on_update),
+                daemon=True)
+            reloader.start()
+
+        clients = [threading.Thread(target=client)
+                   for i in range(concurrency)]
+
+        start = time.perf_counter()
+        for client_ in clients:
+            client_.start()
+        for client_ in clients:
+            client_.join()
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        if reloader is not None:
+            reloader.join()
+
+    kinds = {}
+    for kind, start_, end, ok in samples:
+        kinds.setdefault(kind, {'latencies': [], 'errors': 0})
+        kinds[kind]['latencies'].append(end - start_)
+        if not ok:
+            kinds[kind]['errors'] += 1
+
+    results = {
+        'requests': len(samples),
+        'errors': sum(k['errors'] for k in kinds.values()),
+        'concurrency': concurrency,
+        'reload_mode': reload_mode,
+        'elapsed': elapsed,
+        'throughput': len(samples) / elapsed if elapsed else 0,
+        'latency': get_latency_summary([s[2] - s[1] for s in samples]),
+        'kinds': {}
+    }
+
+    for kind, values in sorted(kinds.items()):
+        results['kinds'][kind] = get_latency_summary(values['latencies'])
+        results['kinds'][kind]['errors'] = values['errors']
+
+    if reload_interval > 0:
+        reloading = []
+        steady = []
+        for kind, start_, end, ok in samples:
+            if any(r_start <= end and start_ <= r_end + RELOAD_GRACE
+                   for r_start, r_end in reloads):
+                reloading.append(end - start_)
+            else:
+                steady.append(end - start_)
+
+        results['reload'] = {
+            'reloads': len(reloads),
+            'update_duration': (statistics.mean(r[1] - r[0] for r in reloads)
+                                if reloads else None),
+            'steady': get_latency_summary(steady),
+            'reloading': get_latency_summary(reloading)
+        }
+
+    return results
+
+
+def get_free_port():
+    """
+    Get a free local TCP port
+
+    :returns: `int` of port
+    """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def http_get(url, timeout=30):
+    """
+    Perform an HTTP GET request
+
+    :param url: URL
+    :param timeout: timeout (seconds)
+
+    :returns: `tuple` of status code and `bytes` of response body
+    """
+
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.status, response.read()
+    except URLError as err:
+        status = getattr(err, 'code', None)
+        return status, b''
+    except OSError:
+        return None, b''
+
+
+def get_child_pids(pid):
+    """
+    Get the child processes of a process (Linux)
+
+    :param pid: process id
+
+    :returns: `list` of process ids
+    """
+
+    pids = []
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as fh:
+                # ppid is the second field after the (command name)
+                ppid = int(fh.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+
+    return sorted(pids)
+
+
+def get_process_memory(pid):
+    """
+    Get the memory usage of a process (Linux)
+
+    :param pid: process id
+
+    :returns: `dict` of resident (rss), proportional (pss) and private
+              (uss) set sizes (bytes)
+    """
+
+    memory = {'rss': 0, 'pss': 0, 'uss': 0}
+    keys = {
+        'Rss': ['rss'],
+        'Pss': ['pss'],
+        'Private_Clean': ['uss'],
+        'Private_Dirty': ['uss']
+    }
+
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fh:
+        for line in fh:
+            key, _, value = line.partition(':')
+            for name in keys.get(key, []):
+                memory[name] += int(value.split()[0]) * 1024
+
+    return memory
+
+
+def get_server_memory(pid):
+    """
+    Get the memory usage of a server process and its workers (Linux)
+
+    :param pid: process id of server (master) process
+
+    :returns: `dict` of number of workers, mean worker resident,
+              proportional and private set sizes, and total proportional
+              set size including the master process (bytes)
+    """
+
+    memory = [get_process_memory(pid_) for pid_ in get_child_pids(pid)]
+    master = get_process_memory(pid)
+
+    return {
+        'workers': len(memory),
+        'worker_rss': statistics.mean(m['rss'] for m in memory),
+        'worker_pss': statistics.mean(m['pss'] for m in memory),
+        'worker_uss': statistics.mean(m['uss'] for m in memory),
+        'total_pss': master['pss'] + sum(m['pss'] for m in memory)
+    }
+
+
+def start_gunicorn(environ, workers=4, threads=1, mode='mtime', timeout=60):
+    """
+    Start gunicorn serving the WSGI application, waiting until it responds
+
+    :param environ: `dict` of environment variables
+    :param workers: number of worker processes
+    :param threads: number of threads per worker process (gthread worker
+                    class if more than 1)
+    :param mode: reload mode (see `geomet_mapproxy.wsgi`)
+    :param timeout: timeout of server start up (seconds)
+
+    :returns: `tuple` of `subprocess.Popen` of server, service URL and
+              start up time (seconds)
+    """
+
+    port = get_free_port()
+    url = 'http://127.0.0.1:{}/service'.format(port)
+    cmd = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+           '--threads', str(threads), '--bind', '127.0.0.1:{}'.format(port),
+           '--graceful-timeout', str(timeout)]
+    if mode == 'signal':
+        cmd.extend(['--config', 'python:geomet_mapproxy.gunicorn_config'])
+    cmd.append('geomet_mapproxy.wsgi:application')
+
+    capabilities = '{}?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
+    capabilities = capabilities.format(url)
+
+    server = subprocess.Popen(cmd, env=environ, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    start = time.perf_counter()
+    while http_get(capabilities, 5)[0] != 200:
+        if server.poll() is not None or \
+                time.perf_counter() - start > timeout:
+            server.terminate()
+            server.wait(timeout)
+            raise RuntimeError('gunicorn did not start')
+        time.sleep(0.2)
+
+    return server, url, time.perf_counter() - start
+
+
+def run_reload_benchmark(layer_names, mode='mtime', workers=4, reloads=3,
+                         concurrency=4, timeout=60):
+    """
+    Measure worker memory and configuration reload latency of the WSGI
+    application served by gunicorn
+
+    :param layer_names: `list` of layer names
+    :param mode: reload mode (mtime: per-request configuration mtime checks
+                 in each worker, signal: preloaded application rebuilt in the
+                 master process on configuration changes)
+    :param workers: number of gunicorn workers
+    :param reloads: number of configuration updates
+    :param concurrency: number of concurrent GetMap clients during updates
+    :param timeout: timeout of server start up and reloads (seconds)
+
+    :returns: `dict` of benchmark results
+    """
+
+    with tempfile.TemporaryDirectory() as workdir, \
+            StubWMS(layer_names) as stub:
+        env = prepare_workdir(workdir, layer_names, stub.url)
+        env['GEOMET_MAPPROXY_RELOAD'] = mode
+        env['GEOMET_MAPPROXY_RELOAD_INTERVAL'] = '0.2'
+        env['GEOMET_MAPPROXY_METRICS_DIR'] = os.path.join(workdir, 'metrics')
+        environ = os.environ.copy()
+        environ.update(env)
+        cli = [sys.executable, '-c', 'from geomet_mapproxy import cli; cli()']
+
+        subprocess.run(cli + ['config', 'create', '--mode', 'xml'],
+                       env=environ, stdout=subprocess.DEVNULL, check=True)
+
+        server, url, startup = start_gunicorn(environ, workers, 1, mode,
+                                              timeout)
+        capabilities = '{}?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
+        capabilities = capabilities.format(url)
+
+        try:
+            # warm up all workers
+            queries = [get_getmap_query(layer, 2, x, 1)
+                       for layer in layer_names for x in range(4)]
+            for query in queries * 2:
+                http_get('{}?{}'.format(url, query))
+            for i in range(workers * 4):
+                http_get(capabilities)
+
+            memory_before = get_server_memory(server.pid)
+
+            samples = []
+            stop = threading.Event()
+
+            def client(i):
+                while not stop.is_set():
+                    query = queries[i % len(queries)]
+                    i += 1
+                    start_ = time.perf_counter()
+                    status = http_get('{}?{}'.format(url, query))[0]
+                    samples.append((start_, time.perf_counter(),
+                                    status == 200))
+
+            clients = [threading.Thread(target=client, args=(i,))
+                       for i in range(concurrency)]
+            for client_ in clients:
+                client_.start()
+
+            latencies = []
+            windows = []
+            capabilities_xml = env['GEOMET_MAPPROXY_CACHE_XML']
+            time_default = TIME_DEFAULT
+
+            try:
+                for i in range(reloads):
+                    time.sleep(1)
+                    new_time_default = (
+                        datetime.strptime(TIME_DEFAULT, '%Y-%m-%dT%H:%M:%SZ') +
+                        timedelta(minutes=6 * (i + 1))
+                    ).strftime('%Y-%m-%dT%H:%M:%SZ')
+                    with open(capabilities_xml) as fh:
+                        xml = fh.read()
+                    with open(capabilities_xml, 'w') as fh:
+                        fh.write(xml.replace(time_default, new_time_default))
+                    time_default = new_time_default
+
+                    subprocess.run(cli + ['config', 'update', '--mode', 'xml'],
+                                   env=environ, stdout=subprocess.DEVNULL,
+                                   check=True)
+                    start = time.perf_counter()
+
+                    expected = new_time_default.encode('utf-8')
+                    converged = 0
+                    while converged < RELOAD_CONVERGENCE:
+                        if time.perf_counter() - start > timeout:
+                            raise RuntimeError('Reload timed out')
+                        if expected in http_get(capabilities)[1]:
+                            converged += 1
+                        else:
+                            converged = 0
+
+                    latencies.append(time.perf_counter() - start)
+                    windows.append((start, time.perf_counter()))
+            finally:
+                stop.set()
+                for client_ in clients:
+                    client_.join()
+
+            memory_after = get_server_memory(server.pid)
+
+            # application rebuilds, as recorded by all processes
+            rebuilds = {}
+            metrics = http_get(url.replace('/service', '/metrics'))[1]
+            for line in metrics.decode('utf-8').splitlines():
+                if line.startswith('geomet_mapproxy_config_reload_duration'):
+                    name, value = line.rsplit(' ', 1)
+                    rebuilds[name.rsplit('_', 1)[1]] = float(value)
+        finally:
+            server.terminate()
+            server.wait(timeout)
+
+    reloading = [end - start_ for start_, end, ok in samples
+                 if any(w_start <= end and start_ <= w_end
+                        for w_start, w_end in windows)]
+
+    return {
+        'mode': mode,
+        'layers': len(layer_names),
+        'workers': workers,
+        'startup': startup,
+        'memory': memory_before,
+        'memory_after_reloads': memory_after,
+        'reload_latency': get_latency_summary(latencies),
+        'reload_latency_max': max(latencies),
+        'rebuilds': rebuilds.get('count', 0),
+        'rebuild_duration': rebuilds.get('sum', 0),
+        'reloading': get_latency_summary(reloading),
+        'reloading_max': max(reloading) if reloading else None,
+        'errors': sum(1 for sample in samples if not sample[2])
+    }
+
+
+def parse_layouts(layouts):
+    """
+    Parse worker layouts
+
+    :param layouts: `str` of CSV list of processes x threads (e.g. `8x1,4x2`)
+
+    :returns: `list` of (processes, threads) tuples
+    """
+
+    layouts_ = []
+
+    for layout in layouts.split(','):
+        processes, _, threads = layout.strip().lower().partition('x')
+        layout_ = (int(processes), int(threads or 1))
+        if min(layout_) < 1:
+            raise ValueError('Invalid layout {}'.format(layout))
+        layouts_.append(layout_)
+
+    return layouts_
+
+
+def run_threads_benchmark(layer_names, requests, layouts, mode='mtime',
+                          reload_interval=0, upstream_latency=0.01,
+                          timeout=60):
+    """
+    Compare memory usage and throughput of the WSGI application served by
+    gunicorn with worker processes and threads, with one client per
+    worker thread
+
+    :param layer_names: `list` of layer names
+    :param requests: `list` of request kind and query string tuples
+    :param layouts: `list` of (processes, threads) tuples
+    :param mode: reload mode (see `geomet_mapproxy.wsgi`)
+    :param reload_interval: interval between `config update` runs during
+                            the load test (seconds, 0 to disable)
+    :param upstream_latency: simulated upstream latency (seconds)
+    :param timeout: timeout of server start up (seconds)
+
+    :returns: `list` of `dict` of results per layout
+    """
+
+    results = []
+
+    for processes, threads in layouts:
+        # fresh cache per layout, for the same share of misses
+        with tempfile.TemporaryDirectory() as workdir, \
+                StubWMS(layer_names, upstream_latency) as stub:
+            env = prepare_workdir(workdir, layer_names, stub.url)
+            env['GEOMET_MAPPROXY_RELOAD'] = mode
+            env['GEOMET_MAPPROXY_RELOAD_INTERVAL'] = '0.2'
+            environ = os.environ.copy()
+            environ.update(env)
+
+            subprocess.run([sys.executable, '-c',
+                            'from geomet_mapproxy import cli; cli()',
+                            'config', 'create', '--mode', 'xml'],
+                           env=environ, stdout=subprocess.DEVNULL,
+                           check=True)
+
+            server, url, startup = start_gunicorn(environ, processes, threads,
+                                                  mode, timeout)
+            try:
+                samples = []
+                lock = threading.Lock()
+                queue = iter(requests)
+
+                def client():
+                    while True:
+                        with lock:
+                            request = next(queue, None)
+                        if request is None:
+                            return
+                        start_ = time.perf_counter()
+                        status, body = http_get('{}?{}'.format(
+                            url, request[1]))
+                        # MapProxy reports WMS errors as service exceptions
+                        ok = status == 200 and (
+                            request[0] == 'capabilities' or
+                            body.startswith(b'\x89PNG'))
+                        samples.append((start_, time.perf_counter(), ok))
+
+                stop = threading.Event()
+                reloads = []
+                updater = None
+                if reload_interval > 0:
+                    updater = threading.Thread(
+                        target=run_config_updates,
+                        args=(env, reload_interval, stop, reloads),
+                        daemon=True)
+                    updater.start()
+
+                clients = [threading.Thread(target=client)
+                           for i in range(processes * threads)]
+
+                start = time.perf_counter()
+                for client_ in clients:
+                    client_.start()
+                for client_ in clients:
+                    client_.join()
+                elapsed = time.perf_counter() - start
+
+                stop.set()
+                if updater is not None:
+                    updater.join()
+
+                memory = get_server_memory(server.pid)
+            finally:
+                server.terminate()
+                server.wait(timeout)
+
+        results.append({
+            'processes': processes,
+            'threads': threads,
+            'mode': mode,
+            'startup': startup,
+            'memory': memory,
+            'pss_per_thread': memory['total_pss'] / (processes * threads),
+            'requests': len(samples),
+            'errors': sum(1 for sample in samples if not sample[2]),
+            'reloads': len(reloads),
+            'elapsed': elapsed,
+            'throughput': len(samples) / elapsed if elapsed else 0,
+            'latency': get_latency_summary([end - start_ for start_, end, ok
+                                            in samples])
+        })
+
+    return results
+
+
+@click.group()
+def bench():
+    """Benchmark geomet-mapproxy"""
+    pass
+
+
+@click.command('config')
+@click.pass_context
+@click.option('--sizes', '-s', 'sizes', default='10,100,1000,10000',
+              help='CSV list of numbers of layers')
+@click.option('--benchmarks', '-b', 'benchmarks', default=None,
+              help='CSV list of benchmarks (default all: {})'.format(
+                  ','.join(CONFIG_BENCHMARKS)))
+@click.option('--repeat', '-r', 'repeat', type=click.IntRange(min=1),
+              default=3, help='Number of timed runs per benchmark')
+@click.option('--output', '-o', 'output', type=click.Path(dir_okay=False),
+              default=None, help='Write results to JSON file')
+@click.option('--compare', '-c', 'compare',
+              type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Compare with results of a previous run (JSON file)')
+@click.option('--timeout', '-t', 'timeout', type=click.IntRange(min=1),
+              default=CONFIG_BENCHMARK_TIMEOUT,
+              help='Maximum duration of a benchmark (seconds)')
+def config_(ctx, sizes, benchmarks, repeat, output, compare, timeout):
+    """Benchmark the configuration pipeline"""
+
+    sizes_ = [int(x) for x in sizes.split(',')]
+
+    if benchmarks is None:
+        benchmarks_ = CONFIG_BENCHMARKS
+    else:
+        benchmarks_ = [x.strip() for x in benchmarks.split(',')]
+        for benchmark in benchmarks_:
+            if benchmark not in CONFIG_BENCHMARKS:
+                msg = 'Unknown benchmark {}'.format(benchmark)
+                raise click.ClickException(msg)
+
+    results = run_config_benchmarks(sizes_, benchmarks_, repeat, timeout)
+
+    ratios = {}
+    if compare is not None:
+        with open(compare) as fh:
+            ratios = compare_results(results, json.load(fh))
+
+    click.echo('{:<32} {:>7} {:>10} {:>10} {:>12} {:>20}'.format(
+        'benchmark', 'layers', 'min (s)', 'median (s)', 'peak (MiB)',
+        'vs baseline (%/MiB)'))
+
+    for result in results['results']:
+        if 'error' in result:
+            click.echo('{:<32} {:>7} ERROR: {}'.format(
+                result['benchmark'], result['layers'], result['error']))
+            continue
+
+        ratio = ratios.get((result['benchmark'], result['layers']))
+        delta = ''
+        if ratio is not None:
+            delta = '{:+.1%} / {:+.2f}'.format(
+                ratio['median'] - 1, ratio['peak_memory'] / 1048576)
+
+        click.echo('{:<32} {:>7} {:>10.4f} {:>10.4f} {:>12.2f} {:>20}'.format(
+            result['benchmark'], result['layers'], result['min'],
+            result['median'], result['peak_memory'] / 1048576, delta))
+
+    if output is not None:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        click.echo('Results written to {}'.format(output))
+
+    errors = [x for x in results['results'] if 'error' in x]
+    if errors:
+        raise click.ClickException('{} benchmarks failed'.format(len(errors)))
+
+
+def format_latency_summary(name, summary, errors=''):
+    """
+    Format a latency summary as a table row
+
+    :param name: row name
+    :param summary: `dict` of latency summary
+    :param errors: number of errors
+
+    :returns: `str` of table row
+    """
+
+    values = []
+    for key in ['p50', 'p95', 'p99']:
+        if summary[key] is None:
+            values.append('-')
+        else:
+            values.append('{:.2f}'.format(summary[key] * 1000))
+
+    return '{:<24} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+        name, summary['count'], errors, *values)
+
+
+@click.command()
+@click.pass_context
+@click.option('--layers', '-l', 'layers', type=click.IntRange(min=1),
+              default=10, help='Number of synthetic layers')
+@click.option('--mix', '-m', 'mix', default=SERVE_MIX,
+              help='Synthetic request mix (kind=weight,...) of hit, miss, '
+                   'capabilities and time requests')
+@click.option('--count', '-n', 'count', type=click.IntRange(min=1),
+              default=1000, help='Number of synthetic requests')
+@click.option('--replay', '-f', 'replay',
+              type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Replay recorded requests (one URL or query string per '
+                   'line) instead of a synthetic mix')
+@click.option('--concurrency', '-c', 'concurrency',
+              type=click.IntRange(min=1), default=4,
+              help='Number of concurrent clients')
+@click.option('--reload-interval', 'reload_interval',
+              type=click.FloatRange(min=0), default=0,
+              help='Run config update every N seconds during the load test')
+@click.option('--reload-mode', 'reload_mode', type=click.Choice(RELOAD_MODES),
+              default='mtime', help='Reload mode')
+@click.option('--upstream-latency', 'upstream_latency',
+              type=click.FloatRange(min=0), default=0,
+              help='Simulated upstream WMS latency (milliseconds)')
+@click.option('--output', '-o', 'output', type=click.Path(dir_okay=False),
+              default=None, help='Write results to JSON file')
+def serve(ctx, layers, mix, count, replay, concurrency, reload_interval,
+          reload_mode, upstream_latency, output):
+    """Load test the WSGI application"""
+
+    try:
+        if replay is not None:
+            requests, layer_names = read_request_log(replay)
+        else:
+            layer_names = get_layer_names(layers)
+            requests = generate_request_mix(layer_names, mix, count)
+    except (RuntimeError, ValueError) as err:
+        raise click.ClickException('Invalid request mix: {}'.format(err))
+
+    click.echo('Running {} requests with {} clients'.format(
+        len(requests), concurrency))
+
+    results = run_serve_benchmark(requests, layer_names, concurrency,
+                                  reload_interval, upstream_latency / 1000.0,
+                                  reload_mode)
+
+    click.echo('Throughput: {:.1f} requests/s ({} requests, {} errors, '
+               '{:.2f}s)'.format(results['throughput'], results['requests'],
+                                 results['errors'], results['elapsed']))
+    click.echo('{:<24} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+        'requests', 'count', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    click.echo(format_latency_summary('all', results['latency'],
+                                      results['errors']))
+    for kind, summary in results['kinds'].items():
+        click.echo(format_latency_summary(kind, summary, summary['errors']))
+
+    if 'reload' in results:
+        click.echo('Config updates: {}'.format(results['reload']['reloads']))
+        click.echo(format_latency_summary('steady',
+                                          results['reload']['steady']))
+        click.echo(format_latency_summary('during reload',
+                                          results['reload']['reloading']))
+
+    if output is not None:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        click.echo('Results written to {}'.format(output))
+
+
+@click.command()
+@click.pass_context
+@click.option('--layers', '-l', 'layers', type=click.IntRange(min=1),
+              default=100, help='Number of synthetic layers')
+@click.option('--workers', '-w', 'workers', type=click.IntRange(min=1),
+              default=4, help='Number of gunicorn workers')
+@click.option('--reloads', '-r', 'reloads', type=click.IntRange(min=1),
+              default=3, help='Number of configuration updates')
+@click.option('--modes', '-m', 'modes', default=','.join(RELOAD_MODES),
+              help='CSV list of reload modes ({})'.format(
+                  ', '.join(RELOAD_MODES)))
+@click.option('--output', '-o', 'output', type=click.Path(dir_okay=False),
+              default=None, help='Write results to JSON file')
+def reload(ctx, layers, workers, reloads, modes, output):
+    """Compare worker memory and reload latency of reload modes"""
+
+    if importlib.util.find_spec('gunicorn') is None:
+        raise click.ClickException('gunicorn is required')
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        raise click.ClickException('/proc/<pid>/smaps_rollup is required')
+
+    modes_ = [x.strip() for x in modes.split(',')]
+    for mode in modes_:
+        if mode not in RELOAD_MODES:
+            raise click.ClickException('Unknown reload mode {}'.format(mode))
+
+    layer_names = get_layer_names(layers)
+
+    results = []
+    for mode in modes_:
+        click.echo('Running {} workers in {} mode'.format(workers, mode))
+        try:
+            results.append(run_reload_benchmark(layer_names, mode, workers,
+                                                reloads))
+        except RuntimeError as err:
+            raise click.ClickException('{} mode: {}'.format(mode, err))
+
+    click.echo('{:<8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'memory', 'worker RSS', 'worker PSS', 'worker USS', 'total PSS'))
+    for result in results:
+        for key, name in [('memory', result['mode']),
+                          ('memory_after_reloads', '  after')]:
+            click.echo('{:<8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+                name, *[result[key][k] / 1048576 for k in
+                        ['worker_rss', 'worker_pss', 'worker_uss',
+                         'total_pss']]))
+
+    click.echo('{:<8} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'reload', 'p50 (s)', 'max (s)', 'rebuilds', 'rebuild (s)',
+        'GetMap max'))
+    for result in results:
+        click.echo('{:<8} {:>12.3f} {:>12.3f} {:>12.0f} {:>12.3f} '
+                   '{:>10.1f}ms'.format(
+                       result['mode'], result['reload_latency']['p50'],
+                       result['reload_latency_max'], result['rebuilds'],
+                       result['rebuild_duration'],
+                       (result['reloading_max'] or 0) * 1000))
+
+    if output is not None:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        click.echo('Results written to {}'.format(output))
+
+
+@click.command()
+@click.pass_context
+@click.option('--layers', '-l', 'layers', type=click.IntRange(min=1),
+              default=100, help='Number of synthetic layers')
+@click.option('--layouts', 'layouts', default='8x1,4x2,2x4,1x8',
+              help='CSV list of worker processes x threads per process')
+@click.option('--mix', '-m', 'mix', default=SERVE_MIX,
+              help='Synthetic request mix (kind=weight,...) of hit, miss, '
+                   'capabilities and time requests')
+@click.option('--count', '-n', 'count', type=click.IntRange(min=1),
+              default=2000, help='Number of synthetic requests per layout')
+@click.option('--mode', 'mode', type=click.Choice(RELOAD_MODES),
+              default='mtime', help='Reload mode')
+@click.option('--reload-interval', 'reload_interval',
+              type=click.FloatRange(min=0), default=0,
+              help='Run config update every N seconds during the load test')
+@click.option('--upstream-latency', 'upstream_latency',
+              type=click.FloatRange(min=0), default=10,
+              help='Simulated upstream WMS latency (milliseconds)')
+@click.option('--output', '-o', 'output', type=click.Path(dir_okay=False),
+              default=None, help='Write results to JSON file')
+def threads(ctx, layers, layouts, mix, count, mode, reload_interval,
+            upstream_latency, output):
+    """Compare memory and throughput of worker processes and threads"""
+
+    if importlib.util.find_spec('gunicorn') is None:
+        raise click.ClickException('gunicorn is required')
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        raise click.ClickException('/proc/<pid>/smaps_rollup is required')
+
+    try:
+        layouts_ = parse_layouts(layouts)
+        layer_names = get_layer_names(layers)
+        requests = generate_request_mix(layer_names, mix, count)
+    except (RuntimeError, ValueError) as err:
+        raise click.ClickException(str(err))
+
+    results = []
+    for processes, threads_ in layouts_:
+        click.echo('Running {} processes x {} threads in {} mode'.format(
+            processes, threads_, mode))
+        try:
+            results.extend(run_threads_benchmark(
+                layer_names, requests, [(processes, threads_)], mode,
+                reload_interval, upstream_latency / 1000.0))
+        except RuntimeError as err:
+            raise click.ClickException('{}x{}: {}'.format(
+                processes, threads_, err))
+
+    click.echo('{:<8} {:>12} {:>12} {:>12} {:>10} {:>10} {:>8}'.format(
+        'layout', 'total PSS', 'PSS/thread', 'requests/s', 'p50 (ms)',
+        'p99 (ms)', 'errors'))
+    for result in results:
+        click.echo('{:<8} {:>10.1f}MB {:>10.1f}MB {:>12.1f} {:>10.2f} '
+                   '{:>10.2f} {:>8}'.format(
+                       '{}x{}'.format(result['processes'], result['threads']),
+                       result['memory']['total_pss'] / 1048576,
+                       result['pss_per_thread'] / 1048576,
+                       result['throughput'],
+                       result['latency']['p50'] * 1000,
+                       result['latency']['p99'] * 1000,
+                       result['errors']))
+
+    # processes replaced by threads, at the same number of threads in total
+    for result in results:
+        baseline = [r for r in results if r['threads'] == 1 and
+                    r['processes'] == result['processes'] * result['threads']]
+        if result['threads'] > 1 and baseline:
+            click.echo('{}x{} replaces {} processes with {:.0%} of the '
+                       'memory and {:.0%} of the throughput'.format(
+                           result['processes'], result['threads'],
+                           baseline[0]['processes'],
+                           result['memory']['total_pss'] /
+                           baseline[0]['memory']['total_pss'],
+                           result['throughput'] / baseline[0]['throughput']))
+
+    if output is not None:
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        click.echo('Results written to {}'.format(output))
+
+
+bench.add_command(config_)
+bench.add_command(reload)
+bench.add_command(serve)
+bench.add_command(threads)
+
+
+if __name__ == '__main__':
+    bench()
@@ -27,7 +27,157 @@
 #
 # =================================================================
 
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from urllib.parse import parse_qsl
+from wsgiref.util import FileWrapper, setup_testing_defaults
+
+from click.testing import CliRunner
+
+THISDIR = os.path.dirname(os.path.realpath(__file__))
+
+# cumulative import time budget of CLI commands (microseconds), checked
+# when GEOMET_MAPPROXY_TEST_IMPORT_TIME is set (timings vary across hosts)
+IMPORT_TIME_BUDGET = 150000
+# created by setUpModule, removed by tearDownModule
+TMPDIR = os.path.join(tempfile.gettempdir(),
+                      'geomet-mapproxy-tests-{}'.format(os.getpid()))
+
+# environment required by geomet_mapproxy (unless already set)
+ENVIRON = {k: v for k, v in {
+    'GEOMET_MAPPROXY_CACHE_DATA': TMPDIR,
+    'GEOMET_MAPPROXY_TMP': TMPDIR,
+    'GEOMET_MAPPROXY_CONFIG': os.path.join(
+        TMPDIR, 'geomet-mapproxy-config.yml'),
+    'GEOMET_MAPPROXY_CACHE_CONFIG': os.path.join(
+        TMPDIR, 'geomet-mapproxy-cache-config.yml'),
+    'GEOMET_MAPPROXY_URL': 'http://localhost'
+}.items() if k not in os.environ}
+ENVIRON_PATCH = mock.patch.dict(os.environ, ENVIRON)
+
+# geomet_mapproxy reads its environment on import
+with mock.patch.dict(os.environ, ENVIRON):
+    from mapproxy.config.loader import ConfigurationError
+    import mapproxy.config.loader
+    import mapproxy.util.yaml
+
+    from bench import (
+        StubWMS, call_wsgi_application, compare_results,
+        generate_capabilities, generate_request_mix, get_benchmark_result,
+        get_getmap_query, get_layer_names, get_percentile, load_wsgi_module,
+        parse_layouts, prepare_workdir, read_request_log,
+        run_config_benchmarks)
+    from geomet_mapproxy.config import (
+        get_changed_layers, get_config_structure_key, get_layer_profile,
+        validate_cache_config)
+    from geomet_mapproxy.layers import (
+        expand_layers, layer_names_from_mapfile, layer_names_from_xml,
+        refresh_layer_index_wms, split_selectors)
+    from geomet_mapproxy.metrics import Metrics, merge_process_metrics
+    from geomet_mapproxy.middleware import (
+        CapabilitiesCache, ConditionalTiles, InfoCache, LayerRouter)
+    from geomet_mapproxy.profiling import EVENT_LOGGER, PhaseTimer, profiler
+    from geomet_mapproxy.server import (
+        GracefulReloader, make_mapproxy_app, reload_applications,
+        watch_applications)
+    from geomet_mapproxy.shard import (
+        create_routing_map, get_node_mapproxy_config, get_rebalance_report)
+    from geomet_mapproxy.stats import (
+        AccessLogStats, HeavyHitters, get_seed_config, get_tile,
+        get_zoom_range)
+    from geomet_mapproxy.upstream import CircuitBreaker, call_with_retries
+    from geomet_mapproxy.util import (
+        FileLock, get_config_fragments_filepath,
+        get_config_snapshot_filepath, get_private_dir, get_temporal_extent,
+        get_temporal_steps, is_temporal_step, read_config_fragments,
+        write_config_fragments, write_config_generation,
+        write_dimensions_index, yaml_dump, yaml_dump_fragments,
+        yaml_load_snapshot)
+
+
+def setUpModule():
+    """create the test directory and environment"""
+
+    os.makedirs(TMPDIR, exist_ok=True)
+    ENVIRON_PATCH.start()
+
+
+def tearDownModule():
+    """remove the test directory and restore the environment"""
+
+    ENVIRON_PATCH.stop()
+    shutil.rmtree(TMPDIR, ignore_errors=True)
+
+
+def make_environ(query_string, **kwargs):
+    """helper function to build a WSGI environment"""
+
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': '/service',
+        'QUERY_STRING': query_string
+    }
+    environ.update(kwargs)
+
+    return environ
+
+
+def run_app(app, environ):
+    """helper function to run a WSGI application"""
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    app_iter = app(environ, start_response)
+    try:
+        body = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    return response['status'], response['headers'], body
+
+
+def get_cli_imports():
+    """helper function to derive the imports of CLI commands"""
+
+    code = ('import sys; from geomet_mapproxy import cli; '
+            'import geomet_mapproxy.cache, geomet_mapproxy.config; '
+            'print(" ".join(sys.modules))')
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             code], capture_output=True, check=True,
+                            universal_newlines=True)
+
+    import_time = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_time, cumulative, name = line.split('|')
+        # top level geomet_mapproxy imports only
+        if name[1:].startswith('geomet_mapproxy'):
+            import_time += int(cumulative)
+
+    return result.stdout.split(), import_time
 
 
 class GeoMetMapProxyTest(unittest.TestCase):
@@ -40,6 +190,1492 @@ class GeoMetMapProxyTest(unittest.TestCase):
 
         pass
 
+    def test_capabilities_cache(self):
+        """Test Capabilities caching"""
+
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['QUERY_STRING'])
+            start_response('200 OK', [('Content-Type', 'text/xml')])
+            return [b'<WMS_Capabilities/>']
+
+        config = os.environ['GEOMET_MAPPROXY_CONFIG']
+        with open(config, 'w') as fh:
+            fh.write('layers: []')
+        write_config_generation(config)
+
+        caps = CapabilitiesCache(app, config)
+        qs = 'service=WMS&request=GetCapabilities&version=1.3.0'
+
+        status, headers, body = run_app(caps, make_environ(qs))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'<WMS_Capabilities/>')
+        etag = headers['ETag']
+
+        status, headers, body = run_app(caps, make_environ(
+            qs, HTTP_ACCEPT_ENCODING='gzip, deflate'))
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), b'<WMS_Capabilities/>')
+        self.assertEqual(len(calls), 1)
+
+        status, headers, body = run_app(caps, make_environ(
+            qs, HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(status, '304 Not Modified')
+
+        run_app(caps, make_environ(qs.replace('1.3.0', '1.1.1')))
+        run_app(caps, make_environ('service=WMS&request=GetMap'))
+        self.assertEqual(len(calls), 3)
+
+        with open(config, 'w') as fh:
+            fh.write('layers: [GDPS.ETA_TT]')
+        write_config_generation(config)
+
+        run_app(caps, make_environ(qs))
+        self.assertEqual(len(calls), 4)
+
+        # parameters Capabilities do not depend on (e.g. cache busters) do
+        # not multiply cache entries
+        for i in range(3):
+            run_app(caps, make_environ('{}&_={}&REQUEST=getcapabilities'
+                                       .format(qs, i)))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(caps._entries), 2)
+
+        # the cache is bounded by size
+        caps = CapabilitiesCache(app, config, max_size=100)
+        for version in ['1.1.1', '1.3.0']:
+            run_app(caps, make_environ(qs.replace('1.3.0', version)))
+        self.assertEqual(len(caps._entries), 1)
+        self.assertLessEqual(caps._entries.size, 100)
+
+    def test_info_cache(self):
+        """Test GetLegendGraphic/GetFeatureInfo caching"""
+
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['QUERY_STRING'])
+            time.sleep(0.1)
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return [b'PNG']
+
+        info = InfoCache(app, legend_ttl=60, featureinfo_ttl=0)
+        qs = 'service=WMS&request=GetLegendGraphic&layer=GDPS.ETA_TT'
+
+        threads = [
+            threading.Thread(target=run_app, args=(info, make_environ(qs)))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+
+        status, headers, body = run_app(info, make_environ(qs))
+        self.assertEqual(body, b'PNG')
+        self.assertIn('max-age', headers['Cache-Control'])
+        self.assertEqual(len(calls), 1)
+
+        run_app(info, make_environ(qs + '&style=DEFAULT'))
+        self.assertEqual(len(calls), 2)
+
+        qs = 'service=WMS&request=GetFeatureInfo&layers=GDPS.ETA_TT'
+        run_app(info, make_environ(qs))
+        run_app(info, make_environ(qs))
+        self.assertEqual(len(calls), 4)
+
+    def test_get_temporal_extent(self):
+        """Test temporal dimension latest value and cadence"""
+
+        latest, cadence = get_temporal_extent(
+            ['2024-01-01T00:00:00Z/2024-01-01T03:00:00Z/PT6M'])
+        self.assertEqual(latest.isoformat(), '2024-01-01T03:00:00+00:00')
+        self.assertEqual(cadence.total_seconds(), 360)
+
+        latest, cadence = get_temporal_extent(
+            ['2024-01-01T00:00:00Z', '2024-01-01T03:00:00Z'])
+        self.assertEqual(latest.isoformat(), '2024-01-01T03:00:00+00:00')
+        self.assertEqual(cadence.total_seconds(), 10800)
+
+        self.assertEqual(get_temporal_extent([]), (None, None))
+
+    def test_conditional_tiles(self):
+        """Test GetMap conditional requests and freshness"""
+
+        tile = {'body': b'PNG', 'timestamp': 'Mon, 01 Jan 2024 03:00:00 GMT'}
+
+        def app(environ, start_response):
+            headers = [('Content-Type', 'image/png'),
+                       ('Cache-control', 'public, max-age=60, s-maxage=60')]
+            # as per MapProxy for tiled requests served from the cache
+            if 'tiled=true' in environ['QUERY_STRING'] and \
+                    tile['timestamp'] is not None:
+                etag = hashlib.md5(tile['timestamp'].encode(
+                    'utf-8')).hexdigest()
+                headers.extend([('ETag', etag),
+                                ('Last-modified', tile['timestamp'])])
+                if environ.get('HTTP_IF_NONE_MATCH') == etag or \
+                        environ.get('HTTP_IF_MODIFIED_SINCE') == \
+                        tile['timestamp']:
+                    start_response('304 Not Modified', headers)
+                    return [b'']
+            start_response('200 OK', headers)
+            tile['response'] = [tile['body']]
+            return tile['response']
+
+        config = os.path.join(TMPDIR, 'tiles-config.yml')
+        write_dimensions_index(config, {
+            'layers': [{
+                'name': 'RADAR_1KM_RRAI',
+                'dimensions': {
+                    'time': {
+                        'default': '2024-01-01T03:00:00Z',
+                        'values': [
+                            '2024-01-01T00:00:00Z/2024-01-01T03:00:00Z/PT6M'
+                        ]
+                    }
+                }
+            }, {
+                'name': 'CLIMATE_NORMALS',
+                'dimensions': {
+                    'time': {
+                        'default': '2024-01-01T00:00:00Z',
+                        'values': [
+                            '2020-01-01T00:00:00Z/2024-01-01T00:00:00Z/P1Y'
+                        ]
+                    }
+                }
+            }, {
+                'name': 'CURRENT_CONDITIONS'
+            }]
+        })
+
+        tiles = ConditionalTiles(app, config, default_max_age=120,
+                                 historical_max_age=3600)
+        qs = 'service=WMS&request=GetMap&layers=RADAR_1KM_RRAI'
+
+        status, headers, body = run_app(tiles, make_environ(qs))
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=360')
+        self.assertNotIn('Last-Modified', headers)
+        etag = headers['ETag']
+
+        status, headers, body = run_app(tiles, make_environ(
+            qs, HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(status, '304 Not Modified')
+
+        # reprocessed tiles are revalidated
+        tile['body'] = b'PNG2'
+        status, headers, body = run_app(tiles, make_environ(
+            qs, HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(headers['ETag'], etag)
+
+        # tiled requests are answered by MapProxy from the tile cache
+        # metadata, and streamed
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&tiled=true'))
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=360')
+        last_modified = headers['Last-Modified']
+        self.assertEqual(last_modified, tile['timestamp'])
+        etag = headers['ETag']
+        self.assertTrue(etag.startswith('"'))
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&tiled=true', HTTP_IF_MODIFIED_SINCE=last_modified))
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=360')
+        self.assertNotIn('Content-Type', headers)
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&tiled=true', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['ETag'], etag)
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&tiled=true', HTTP_IF_NONE_MATCH='W/{}'.format(etag)))
+        self.assertEqual(status, '304 Not Modified')
+
+        tile['timestamp'] = 'Mon, 01 Jan 2024 04:00:00 GMT'
+        environ = make_environ(qs + '&tiled=true',
+                               HTTP_IF_NONE_MATCH=etag,
+                               HTTP_IF_MODIFIED_SINCE=last_modified)
+        response = tiles(environ, lambda status, headers, exc_info=None: None)
+        self.assertIs(response, tile['response'])
+        status, headers, body = run_app(tiles, environ)
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(headers['ETag'], etag)
+
+        # newly created tiles have no cache metadata
+        tile['timestamp'] = None
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&tiled=true'))
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('ETag', headers)
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=360')
+
+        status, headers, body = run_app(tiles, make_environ(
+            qs + '&time=2024-01-01T01:00:00Z'))
+        self.assertEqual(headers['Cache-Control'],
+                         'public, max-age=3600, immutable')
+
+        # latest, future, misaligned and out of range frames may change
+        for time_ in ['2024-01-01T03:00:00Z', '2030-01-01T00:00:00Z',
+                      '2024-01-01T03:06:00Z', '2024-01-01T01:03:00Z',
+                      '2023-12-31T23:54:00Z', 'invalid']:
+            status, headers, body = run_app(tiles, make_environ(
+                '{}&time={}'.format(qs, time_)))
+            self.assertEqual(headers['Cache-Control'], 'public, max-age=360',
+                             time_)
+
+        status, headers, body = run_app(tiles, make_environ(
+            'service=WMS&request=GetMap&layers=CURRENT_CONDITIONS'))
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=120')
+
+        # the latest frame of long cadences is not cached for longer than
+        # historical frames
+        status, headers, body = run_app(tiles, make_environ(
+            'service=WMS&request=GetMap&layers=CLIMATE_NORMALS'))
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=3600')
+
+        steps = get_temporal_steps(['2024-01-01T00:00:00Z/2024-12-01T00:00:00Z'
+                                    '/P1M', '2025-01-01T00:00:00Z'])
+        self.assertFalse(is_temporal_step(
+            steps, datetime(2024, 2, 1, tzinfo=timezone.utc)))
+        self.assertTrue(is_temporal_step(
+            steps, datetime(2025, 1, 1, tzinfo=timezone.utc)))
+
+    def test_layer_profiles(self):
+        """Test cache configuration tuning profiles"""
+
+        cache_config = {
+            'profiles': {
+                'default': {'concurrent_requests': 4},
+                'radar': {'meta_size': [2, 2], 'grids': ['GLOBAL_GEODETIC']}
+            },
+            'layer-profiles': [
+                {'pattern': 'RADAR_*', 'profile': 'radar'}
+            ]
+        }
+
+        self.assertTrue(validate_cache_config(cache_config))
+        self.assertEqual(get_layer_profile(cache_config, 'RADAR_1KM_RRAI'),
+                         cache_config['profiles']['radar'])
+        self.assertEqual(get_layer_profile(cache_config, 'GDPS.ETA_TT'),
+                         cache_config['profiles']['default'])
+        self.assertEqual(get_layer_profile({}, 'GDPS.ETA_TT'), {})
+
+        cache_config['profiles']['radar']['grids'] = ['EPSG:2950']
+        with self.assertRaises(RuntimeError):
+            validate_cache_config(cache_config)
+
+        cache_config['profiles']['radar'] = {'meta_sizes': [2, 2]}
+        with self.assertRaises(RuntimeError):
+            validate_cache_config(cache_config)
+
+        cache_config['layer-profiles'][0]['profile'] = 'model'
+        with self.assertRaises(RuntimeError):
+            validate_cache_config(cache_config)
+
+    def test_expand_layers(self):
+        """Test layer selectors"""
+
+        layer_names = ['GDPS.ETA_TT', 'GDPS.ETA_UU', 'RADAR_1KM_RRAI',
+                       'RADAR_1KM_RSNO', 'RDPS.ETA_TT']
+
+        self.assertEqual(expand_layers(['GDPS.ETA_TT', 'FOO']),
+                         ['GDPS.ETA_TT', 'FOO'])
+        self.assertEqual(expand_layers(['RADAR_*'], layer_names),
+                         ['RADAR_1KM_RRAI', 'RADAR_1KM_RSNO'])
+        self.assertEqual(expand_layers([r're:.*\.ETA_TT', 'GDPS.ETA_TT'],
+                                       layer_names),
+                         ['GDPS.ETA_TT', 'RDPS.ETA_TT'])
+        self.assertEqual(expand_layers(['re:ETA'], layer_names), [])
+
+        with self.assertRaises(RuntimeError):
+            expand_layers(['re:GDPS.(ETA'], layer_names)
+
+        # regexes only valid on their own
+        self.assertEqual(expand_layers(['re:(?i)radar.*', 'GDPS.*'],
+                                       layer_names),
+                         ['GDPS.ETA_TT', 'GDPS.ETA_UU', 'RADAR_1KM_RRAI',
+                          'RADAR_1KM_RSNO'])
+        self.assertEqual(expand_layers([r're:(?P<m>[GR])DPS\.ETA_TT',
+                                        r're:(?P<m>G)DPS\.ETA_UU'],
+                                       layer_names),
+                         ['GDPS.ETA_TT', 'GDPS.ETA_UU', 'RDPS.ETA_TT'])
+
+        # commas within regex quantifiers do not separate selectors
+        selectors = split_selectors([r'RADAR_*,re:[A-Z]{4}\.ETA_T{1,2}',
+                                     'RDPS.ETA_TT'])
+        self.assertEqual(selectors, ['RADAR_*', r're:[A-Z]{4}\.ETA_T{1,2}',
+                                     'RDPS.ETA_TT'])
+        self.assertEqual(expand_layers(selectors[1:2], layer_names),
+                         ['GDPS.ETA_TT', 'RDPS.ETA_TT'])
+        self.assertIsNone(split_selectors(()))
+
+    def test_layer_index_sources(self):
+        """Test layer name extraction from Capabilities and mapfiles"""
+
+        xml = b'''<WMS_Capabilities xmlns="http://www.opengis.net/wms">
+          <Capability>
+            <Layer><Title>GeoMet</Title>
+              <Layer><Name>GDPS</Name><Title>GDPS</Title>
+                <Layer><Name>GDPS.ETA_TT</Name><Title>TT</Title>
+                  <Style><Name>DEFAULT</Name></Style>
+                </Layer>
+              </Layer>
+            </Layer>
+          </Capability>
+        </WMS_Capabilities>'''
+
+        self.assertEqual(layer_names_from_xml(io.BytesIO(xml)),
+                         ['GDPS', 'GDPS.ETA_TT'])
+
+        mapfile = os.path.join(TMPDIR, 'geomet-en.map')
+        with open(mapfile, 'w') as fh:
+            fh.write('MAP\n  NAME "geomet"\n  LAYER\n    NAME "GDPS.ETA_TT"\n'
+                     '    CLASS\n      NAME "0"\n    END\n  END\nEND\n')
+
+        self.assertEqual(layer_names_from_mapfile(mapfile), ['GDPS.ETA_TT'])
+
+        # without ETag/Last-Modified, the WMS is requested once per TTL
+        with StubWMS(['GDPS.ETA_TT']) as stub, \
+                mock.patch('geomet_mapproxy.layers.GEOMET_MAPPROXY_CACHE_WMS',
+                           stub.url):
+            signature, layer_names = refresh_layer_index_wms()
+            self.assertEqual(layer_names, ['GDPS.ETA_TT'])
+
+            with mock.patch('requests.get') as get:
+                self.assertEqual(refresh_layer_index_wms(signature, 60),
+                                 (signature, None))
+                get.assert_not_called()
+
+            signature[3] -= 120
+            signature_, layer_names = refresh_layer_index_wms(signature, 60)
+            self.assertEqual(layer_names, ['GDPS.ETA_TT'])
+            self.assertGreater(signature_[3], signature[3])
+
+    def test_sharding(self):
+        """Test layer sharding over nodes"""
+
+        layers = ['LAYER_{}'.format(i) for i in range(1000)]
+
+        routing_map = create_routing_map(layers, ['node1', 'node2', 'node3'])
+        self.assertEqual(routing_map,
+                         create_routing_map(layers,
+                                            ['node1', 'node2', 'node3']))
+        self.assertEqual(set(routing_map['layers'].values()),
+                         {'node1', 'node2', 'node3'})
+
+        new_routing_map = create_routing_map(
+            layers, ['node1', 'node2', 'node3', 'node4'])
+        report = get_rebalance_report(routing_map, new_routing_map, TMPDIR)
+
+        # only layers moving to the new node move, about 1/4 of them
+        self.assertTrue(150 < report['moved_layers'] < 350)
+        for move in report['moves'].values():
+            self.assertEqual(move['to'], 'node4')
+
+        mapproxy_config = {
+            'layers': [{'name': 'LAYER_1', 'sources': ['LAYER_1_cache']}],
+            'caches': {'LAYER_1_cache': {'sources': ['LAYER_1_source']}},
+            'sources': {'LAYER_1_source': {}},
+            'services': {}
+        }
+        node = routing_map['layers']['LAYER_1']
+        node_config = get_node_mapproxy_config(mapproxy_config, routing_map,
+                                               node)
+        self.assertEqual(len(node_config['layers']), 1)
+
+        other_node = 'node1' if node != 'node1' else 'node2'
+        node_config = get_node_mapproxy_config(mapproxy_config, routing_map,
+                                               other_node)
+        self.assertEqual(node_config['layers'], [])
+        self.assertEqual(node_config['sources'], {})
+
+    def test_sharded_serving(self):
+        """Test serving layers sharded over nodes"""
+
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+        from wsgiref.util import shift_path_info
+
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        class Handler(WSGIRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        layer_names = get_layer_names(8)
+
+        with tempfile.TemporaryDirectory() as workdir, \
+                StubWMS(layer_names) as stub:
+            env = prepare_workdir(workdir, layer_names, stub.url)
+            environ = os.environ.copy()
+            environ.update(env)
+            subprocess.run([sys.executable, '-c',
+                            'from geomet_mapproxy import cli; cli()',
+                            'config', 'create', '--mode', 'xml',
+                            '--nodes', '2'],
+                           env=environ, stdout=subprocess.DEVNULL,
+                           check=True)
+
+            with open('{}.routing.json'.format(
+                    env['GEOMET_MAPPROXY_CONFIG'])) as fh:
+                routes = json.load(fh)['layers']
+            local = [k for k, v in routes.items() if v == 'node1'][0]
+            remote = [k for k, v in routes.items() if v == 'node2'][0]
+
+            server = Server(('127.0.0.1', 0), Handler)
+            env['GEOMET_MAPPROXY_NODE_URL'] = (
+                'http://127.0.0.1:{}/{{node}}'.format(server.server_port))
+            apps = {}
+            for node in ['node1', 'node2']:
+                env['GEOMET_MAPPROXY_NODE'] = node
+                apps[node] = load_wsgi_module(env).application
+
+            routed = []
+
+            def dispatch(environ, start_response):
+                node = shift_path_info(environ)
+                routed.append((node, environ['QUERY_STRING']))
+                return apps[node](environ, start_response)
+
+            server.set_app(dispatch)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            def request(query_string, **kwargs):
+                environ = make_environ(query_string, SCRIPT_NAME='/public',
+                                       **kwargs)
+                setup_testing_defaults(environ)
+                return run_app(apps['node1'], environ)
+
+            try:
+                # layers of other nodes are proxied, not redirected
+                for layer in [local, remote]:
+                    status, headers, body = request(
+                        get_getmap_query(layer, 1, 0, 0))
+                    headers = {k.lower(): v for k, v in headers.items()}
+                    self.assertEqual(status, '200 OK', layer)
+                    self.assertEqual(headers['content-type'], 'image/png')
+                    self.assertNotIn('location', headers)
+
+                status, headers, body = request(
+                    get_getmap_query('{},{}'.format(local, remote), 1, 0, 0))
+                self.assertEqual(status, '400 Bad Request')
+                self.assertIn(b'different nodes', body)
+
+                # routed requests are served locally (no loops)
+                status, headers, body = request(
+                    get_getmap_query(remote, 1, 0, 0),
+                    HTTP_X_GEOMET_MAPPROXY_NODE='node2')
+                self.assertIn(b'LayerNotDefined', body)
+
+                # Capabilities list the layers of all nodes, with public
+                # online resource URLs
+                query_string = ('SERVICE=WMS&VERSION=1.3.0&'
+                                'REQUEST=GetCapabilities')
+                status, headers, body = request(query_string)
+                self.assertEqual(status, '200 OK')
+                for layer in layer_names:
+                    self.assertEqual(body.count(
+                        '<Name>{}</Name>'.format(layer).encode()), 1, layer)
+                self.assertIn(b'http://127.0.0.1/public/service', body)
+                self.assertNotIn(b'/node2', body)
+
+                # merged Capabilities are not revalidated against the
+                # other nodes on every request
+                count = len(routed)
+                status, headers_, body_ = request(
+                    query_string, HTTP_IF_NONE_MATCH=headers['ETag'])
+                self.assertEqual(status, '304 Not Modified')
+                self.assertEqual(len(routed), count)
+
+                status, headers_, body_ = request(
+                    query_string.replace('1.3.0', '1.1.1'))
+                self.assertEqual(status, '200 OK')
+                self.assertIn('<Name>{}</Name>'.format(remote).encode(),
+                              body_)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            status, headers, body = request(get_getmap_query(remote, 1, 0, 0))
+            self.assertEqual(status, '502 Bad Gateway')
+
+        # other nodes are revalidated in parallel, once the merged
+        # Capabilities expire
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/xml')])
+            return [b'<WMS_Capabilities><Capability><Layer/></Capability>'
+                    b'</WMS_Capabilities>']
+
+        def fetch_capabilities(node, environ, part=None):
+            fetches.append(node)
+            time.sleep(0.2)
+            return '"{}"'.format(node), (
+                '<WMS_Capabilities><Capability><Layer><Layer><Name>{}'
+                '</Name></Layer></Layer></Capability></WMS_Capabilities>'
+                .format(node).encode())
+
+        fetches = []
+        router = LayerRouter(app, os.environ['GEOMET_MAPPROXY_CONFIG'],
+                             'node1', 'http://{node}', capabilities_ttl=0.5)
+        query_string = 'SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
+        with mock.patch.object(router, 'get_routing_map', return_value={
+                'nodes': ['node1', 'node2', 'node3', 'node4']}), \
+                mock.patch.object(router, 'fetch_capabilities',
+                                  fetch_capabilities):
+            start = time.monotonic()
+            status, headers, body = run_app(router, make_environ(
+                query_string))
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual(sorted(fetches), ['node2', 'node3', 'node4'])
+            self.assertIn(b'<Name>node4</Name>', body)
+
+            run_app(router, make_environ(query_string))
+            self.assertEqual(len(fetches), 3)
+            time.sleep(0.5)
+            run_app(router, make_environ(query_string))
+            self.assertEqual(len(fetches), 6)
+
+    def test_config_benchmarks(self):
+        """Test configuration pipeline benchmarks"""
+
+        layer_names = get_layer_names(10)
+        self.assertEqual(len(layer_names), 10)
+
+        xml = generate_capabilities(layer_names).encode('utf-8')
+        self.assertEqual(layer_names_from_xml(io.BytesIO(xml)), layer_names)
+
+        results = run_config_benchmarks([10], ['from_wms', 'from_xml'], 1)
+        self.assertEqual(len(results['results']), 2)
+        for result in results['results']:
+            self.assertNotIn('error', result)
+            self.assertEqual(result['layers'], 10)
+
+        ratios = compare_results(results, results)
+        self.assertEqual(ratios[('from_xml', 10)]['median'], 1)
+
+        # benchmark processes which die or hang are reported
+        context = multiprocessing.get_context('spawn')
+        for target, args, error in [
+                (os._exit, (3,), 'exited with status 3'),
+                (time.sleep, (60,), 'timed out after 1s')]:
+            queue = context.Queue()
+            process = context.Process(target=target, args=args)
+            process.start()
+            self.assertIn(error, get_benchmark_result(process, queue, 1))
+            process.join()
+
+    def test_serve_benchmark_requests(self):
+        """Test load test request mixes"""
+
+        layer_names = get_layer_names(10)
+        requests = generate_request_mix(layer_names, 'hit=1,capabilities=1',
+                                        100)
+        self.assertEqual(len(requests), 100)
+        self.assertEqual(requests, generate_request_mix(
+            layer_names, 'hit=1,capabilities=1', 100))
+        self.assertEqual({r[0] for r in requests}, {'hit', 'capabilities'})
+
+        with self.assertRaises(RuntimeError):
+            generate_request_mix(layer_names, 'hits=1')
+
+        requests, layer_names = read_request_log(
+            os.path.join(THISDIR, 'requests.txt'))
+        self.assertEqual(len(requests), 252)
+        self.assertIn('RADAR_1KM_RRAI', layer_names)
+
+        self.assertEqual(get_percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(get_percentile([3, 1, 2, 4], 99), 4)
+        self.assertIsNone(get_percentile([], 50))
+
+        # the harness is a geomet-mapproxy subcommand in a source checkout
+        import geomet_mapproxy
+
+        result = CliRunner().invoke(geomet_mapproxy.cli, ['bench', '--help'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('serve', result.output)
+
+        with mock.patch.object(geomet_mapproxy, 'BENCH_DIR',
+                               os.path.join(TMPDIR, 'missing')):
+            result = CliRunner().invoke(geomet_mapproxy.cli,
+                                        ['bench', 'serve', '--count', '1'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('Benchmark harness not found', result.output)
+
+    def test_metrics(self):
+        """Test Prometheus metrics middleware"""
+
+        upstream = logging.getLogger('mapproxy.source.request')
+
+        def app(environ, start_response):
+            if 'MISS' in environ['QUERY_STRING']:
+                upstream.info('%s %s %d %s %s', 'GET',
+                              'http://localhost/?LAYERS=MISS&CRS=EPSG:3857',
+                              200, '10', '25')
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return [b'png']
+
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            config = os.path.join(metrics_dir, 'config.yml')
+            write_dimensions_index(config, {
+                'layers': [{'name': 'HIT'}, {'name': 'MISS'}]})
+            metrics = Metrics(app, metrics_dir=metrics_dir,
+                              config_filepath=config, token='s3cr3t',
+                              upstream=True)
+
+            for layers in ['HIT', 'MISS', 'HIT']:
+                status, headers, body = run_app(metrics, make_environ(
+                    'SERVICE=WMS&REQUEST=GetMap&CRS=EPSG:3857&LAYERS={}'
+                    .format(layers)))
+                self.assertEqual(headers['X-Cache'], layers)
+
+            # client supplied values which are not configured are bounded
+            run_app(metrics, make_environ(
+                'SERVICE=WMS&REQUEST=GetMap&CRS=EPSG:9999&LAYERS=X1'))
+            run_app(metrics, make_environ(
+                'SERVICE=WMS&REQUEST=GetMap&CRS=EPSG:9998&LAYERS=X2'))
+            run_app(metrics, make_environ('SERVICE=WMS&REQUEST=X3'))
+
+            # metrics are only served to allowed clients
+            for kwargs in [{'REMOTE_ADDR': '10.0.0.1'},
+                           {'REMOTE_ADDR': '127.0.0.1',
+                            'HTTP_X_FORWARDED_FOR': '10.0.0.1'},
+                           {'REMOTE_ADDR': '127.0.0.1',
+                            'HTTP_X_FORWARDED_FOR': 'unknown'},
+                           {'HTTP_AUTHORIZATION': 'Bearer s3cr3'}]:
+                status, headers, body = run_app(metrics, make_environ(
+                    '', PATH_INFO='/metrics', **kwargs))
+                self.assertEqual(status, '403 Forbidden', kwargs)
+            status, headers, body = run_app(metrics, make_environ(
+                '', PATH_INFO='/metrics', REMOTE_ADDR='10.0.0.1',
+                HTTP_AUTHORIZATION='Bearer s3cr3t'))
+            self.assertEqual(status, '200 OK')
+
+            status, headers, body = run_app(metrics, make_environ(
+                '', PATH_INFO='/metrics', REMOTE_ADDR='127.0.0.1'))
+            self.assertEqual(status, '200 OK')
+            body = body.decode('utf-8')
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="other",'
+                          'grid="other",result="hit"} 2', body)
+            self.assertIn('geomet_mapproxy_request_duration_seconds_count'
+                          '{request="other",layer=""} 1', body)
+            for value in ['X1', 'X2', 'X3', 'EPSG:999']:
+                self.assertNotIn(value, body)
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="HIT",'
+                          'grid="GLOBAL_WEBMERCATOR",result="hit"} 2', body)
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="MISS",'
+                          'grid="GLOBAL_WEBMERCATOR",result="miss"} 1', body)
+            self.assertIn('geomet_mapproxy_request_duration_seconds_count'
+                          '{request="getmap",layer="HIT"} 2', body)
+            self.assertIn('geomet_mapproxy_upstream_request_duration_seconds_'
+                          'sum{layer="MISS",grid="GLOBAL_WEBMERCATOR"} 0.025',
+                          body)
+
+            # metrics of other worker processes are aggregated
+            worker = Metrics(app, config_filepath=config, upstream=True)
+            run_app(worker, make_environ(
+                'SERVICE=WMS&REQUEST=GetMap&CRS=EPSG:3857&LAYERS=HIT'))
+            with open(os.path.join(metrics_dir, 'metrics-0.json'), 'w') as fh:
+                json.dump(worker.registry.dump(), fh)
+
+            status, headers, body = run_app(metrics, make_environ(
+                '', PATH_INFO='/metrics', REMOTE_ADDR='127.0.0.1'))
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="HIT",'
+                          'grid="GLOBAL_WEBMERCATOR",result="hit"} 3',
+                          body.decode('utf-8'))
+
+            # metrics of exited processes are merged into the archive
+            self.assertTrue(merge_process_metrics(metrics_dir, 0))
+            self.assertFalse(merge_process_metrics(metrics_dir, 0))
+            self.assertFalse(os.path.exists(
+                os.path.join(metrics_dir, 'metrics-0.json')))
+            status, headers, body = run_app(metrics, make_environ(
+                '', PATH_INFO='/metrics', REMOTE_ADDR='127.0.0.1'))
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="HIT",'
+                          'grid="GLOBAL_WEBMERCATOR",result="hit"} 3',
+                          body.decode('utf-8'))
+
+            # metrics of processes which are no longer running (e.g.
+            # mod_wsgi daemon processes) are merged when collected
+            process = subprocess.Popen([sys.executable, '-c', 'pass'])
+            process.wait()
+            filepath = os.path.join(metrics_dir,
+                                    'metrics-{}.json'.format(process.pid))
+            with open(filepath, 'w') as fh:
+                json.dump(worker.registry.dump(), fh)
+            status, headers, body = run_app(metrics, make_environ(
+                '', PATH_INFO='/metrics', REMOTE_ADDR='::1'))
+            self.assertIn('geomet_mapproxy_cache_requests_total{layer="HIT",'
+                          'grid="GLOBAL_WEBMERCATOR",result="hit"} 4',
+                          body.decode('utf-8'))
+            self.assertFalse(os.path.exists(filepath))
+
+            # metrics inherited from a parent process are reset
+            metrics.registry._pid = -1
+            self.assertEqual(metrics.registry.dump()['counters'], [])
+
+        # without upstream recording, MapProxy is left untouched, and
+        # responses are only recorded once closed
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return environ['wsgi.file_wrapper'](fh)
+
+        handlers = list(upstream.handlers)
+        metrics = Metrics(app)
+        self.assertEqual(upstream.handlers, handlers)
+
+        fh = io.BytesIO(b'png')
+        environ = make_environ('SERVICE=WMS&REQUEST=GetMap&LAYERS=L')
+        environ['wsgi.file_wrapper'] = FileWrapper
+        response = metrics(environ, lambda status, headers,
+                           exc_info=None: self.assertNotIn(
+                               'X-Cache', dict(headers)))
+        self.assertEqual(b''.join(response), b'png')
+        self.assertEqual(metrics.registry.dump()['histograms'], [])
+        response.close()
+        self.assertTrue(fh.closed)
+        self.assertEqual(len(metrics.registry.dump()['histograms']), 1)
+        self.assertEqual(metrics.registry.dump()['counters'], [])
+
+    def test_phase_timings(self):
+        """Test phase timings and profiling"""
+
+        timer = PhaseTimer('update')
+        for layer in ['GDPS.ETA_TT', 'RADAR_1KM_RRAI']:
+            with timer.phase('fetch', layer):
+                time.sleep(0.01)
+        with timer.phase('yaml_dump'):
+            pass
+
+        summary = timer.summary()
+        self.assertEqual(summary['command'], 'update')
+        self.assertEqual(summary['phases']['fetch']['count'], 2)
+        self.assertGreaterEqual(summary['phases']['fetch']['duration'], 0.02)
+        self.assertEqual(len(summary['phases']['fetch']['slowest_layers']), 2)
+        self.assertNotIn('slowest_layers', summary['phases']['yaml_dump'])
+
+        with profiler(None, 'update') as memory:
+            pass
+        self.assertEqual(memory, {})
+
+        # events are emitted when profiling whatever the log level
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(EVENT_LOGGER, 'handlers', []), \
+                mock.patch.object(EVENT_LOGGER, 'level', logging.NOTSET), \
+                mock.patch.object(EVENT_LOGGER, 'propagate', True), \
+                mock.patch.object(logging.getLogger(), 'level',
+                                  logging.ERROR), \
+                mock.patch('sys.stderr', io.StringIO()) as stderr:
+            self.assertFalse(EVENT_LOGGER.isEnabledFor(logging.INFO))
+
+            filepath = os.path.join(tmpdir, 'update.pstats')
+            with profiler(filepath, 'update') as memory:
+                sum(range(1000))
+            timer.log()
+            self.assertTrue(os.path.exists(filepath))
+            self.assertGreater(memory['peak_rss'], 0)
+
+            events = [json.loads(line) for line in
+                      stderr.getvalue().splitlines() if line.startswith('{')]
+            self.assertEqual([e['event'] for e in events],
+                             ['memory', 'phase', 'phase', 'command'])
+
+    def test_config_snapshot(self):
+        """Test compiled configuration snapshots"""
+
+        os.environ['GEOMET_MAPPROXY_TEST_URL'] = 'http://localhost/wms'
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'config.yml')
+            snapshot = get_config_snapshot_filepath(filepath, tmpdir)
+
+            with open(filepath, 'w') as fh:
+                fh.write('url: ${GEOMET_MAPPROXY_TEST_URL}\nlayers: [a]\n')
+
+            config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['url'], 'http://localhost/wms')
+            self.assertTrue(os.path.exists(snapshot))
+
+            # unchanged configuration is loaded from the snapshot
+            with open(snapshot) as fh:
+                data = json.load(fh)
+            data['data']['layers'] = ['b']
+            with open(snapshot, 'w') as fh:
+                json.dump(data, fh)
+            config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['layers'], ['b'])
+
+            # referenced environment variable changes invalidate
+            os.environ['GEOMET_MAPPROXY_TEST_URL'] = 'http://localhost/ows'
+            config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['url'], 'http://localhost/ows')
+            self.assertEqual(config['layers'], ['a'])
+
+            # content changes invalidate
+            with open(filepath, 'a') as fh:
+                fh.write('name: test\n')
+            config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['name'], 'test')
+
+            # snapshots writable by others, or outside a private directory,
+            # are not trusted
+            self.assertEqual(os.path.dirname(snapshot),
+                             get_private_dir(tmpdir))
+            with open(snapshot) as fh:
+                data = json.load(fh)
+            data['data']['name'] = 'planted'
+            with open(snapshot, 'w') as fh:
+                json.dump(data, fh)
+            os.chmod(snapshot, 0o666)
+            with self.assertLogs('geomet_mapproxy.util', 'WARNING'):
+                config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['name'], 'test')
+            self.assertFalse(os.stat(snapshot).st_mode & 0o022)
+
+            with open(snapshot, 'w') as fh:
+                json.dump(data, fh)
+            os.chmod(get_private_dir(tmpdir), 0o777)
+            with self.assertLogs('geomet_mapproxy.util', 'WARNING'):
+                config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertEqual(config['name'], 'test')
+            # (snapshots of the current user are trusted)
+            os.chmod(get_private_dir(tmpdir), 0o700)
+            self.assertEqual(yaml_load_snapshot(filepath, tmpdir)['name'],
+                             'planted')
+
+            # configurations not surviving a JSON round trip are not
+            # snapshotted
+            os.remove(snapshot)
+            with open(filepath, 'w') as fh:
+                fh.write('updated: 2024-01-01T00:00:00Z\n')
+            config = yaml_load_snapshot(filepath, tmpdir)
+            self.assertNotIsInstance(config['updated'], str)
+            self.assertFalse(os.path.exists(snapshot))
+
+            # MapProxy applications are built from snapshots with the
+            # validation and errors of MapProxy, without patching it
+            with open(filepath, 'w') as fh:
+                fh.write('services:\n  wms:\n    md: {title: test}\n'
+                         'layers:\n  - {name: test, title: test, '
+                         'sources: []}\n')
+            app = make_mapproxy_app(filepath, tmpdir)
+            self.assertTrue(os.path.exists(snapshot))
+            self.assertEqual(list(app.config_files),
+                             [os.path.abspath(filepath)])
+            self.assertIs(mapproxy.config.loader.load_yaml_file,
+                          mapproxy.util.yaml.load_yaml_file)
+
+            for content in ['- layers\n', 'layers: [\n', 'layers: 1\n']:
+                with open(filepath, 'w') as fh:
+                    fh.write(content)
+                with self.assertRaises(ConfigurationError):
+                    make_mapproxy_app(filepath, tmpdir)
+
+        del os.environ['GEOMET_MAPPROXY_TEST_URL']
+
+    def test_import_time(self):
+        """Test CLI start-up imports"""
+
+        modules = get_cli_imports()[0]
+        for module in ['mappyfile', 'owslib', 'lxml', 'requests', 'mapproxy',
+                       'http.server']:
+            self.assertNotIn(module, modules)
+
+    @unittest.skipUnless(os.environ.get('GEOMET_MAPPROXY_TEST_IMPORT_TIME'),
+                         'GEOMET_MAPPROXY_TEST_IMPORT_TIME not set')
+    def test_import_time_budget(self):
+        """Test CLI start-up import time"""
+
+        import_time = get_cli_imports()[1]
+        self.assertGreater(import_time, 0)
+        self.assertLess(import_time, IMPORT_TIME_BUDGET)
+
+    def test_graceful_reload(self):
+        """Test preloaded application reloads"""
+
+        config = """
+services:
+  wms:
+    md:
+      title: {}
+layers:
+  - name: test
+    title: Test
+    sources: [debug]
+sources:
+  debug:
+    type: debug
+"""
+        environ = make_environ(
+            'SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities')
+        setup_testing_defaults(environ)
+
+        def capabilities():
+            return dict(environ)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'config.yml')
+            with open(filepath, 'w') as fh:
+                fh.write(config.format('Initial'))
+            write_config_generation(filepath)
+
+            reloader = GracefulReloader(filepath)
+            status, headers, body = run_app(reloader,
+                                            capabilities())
+            self.assertIn(b'Initial', body)
+
+            # configuration changes are only applied on reload
+            with open(filepath, 'w') as fh:
+                fh.write(config.format('Updated'))
+            generation = write_config_generation(filepath)
+            status, headers, body = run_app(reloader,
+                                            capabilities())
+            self.assertIn(b'Initial', body)
+
+            self.assertGreaterEqual(reload_applications(), 1)
+            self.assertEqual(reloader.generation, generation)
+            status, headers, body = run_app(reloader,
+                                            capabilities())
+            self.assertIn(b'Updated', body)
+
+            # invalid configurations keep the current application
+            with open(filepath, 'w') as fh:
+                fh.write('layers: [')
+            self.assertFalse(reloader.reload())
+            status, headers, body = run_app(reloader,
+                                            capabilities())
+            self.assertIn(b'Updated', body)
+
+            # generation marker changes signal the process
+            signalled = threading.Event()
+            handler = signal.signal(signal.SIGUSR1,
+                                    lambda signum, frame: signalled.set())
+            try:
+                watch_applications(0.05, signal.SIGUSR1)
+                write_config_generation(filepath)
+                self.assertTrue(signalled.wait(5))
+            finally:
+                signal.signal(signal.SIGUSR1, handler)
+
+    def test_upstream_failures(self):
+        """Test upstream retries, circuit breaker and stale dimensions"""
+
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError('connection refused')
+            return 'ok'
+
+        self.assertEqual(call_with_retries(flaky, 2, backoff=0), ('ok', 3))
+        calls.clear()
+        with self.assertRaises(ConnectionError):
+            call_with_retries(flaky, 1, backoff=0)
+        # no retry past the deadline
+        calls.clear()
+        with self.assertRaises(ConnectionError):
+            call_with_retries(flaky, 2, backoff=0,
+                              deadline=time.monotonic())
+        self.assertEqual(len(calls), 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_filepath = os.path.join(tmpdir, 'breaker.json')
+            breaker = CircuitBreaker(state_filepath, threshold=2, cooldown=60)
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+
+            # state is shared by successive runs, half-open after cool down
+            breaker = CircuitBreaker(state_filepath, threshold=2, cooldown=0)
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+            self.assertEqual(CircuitBreaker(state_filepath).failures, 0)
+
+            # failing layers keep their last known dimensions
+            config_filepath = os.path.join(tmpdir, 'config.yml')
+            dimensions = {
+                'time': {
+                    'default': '2026-10-19T00:00:00Z',
+                    'values': ['2026-10-19T00:00:00Z']
+                }
+            }
+            write_dimensions_index(config_filepath, {
+                'layers': [{'name': 'GDPS.ETA_TT', 'dimensions': dimensions}]
+            })
+
+            config = sys.modules['geomet_mapproxy.config']
+            with mock.patch.multiple(
+                    config,
+                    GEOMET_MAPPROXY_CACHE_WMS='http://127.0.0.1:9/wms',
+                    GEOMET_MAPPROXY_CONFIG=config_filepath,
+                    GEOMET_MAPPROXY_WMS_RETRIES=0,
+                    GEOMET_MAPPROXY_WMS_BREAKER_THRESHOLD=2,
+                    BREAKER_FILE=state_filepath):
+                timer = PhaseTimer('update')
+                ltu = config.from_wms(['GDPS.ETA_TT', 'NEW_LAYER'], timer)
+                self.assertEqual(ltu, {'GDPS.ETA_TT': dimensions})
+                self.assertFalse(CircuitBreaker(state_filepath).allow())
+                self.assertEqual(
+                    len(timer.summary()['phases']['fetch']['slowest_layers']),
+                    2)
+
+                # open circuit skips the upstream
+                ltu = config.from_wms(['GDPS.ETA_TT'])
+                self.assertEqual(ltu, {'GDPS.ETA_TT': dimensions})
+
+                # layers are skipped once the time budget is spent
+                os.remove(state_filepath)
+                with self.assertLogs(config.LOGGER, 'WARNING') as logs:
+                    ltu = config.from_wms(['GDPS.ETA_TT', 'NEW_LAYER'],
+                                          budget=1e-9)
+                self.assertEqual(ltu, {'GDPS.ETA_TT': dimensions})
+                self.assertIn('budget', logs.output[0])
+                self.assertTrue(CircuitBreaker(state_filepath).allow())
+                self.assertEqual(CircuitBreaker(state_filepath).failures, 0)
+
+                # a layer missing from a responding WMS is a success
+                breaker = CircuitBreaker(state_filepath)
+                breaker.record_failure()
+                wms = mock.MagicMock()
+                wms.__getitem__.side_effect = KeyError('NEW_LAYER')
+                with mock.patch('owslib.wms.WebMapService',
+                                return_value=wms):
+                    self.assertEqual(config.from_wms(['NEW_LAYER']), {})
+                self.assertEqual(CircuitBreaker(state_filepath).failures, 0)
+
+            # only one update runs at a time
+            lock_filepath = os.path.join(tmpdir, 'config.lock')
+            lock = FileLock(lock_filepath)
+            self.assertTrue(lock.acquire())
+            self.assertFalse(FileLock(lock_filepath).acquire())
+            lock.release()
+            with FileLock(lock_filepath):
+                self.assertFalse(FileLock(lock_filepath).acquire())
+
+                # overlapping runs exit with a distinct status
+                with mock.patch.object(config, 'LOCK_FILE', lock_filepath):
+                    for command in (config.create, config.update):
+                        result = CliRunner().invoke(command, [])
+                        self.assertEqual(result.exit_code,
+                                         config.EXIT_LOCKED)
+                        self.assertIn('skipping', result.output)
+
+    def test_access_log_stats(self):
+        """Test access log aggregation"""
+
+        params = {k.lower(): v for k, v in parse_qsl(
+            get_getmap_query('GDPS.ETA_TT', 5, 3, 7))}
+        self.assertEqual(get_tile(params), ('GLOBAL_WEBMERCATOR', 5, 3, 7))
+        # WMS 1.3.0 EPSG:4326 axis order
+        self.assertEqual(get_tile({
+            'crs': 'EPSG:4326', 'bbox': '0,-135,45,-90', 'width': '256'
+        }), ('GLOBAL_GEODETIC', 3, 1, 2))
+        self.assertEqual(get_tile({'srs': 'EPSG:2960'}),
+                         ('other', None, None, None))
+
+        self.assertEqual(get_zoom_range({3: 1, 5: 50, 6: 40, 12: 9}, 0.9),
+                         [5, 6])
+
+        hitters = HeavyHitters(capacity=2)
+        for key in 'aaabaacad':
+            hitters.add(key)
+        self.assertEqual(hitters.most_common(1), [('a', 5)])
+        self.assertLessEqual(len(hitters.counts), 2)
+
+        index = {
+            'layers': {
+                'RADAR_1KM_RRAI': {
+                    'dimensions': {
+                        'time': {
+                            'default': '2026-10-19T12:00:00Z',
+                            'values': [
+                                '2026-10-19T09:00:00Z/2026-10-19T12:00:00Z/'
+                                'PT6M'
+                            ]
+                        }
+                    },
+                    # default updated 3 minutes after its valid time
+                    'updated': 1792411380
+                }
+            }
+        }
+        line = ('10.0.0.1 - - [19/Oct/2026:{} +0000] "GET /?{} HTTP/1.1" '
+                '200 1234 "-" "curl" "{}"\n')
+        stats = AccessLogStats(index)
+        for time_, query, cache in [
+                ('12:30:00', get_getmap_query('RADAR_1KM_RRAI', 4, 1, 2),
+                 'HIT'),
+                ('12:30:00', get_getmap_query('RADAR_1KM_RRAI', 4, 1, 2),
+                 'MISS'),
+                ('12:30:00', get_getmap_query('RADAR_1KM_RRAI', 5, 2, 4),
+                 '-'),
+                ('12:32:00', get_getmap_query(
+                    'RADAR_1KM_RRAI', 4, 1, 2, '2026-10-19T12:18:00Z'),
+                 'HIT'),
+                ('12:33:00', 'SERVICE=WMS&REQUEST=GetCapabilities', '-')]:
+            stats.add(line.format(time_, query, cache))
+        stats.add('garbage\n')
+
+        summary = stats.summary(top=1, coverage=0.5)
+        self.assertEqual(summary['lines'], 6)
+        self.assertEqual(summary['unparsed'], 1)
+        self.assertEqual(summary['requests'],
+                         {'getmap': 4, 'getcapabilities': 1})
+
+        layer = summary['layers']['RADAR_1KM_RRAI']
+        self.assertEqual(layer['requests'], 4)
+        self.assertEqual(layer['cache'], {'hit': 2, 'miss': 1, 'unknown': 1})
+        # the default at 12:32 was 12:24, requested time is one step earlier
+        self.assertEqual(layer['time_offsets'], {'default': 3, '-PT6M': 1})
+        grid = layer['grids']['GLOBAL_WEBMERCATOR']
+        self.assertEqual(grid['zooms'], {4: 3, 5: 1})
+        self.assertEqual(grid['recommended_zooms'], [4, 4])
+        self.assertEqual(summary['hot_tiles'], [{
+            'layer': 'RADAR_1KM_RRAI', 'grid': 'GLOBAL_WEBMERCATOR',
+            'z': 4, 'x': 1, 'y': 2, 'requests': 3
+        }])
+
+        seeds = get_seed_config(summary)['seeds']
+        self.assertEqual(seeds['RADAR_1KM_RRAI_GLOBAL_WEBMERCATOR'], {
+            'caches': ['RADAR_1KM_RRAI_cache'],
+            'grids': ['GLOBAL_WEBMERCATOR'],
+            'levels': {'from': 4, 'to': 4}
+        })
+
+        # keys from client supplied values are bounded
+        stats = AccessLogStats(index, max_time_offsets=2)
+        for i in range(5):
+            for query in [
+                    get_getmap_query('UNKNOWN_{}'.format(i), 4, 1, 2),
+                    get_getmap_query('RADAR_1KM_RRAI', 4, 1, 2,
+                                     '2026-10-19T1{}:00:00Z'.format(i)),
+                    'SERVICE=WMS&REQUEST=Unknown{}'.format(i)]:
+                stats.add(line.format('12:30:00', query, '-'))
+        summary = stats.summary()
+        self.assertEqual(sorted(summary['layers']),
+                         ['RADAR_1KM_RRAI', 'other'])
+        self.assertEqual(summary['layers']['other']['requests'], 5)
+        self.assertEqual(len(summary['layers']['RADAR_1KM_RRAI'][
+            'time_offsets']), 3)
+        self.assertEqual(summary['layers']['RADAR_1KM_RRAI'][
+            'time_offsets']['other'], 3)
+        self.assertEqual(summary['requests'], {'getmap': 10, 'other': 5})
+        self.assertNotIn('other', [x['layer'] for x in summary['hot_tiles']])
+        self.assertEqual(list(get_seed_config(summary)['seeds']),
+                         ['RADAR_1KM_RRAI_GLOBAL_WEBMERCATOR'])
+
+        # without a dimensions index, the number of layers is bounded
+        stats = AccessLogStats(max_layers=2)
+        for i in range(5):
+            stats.add(line.format('12:30:00', get_getmap_query(
+                'LAYER_{}'.format(i), 4, 1, 2), '-'))
+        self.assertEqual(sorted(stats.summary()['layers']),
+                         ['LAYER_0', 'LAYER_1', 'other'])
+
+        # nor when the configuration has no dimensions index (yet)
+        logfile = os.path.join(TMPDIR, 'access.log')
+        with open(logfile, 'w') as fh:
+            fh.write(line.format('12:30:00', get_getmap_query(
+                'RADAR_1KM_RRAI', 4, 1, 2), '-'))
+        environ = os.environ.copy()
+        environ['GEOMET_MAPPROXY_CONFIG'] = os.path.join(
+            TMPDIR, 'no-index-config.yml')
+        result = subprocess.run(
+            [sys.executable, '-c', 'from geomet_mapproxy import cli; cli()',
+             'stats', 'access-log', logfile],
+            env=environ, stdout=subprocess.PIPE, check=True,
+            universal_newlines=True)
+        self.assertEqual(list(json.loads(result.stdout)['layers']),
+                         ['RADAR_1KM_RRAI'])
+
+    def test_incremental_update(self):
+        """Test incremental configuration updates"""
+
+        def get_config(default):
+            return {
+                'caches': {'A_cache': {'grids': ['GLOBAL_GEODETIC']}},
+                'layers': [{
+                    'name': name,
+                    'dimensions': {
+                        'time': {'default': default, 'values': [default]}
+                    }
+                } for name in ['A', 'B']],
+                'services': {'demo': None}
+            }
+
+        config = get_config('2026-10-19T00:00:00Z')
+        content = io.StringIO()
+        yaml_dump(config, content)
+        yaml_, fragments = yaml_dump_fragments(config)
+        self.assertEqual(yaml_, content.getvalue())
+
+        # only changed layers are serialized again
+        config['layers'][0]['dimensions']['time']['default'] = 'changed'
+        fragments['layers']['B'] = '- name: B\n'
+        yaml_, _ = yaml_dump_fragments(config, fragments, ['A'])
+        self.assertIn('default: changed', yaml_)
+        self.assertTrue(yaml_.endswith('- name: B\nservices:\n'
+                                       '  demo: null\n'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'config.yml')
+            write_dimensions_index(filepath,
+                                   get_config('2026-10-19T00:00:00Z'))
+            self.assertEqual(get_changed_layers(config, filepath), ['A'])
+            self.assertEqual(get_changed_layers(
+                get_config('2026-10-19T00:00:00Z'), filepath), [])
+
+            # fragments are only trusted if private to the current user
+            with open(filepath, 'w') as fh:
+                fh.write(yaml_)
+            generation = write_config_generation(filepath)
+            write_config_fragments(filepath, tmpdir, fragments, generation)
+            self.assertEqual(read_config_fragments(filepath, tmpdir),
+                             fragments)
+            os.chmod(get_config_fragments_filepath(filepath, tmpdir), 0o664)
+            with self.assertLogs('geomet_mapproxy.util', 'WARNING'):
+                self.assertIsNone(read_config_fragments(filepath, tmpdir))
+
+        # the structure key changes with the layer list
+        cache_config = {'wms-server': {'layers': ['A*']}}
+        key = get_config_structure_key(cache_config, ['A', 'AB'])
+        self.assertEqual(key, get_config_structure_key(cache_config,
+                                                       ['A', 'AB']))
+        self.assertNotEqual(key, get_config_structure_key(cache_config,
+                                                          ['A']))
+
+        # create, then update: the configuration written incrementally
+        # matches a full regeneration
+        layer_names = get_layer_names(4)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            env = prepare_workdir(workdir, layer_names, 'http://localhost')
+            environ = os.environ.copy()
+            environ.update(env)
+            config_filepath = env['GEOMET_MAPPROXY_CONFIG']
+            xml_filepath = env['GEOMET_MAPPROXY_CACHE_XML']
+
+            def run(command, config_filepath=config_filepath):
+                environ['GEOMET_MAPPROXY_CONFIG'] = config_filepath
+                return subprocess.run(
+                    [sys.executable, '-c',
+                     'from geomet_mapproxy import cli; cli()',
+                     'config', command, '--mode', 'xml'],
+                    env=environ, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, check=True,
+                    universal_newlines=True)
+
+            def read(filepath=config_filepath):
+                with open(filepath) as fh:
+                    return fh.read()
+
+            def change_dimensions(old, new):
+                with open(xml_filepath) as fh:
+                    head, tail = fh.read().rsplit(old, 1)
+                with open(xml_filepath, 'w') as fh:
+                    fh.write(new.join([head, tail]))
+
+            def regenerate():
+                filepath = os.path.join(workdir, 'full.yml')
+                run('create', filepath)
+                return read(filepath)
+
+            run('create')
+            created = read()
+
+            self.assertIn('No changes', run('update').stdout)
+            self.assertEqual(read(), created)
+
+            change_dimensions('2024-01-02T00:00:00Z/PT6M',
+                              '2024-01-03T00:00:00Z/PT6M')
+            self.assertIn('Dimensions of 1 layers changed',
+                          run('update').stdout)
+            self.assertNotEqual(read(), created)
+            self.assertEqual(read(), regenerate())
+
+            # edits by hand (of unchanged layers) are kept
+            title = 'title: {}\n'.format(layer_names[0])
+            self.assertEqual(read().count(title), 1)
+            with open(config_filepath, 'w') as fh:
+                fh.write(created.replace(title, 'title: Edited\n'))
+            change_dimensions('2024-01-03T00:00:00Z/PT6M',
+                              '2024-01-04T00:00:00Z/PT6M')
+            result = run('update')
+            self.assertIn('modified since it was written', result.stderr)
+            self.assertEqual(read(), regenerate().replace(
+                title, 'title: Edited\n'))
+
+            # dimensions removed upstream are removed
+            with open(xml_filepath) as fh:
+                xml = re.sub(r'<Dimension .*?</Dimension>', '', fh.read(),
+                             flags=re.DOTALL)
+            with open(xml_filepath, 'w') as fh:
+                fh.write(xml)
+            self.assertIn('Dimensions of {} layers changed'.format(
+                len(layer_names)), run('update').stdout)
+            self.assertNotIn('dimensions:', read())
+            self.assertEqual(read(), regenerate().replace(
+                title, 'title: Edited\n'))
+
+            # snapshots and fragments of other configurations, and leftover
+            # temporary files, are pruned
+            private_dir = get_private_dir(workdir)
+            stale = [os.path.join(private_dir, name) for name in [
+                'geomet-mapproxy-snapshot-0123456789abcdef.json',
+                'geomet-mapproxy-fragments-0123456789abcdef.json',
+                '{}.123'.format(os.path.basename(
+                    get_config_snapshot_filepath(config_filepath, workdir)))
+            ]] + [os.path.join(workdir, os.path.basename(
+                get_config_snapshot_filepath(config_filepath, workdir)))]
+            for filepath in stale:
+                with open(filepath, 'w') as fh:
+                    fh.write('{}')
+                os.utime(filepath, (0, 0))
+            run('update')
+            for filepath in stale:
+                self.assertFalse(os.path.exists(filepath))
+            self.assertTrue(os.path.exists(
+                get_config_snapshot_filepath(config_filepath, workdir)))
+
+    def test_threaded_serving(self):
+        """Test multi-threaded serving and reloads"""
+
+        from mapproxy.util import async_
+
+        # upstream requests of MapProxy worker threads are attributed to
+        # the request they were made for, not to concurrent requests
+        upstream = logging.getLogger('mapproxy.source.request')
+        barrier = threading.Barrier(16)
+
+        def fetch(i):
+            upstream.info('%s %s %d %s %s', 'GET',
+                          'http://localhost/?LAYERS=L&CRS=EPSG:3857', 200,
+                          '10', '25')
+
+        def app(environ, start_response):
+            barrier.wait(10)
+            if 'MISS' in environ['QUERY_STRING']:
+                list(async_.imap(fetch, range(2)))
+            else:
+                time.sleep(0.05)
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return [b'png']
+
+        config = os.path.join(TMPDIR, 'threaded-config.yml')
+        write_dimensions_index(config, {'layers': [{'name': 'L'}]})
+        metrics = Metrics(app, config_filepath=config, upstream=True)
+        results = {}
+
+        def client(i):
+            result = ['HIT', 'MISS'][i % 2]
+            status, headers, body = run_app(metrics, make_environ(
+                'SERVICE=WMS&REQUEST=GetMap&CRS=EPSG:3857&LAYERS=L&X={}'
+                .format(result)))
+            results[i] = (result, headers['X-Cache'])
+
+        clients = [threading.Thread(target=client, args=(i,))
+                   for i in range(16)]
+        for client_ in clients:
+            client_.start()
+        for client_ in clients:
+            client_.join()
+
+        self.assertEqual(len(results), 16)
+        for expected, result in results.values():
+            self.assertEqual(result, expected)
+
+        status, headers, body = run_app(metrics, make_environ(
+            '', PATH_INFO='/metrics', REMOTE_ADDR='127.0.0.1'))
+        self.assertIn('geomet_mapproxy_cache_requests_total{layer="L",'
+                      'grid="GLOBAL_WEBMERCATOR",result="miss"} 8',
+                      body.decode('utf-8'))
+
+        self.assertEqual(parse_layouts('8x1,2x4, 1x8'),
+                         [(8, 1), (2, 4), (1, 8)])
+        with self.assertRaises(ValueError):
+            parse_layouts('0x4')
+
+        # concurrent requests against a stub upstream while reloading
+        layer_names = get_layer_names(5)
+        requests = generate_request_mix(
+            layer_names, 'hit=40,miss=30,capabilities=15,time=15', 200)
+
+        with tempfile.TemporaryDirectory() as workdir, \
+                StubWMS(layer_names, 0.005) as stub:
+            env = prepare_workdir(workdir, layer_names, stub.url)
+            environ = os.environ.copy()
+            environ.update(env)
+            subprocess.run([sys.executable, '-c',
+                            'from geomet_mapproxy import cli; cli()',
+                            'config', 'create', '--mode', 'xml'],
+                           env=environ, stdout=subprocess.DEVNULL,
+                           check=True)
+
+            for mode in ['mtime', 'signal']:
+                env['GEOMET_MAPPROXY_RELOAD'] = mode
+                environ_ = os.environ.copy()
+                module = load_wsgi_module(env)
+                self.assertEqual(os.environ, environ_)
+                self.assertNotIn(module, sys.modules.values())
+                application = module.application
+                reloader = module.reloader
+                app_ = reloader.app
+
+                def reload():
+                    if mode == 'signal':
+                        reloader.reload()
+                    else:
+                        mtime = time.time() + reloads[0]
+                        os.utime(env['GEOMET_MAPPROXY_CONFIG'],
+                                 (mtime, mtime))
+
+                errors = []
+                reloads = [0]
+                queue = iter(requests)
+                lock = threading.Lock()
+                stop = threading.Event()
+
+                def client():
+                    while True:
+                        with lock:
+                            request = next(queue, None)
+                        if request is None:
+                            return
+                        try:
+                            if not call_wsgi_application(application,
+                                                         request[1]):
+                                errors.append(request)
+                        except Exception as err:
+                            errors.append((request, err))
+
+                def reload_loop():
+                    while not stop.wait(0.05):
+                        reloads[0] += 1
+                        reload()
+
+                reload_thread = threading.Thread(target=reload_loop)
+                reload_thread.start()
+                clients = [threading.Thread(target=client)
+                           for i in range(16)]
+                for client_ in clients:
+                    client_.start()
+                for client_ in clients:
+                    client_.join()
+                stop.set()
+                reload_thread.join()
+
+                self.assertEqual(errors, [], mode)
+                self.assertGreater(reloads[0], 0, mode)
+                self.assertIsNot(reloader.app, app_, mode)
+
 
 if __name__ == '__main__':
     unittest.main()